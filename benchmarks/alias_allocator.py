@@ -0,0 +1,96 @@
+"""
+compares modules.generate_alias.AliasAllocator against the md5 prefix
+generate_alias it replaced: aliases generated per second, and urls created
+per second when each generated alias is inserted the way /create_url does.
+the legacy run retries on conflict like a client would, and reports how
+many conflicts it hit.
+
+    python -m benchmarks.alias_allocator --urls 200000
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import tempfile
+import time
+
+from benchmarks.common import set_server_args
+
+
+def legacy_generate_alias(url):
+    # the previous modules/generate_alias.py generate_alias
+    timestamp = datetime.datetime.now()
+    unique_object = f"{url}/{timestamp}"
+    return hashlib.md5(unique_object.encode()).hexdigest()[:5]
+
+
+def report(label, count, elapsed, extra=""):
+    print(f"{label:>32}: {count / elapsed:10,.0f}/s {extra}")
+
+
+def time_generation(label, generate, count):
+    start = time.perf_counter()
+    for i in range(count):
+        generate(f"https://example.com/{i}")
+    report(label, count, time.perf_counter() - start)
+
+
+def time_inserts(label, sqlite_helpers, sqlite_file, generate, count):
+    conflicts = 0
+    start = time.perf_counter()
+    for i in range(count):
+        url = f"https://example.com/{i}"
+        while sqlite_helpers.insert_url(sqlite_file, url, generate(url), None) is None:
+            conflicts += 1
+    report(label, count, time.perf_counter() - start, f"({conflicts:,} conflicts)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=200000)
+    parser.add_argument("--alias-length", type=int, default=6)
+    parser.add_argument("--block-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    set_server_args(os.path.join(directory, "unused.db"), directory)
+    import modules.sqlite_helpers as sqlite_helpers
+    from modules.generate_alias import AliasAllocator
+    from modules.storage import SQLiteStorage
+
+    def new_database(name):
+        sqlite_file = os.path.join(directory, f"{name}.db")
+        sqlite_helpers.maybe_create_table(sqlite_file)
+        return sqlite_file
+
+    allocators = {
+        "sequential": lambda sqlite_file: AliasAllocator(
+            SQLiteStorage(sqlite_file), args.alias_length, args.block_size, obfuscate=False
+        ),
+        "feistel": lambda sqlite_file: AliasAllocator(
+            SQLiteStorage(sqlite_file), args.alias_length, args.block_size, obfuscate=True
+        ),
+    }
+
+    print(f"generation, {args.urls:,} aliases")
+    time_generation("md5 prefix", legacy_generate_alias, args.urls)
+    for name, make in allocators.items():
+        allocator = make(new_database(f"generate_{name}"))
+        time_generation(f"allocator {name}", lambda url: allocator.allocate(), args.urls)
+
+    print(f"generation + insert_url, {args.urls:,} urls")
+    time_inserts(
+        "md5 prefix", sqlite_helpers, new_database("insert_legacy"),
+        legacy_generate_alias, args.urls,
+    )
+    for name, make in allocators.items():
+        sqlite_file = new_database(f"insert_{name}")
+        allocator = make(sqlite_file)
+        time_inserts(
+            f"allocator {name}", sqlite_helpers, sqlite_file,
+            lambda url: allocator.allocate(), args.urls,
+        )
+
+
+if __name__ == "__main__":
+    main()
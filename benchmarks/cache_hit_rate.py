@@ -0,0 +1,101 @@
+"""
+compares the hit rate of modules.cache.Cache against the OrderedDict cache
+it replaced, on a zipfian /find trace with optional scans of one-off aliases
+mixed in. the lookups/sec column for Cache includes its locking, logging
+and metrics, which the legacy copy leaves out.
+
+    python -m benchmarks.cache_hit_rate --aliases 100000 --requests 1000000
+"""
+import argparse
+from collections import OrderedDict
+import itertools
+import random
+import time
+
+from modules.cache import Cache
+from modules.metrics import MetricsHandler
+
+
+class LegacyCache:
+    # the previous modules/cache.py Cache, minus logging and metrics
+    def __init__(self, cacheSize):
+        self.dict = OrderedDict()
+        self.size = cacheSize
+
+    def find(self, alias):
+        if alias not in self.dict:
+            return None
+        self.dict.move_to_end(alias, last=False)
+        return self.dict[alias]
+
+    def add(self, alias, url_output):
+        if len(self.dict) == self.size:
+            self.dict.popitem()
+        self.dict[alias] = url_output
+
+
+def zipf_trace(num_aliases, num_requests, exponent, scan_every, scan_length, seed):
+    rng = random.Random(seed)
+    cum_weights = list(
+        itertools.accumulate(1 / (rank ** exponent) for rank in range(1, num_aliases + 1))
+    )
+    ranks = rng.choices(range(num_aliases), cum_weights=cum_weights, k=num_requests)
+    # shuffle which alias gets which rank so hot aliases aren't clustered
+    names = [f"a{i}" for i in range(num_aliases)]
+    rng.shuffle(names)
+    scan_ids = itertools.count()
+    for i, rank in enumerate(ranks):
+        if scan_every and i % scan_every == 0 and i > 0:
+            for _ in range(scan_length):
+                yield f"scan{next(scan_ids)}"
+        yield names[rank]
+
+
+def replay(cache, trace):
+    hits = 0
+    total = 0
+    start = time.perf_counter()
+    for alias in trace:
+        total += 1
+        if cache.find(alias) is not None:
+            hits += 1
+        else:
+            cache.add(alias, "https://example.com/" + alias)
+    elapsed = time.perf_counter() - start
+    return hits / total, total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aliases", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=1000000)
+    parser.add_argument("--cache-size", type=int, default=1000)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--exponent", type=float, default=1.0)
+    parser.add_argument(
+        "--scan-every", type=int, default=0,
+        help="inject a scan of one-off aliases after this many requests, 0 disables",
+    )
+    parser.add_argument("--scan-length", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    MetricsHandler.init()
+
+    def trace():
+        return zipf_trace(
+            args.aliases, args.requests, args.exponent,
+            args.scan_every, args.scan_length, args.seed,
+        )
+
+    caches = {
+        "legacy": LegacyCache(args.cache_size),
+        "slru": Cache(args.cache_size, shards=args.shards),
+    }
+    for name, cache in caches.items():
+        hit_rate, throughput = replay(cache, trace())
+        print(f"{name:>8}: hit rate {hit_rate:.2%}, {throughput:,.0f} lookups/sec")
+
+
+if __name__ == "__main__":
+    main()
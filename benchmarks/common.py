@@ -0,0 +1,13 @@
+import sys
+
+
+def set_server_args(database_file_path, qr_code_cache_path, *extra):
+    # modules.args parses sys.argv when sqlite_helpers or server is imported,
+    # so benchmarks set it up before importing either of them
+    sys.argv = [
+        sys.argv[0],
+        f"--database-file-path={database_file_path}",
+        f"--qr-code-cache-path={qr_code_cache_path}",
+        "--qr-code-base-url=http://localhost:8000/find",
+        *extra,
+    ]
@@ -0,0 +1,269 @@
+"""
+load test for the server's endpoints. seeds a synthetic database, then
+replays each scenario against server.app in-process, or against a running
+server with --base-url, and reports throughput and p50/p95/p99 latency as
+JSON so runs can be compared.
+
+    find         zipfian /find trace over the seeded aliases
+    create       /create_url burst of generated urls, or one request per
+                 line of --create-file, newline delimited /create_url bodies
+    create_bulk  another such burst posted to /create_urls --bulk-size at a time
+    list         /list searches for words used in the seeded urls
+    qr_cold      /qr of aliases whose qr code was never rendered
+    qr_warm      the same /qr requests again, served from the qr cache
+
+arguments the suite doesn't know are passed on to the server, e.g.
+
+    python -m benchmarks.endpoints --rows 100000 --output before.json -- --cache-size 10000
+
+to drive a local uvicorn instead, seed a database, start the server on it
+and point the suite at both
+
+    python -m benchmarks.endpoints --rows 1000000 --database-file-path urls.db --seed-only
+    python server.py --database-file-path urls.db ...
+    python -m benchmarks.endpoints --rows 1000000 --database-file-path urls.db --base-url http://localhost:8000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.cache_hit_rate import zipf_trace
+from benchmarks.common import set_server_args
+
+SCENARIOS = ("find", "create", "create_bulk", "list", "qr_cold", "qr_warm")
+SEED_CHUNK_SIZE = 100000
+NUM_WORDS = 5000
+
+
+def seed_words(seed):
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9)))
+        for _ in range(NUM_WORDS)
+    ]
+
+
+def seeded_alias(i):
+    # the names zipf_trace hands out, so traces map straight onto rows
+    return f"a{i}"
+
+
+def seed(storage, rows, words, seed):
+    # skipped when the database already has urls, so a database seeded for
+    # a running server is reused as is
+    storage.maybe_create_table()
+    existing = storage.get_number_of_entries()
+    if existing:
+        print(f"using {existing:,} existing rows", file=sys.stderr)
+        return
+    rng = random.Random(seed)
+
+    def generate(first, last):
+        # EXPORT_COLUMNS tuples
+        for i in range(first, last):
+            url = f"https://{rng.choice(words)}.com/{rng.choice(words)}/{rng.choice(words)}"
+            yield (url, seeded_alias(i), f"2024-01-01 00:00:{i % 60:02d}.000000", None, 1)
+
+    start = time.perf_counter()
+    for first in range(0, rows, SEED_CHUNK_SIZE):
+        storage.import_urls(list(generate(first, min(rows, first + SEED_CHUNK_SIZE))))
+    print(f"seeded {rows:,} rows in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def create_bodies(create_file, count, prefix):
+    # lines of create_file, or generated urls without an alias so the
+    # server generates one
+    if create_file is not None:
+        with open(create_file, "rb") as lines:
+            return [line for line in lines if line.strip()][:count]
+    return [
+        json.dumps({"url": f"https://example.com/{prefix}/{i}"}).encode()
+        for i in range(count)
+    ]
+
+
+def build_scenarios(args, words):
+    rng = random.Random(args.seed)
+    run_id = f"{time.time_ns():x}"
+    creates = create_bodies(args.create_file, args.create_requests, run_id)
+    # with --create-file both get its lines, so aliases in it will conflict
+    # in whichever of the two runs second
+    bulk_creates = create_bodies(args.create_file, args.create_requests, f"{run_id}-bulk")
+    qr_aliases = rng.sample(range(args.rows), min(args.qr_requests, args.rows))
+    # (method, path, body, expected status) of every request, in order
+    return {
+        "find": lambda: [
+            ("GET", f"/find/{alias}", None, 307)
+            for alias in zipf_trace(
+                args.rows, args.find_requests, args.zipf_exponent, 0, 0, args.seed
+            )
+        ],
+        "create": lambda: [("POST", "/create_url", body, 200) for body in creates],
+        "create_bulk": lambda: [
+            ("POST", "/create_urls", b"\n".join(batch), 200)
+            for batch in chunked(bulk_creates, args.bulk_size)
+        ],
+        "list": lambda: [
+            ("GET", f"/list?search={rng.choice(words)[:rng.randint(3, 6)]}", None, 200)
+            for _ in range(args.list_requests)
+        ],
+        "qr_cold": lambda: [
+            ("GET", f"/qr/{seeded_alias(i)}", None, 200) for i in qr_aliases
+        ],
+        "qr_warm": lambda: [
+            ("GET", f"/qr/{seeded_alias(i)}", None, 200) for i in qr_aliases
+        ],
+    }
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def replay(client, requests, concurrency):
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for method, path, body, expected_status in pending:
+            start = time.perf_counter()
+            response = await client.request(method, path, content=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != expected_status:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def summarize(name, elapsed, latencies, errors):
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+    else:
+        quantiles = latencies * 99 or [0] * 99
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+    }
+
+
+async def run_scenarios(client, scenarios, names, concurrency):
+    results = []
+    for name in names:
+        result = summarize(name, *await replay(client, scenarios[name](), concurrency))
+        print(
+            f"{name:>12}: {result['requests_per_second']:10,.1f} req/s "
+            f"p50 {result['p50_ms']:8.3f} ms p95 {result['p95_ms']:8.3f} ms "
+            f"p99 {result['p99_ms']:8.3f} ms {result['errors']} errors",
+            file=sys.stderr,
+        )
+        results.append(result)
+    return results
+
+
+def scenario_list(value):
+    names = value.split(",")
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown scenarios {', '.join(sorted(unknown))}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--scenarios", type=scenario_list, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--find-requests", type=int, default=20000)
+    parser.add_argument("--zipf-exponent", type=float, default=1.0)
+    parser.add_argument("--create-requests", type=int, default=2000)
+    parser.add_argument("--create-file", help="newline delimited /create_url bodies")
+    parser.add_argument("--bulk-size", type=int, default=500)
+    parser.add_argument("--list-requests", type=int, default=200)
+    parser.add_argument("--qr-requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-file-path", help="defaults to a new temporary database")
+    parser.add_argument("--base-url", help="drive a running server instead of server.app")
+    parser.add_argument(
+        "--fast-find", action="store_true", help="drive server.fast_app instead of server.app"
+    )
+    parser.add_argument("--seed-only", action="store_true")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args, server_args = parser.parse_known_args()
+    if server_args[:1] == ["--"]:
+        server_args = server_args[1:]
+
+    directory = tempfile.mkdtemp()
+    sqlite_file = args.database_file_path or os.path.join(directory, "urls.db")
+    set_server_args(sqlite_file, directory, *server_args)
+    from modules.args import get_args
+    from modules.storage import open_storage
+
+    words = seed_words(args.seed)
+    # the server's own arguments, so --database-shards is seeded the same way
+    storage = open_storage(sqlite_file, get_args().database_shards)
+    seed(storage, args.rows, words, args.seed)
+    if args.seed_only:
+        return
+
+    scenarios = build_scenarios(args, words)
+    if args.base_url is not None:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=None)
+        server = None
+    else:
+        import server
+        app = server.fast_app if args.fast_find else server.app
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None
+        )
+
+    async def run():
+        async with client:
+            return await run_scenarios(client, scenarios, args.scenarios, args.concurrency)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        if server is not None:
+            server.signal_handler()
+
+    report = {
+        "config": {
+            "rows": args.rows,
+            "concurrency": args.concurrency,
+            "target": args.base_url or ("fast_app" if args.fast_find else "app"),
+            "server_args": server_args,
+        },
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+compares cached /find redirects through server.fast_app, which answers
+them ahead of FastAPI, against server.app, the full FastAPI stack with its
+middleware. requests are sent straight to the ASGI callable, concurrency
+at a time, so the numbers are the per-request cost of the stack without
+any network or http parsing. prints requests/sec and latency percentiles.
+
+    python -m benchmarks.fast_find --requests 20000 --concurrency 16
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.common import set_server_args
+
+
+def find_scope(alias):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": f"/find/{alias}",
+        "raw_path": f"/find/{alias}".encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost:8000"), (b"origin", b"http://example.com")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+
+
+async def request(app, scope):
+    status = None
+    request_sent = False
+    response_done = asyncio.Event()
+
+    async def receive():
+        # the body once, then a disconnect after the response, like a
+        # client that closes the connection
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif not message.get("more_body", False):
+            response_done.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    elapsed = time.perf_counter() - start
+    if status != 307:
+        raise RuntimeError(f"expected a redirect, got {status}")
+    return elapsed
+
+
+async def run(app, scopes, num_requests, concurrency):
+    latencies = []
+
+    async def worker(offset):
+        for i in range(offset, num_requests, concurrency):
+            latencies.append(await request(app, scopes[i % len(scopes)]))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    return time.perf_counter() - start, latencies
+
+
+def report(label, elapsed, latencies):
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{label:>10}: {len(latencies) / elapsed:10,.0f} req/s "
+        f"p50 {quantiles[49] * 1e6:7.1f} us p99 {quantiles[98] * 1e6:7.1f} us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--aliases", type=int, default=1000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    set_server_args(
+        os.path.join(directory, "urls.db"), directory,
+        f"--cache-size={args.aliases}", "--cache-shards=1",
+    )
+    import server
+
+    aliases = [f"alias{i}" for i in range(args.aliases)]
+    for alias in aliases:
+        server.cache.add(alias, f"https://example.com/{alias}?from=benchmark")
+    scopes = [find_scope(alias) for alias in aliases]
+
+    async def compare():
+        # warm both up so neither pays for first-call imports
+        for app in (server.app, server.fast_app):
+            await run(app, scopes, len(scopes), args.concurrency)
+        for label, app in (("fastapi", server.app), ("fast path", server.fast_app)):
+            report(label, *await run(app, scopes, args.requests, args.concurrency))
+
+    try:
+        asyncio.run(compare())
+    finally:
+        server.signal_handler()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+times /list searches through the urls_search trigram index against the
+LOWER(...) LIKE '%x%' scan it replaced, on a synthetic database.
+
+    python -m benchmarks.list_search --rows 1000000
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+from benchmarks.common import set_server_args
+
+LEGACY_SEARCH_QUERY = """
+SELECT * FROM urls
+WHERE LOWER(alias) LIKE LOWER(?) OR LOWER(url) LIKE LOWER(?)
+ORDER BY created_at DESC LIMIT 25
+"""
+LEGACY_COUNT_QUERY = """
+SELECT COUNT(*) FROM urls
+WHERE LOWER(alias) LIKE LOWER(?) OR LOWER(url) LIKE LOWER(?)
+"""
+
+
+def seed(sqlite_helpers, sqlite_file, rows, rng):
+    db = sqlite_helpers.get_connection(sqlite_file)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(5000)]
+
+    def generate():
+        for i in range(rows):
+            alias = f"{i:x}{rng.choice(words)}"
+            url = f"https://{rng.choice(words)}.com/{rng.choice(words)}/{rng.choice(words)}"
+            yield (url, alias, f"2024-01-01 00:00:{i % 60:02d}.000000")
+
+    start = time.perf_counter()
+    with db:
+        db.executemany(
+            "INSERT INTO urls(url, alias, created_at) VALUES (?, ?, ?)", generate()
+        )
+    print(f"seeded {rows:,} rows in {time.perf_counter() - start:.1f}s")
+    return words
+
+
+def time_queries(label, run, terms):
+    start = time.perf_counter()
+    for term in terms:
+        run(term)
+    elapsed = time.perf_counter() - start
+    print(f"{label:>24}: {elapsed / len(terms) * 1000:8.2f} ms/search")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--searches", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    sqlite_file = os.path.join(directory, "urls.db")
+    set_server_args(sqlite_file, directory)
+    import modules.sqlite_helpers as sqlite_helpers
+
+    rng = random.Random(args.seed)
+    sqlite_helpers.maybe_create_table(sqlite_file)
+    words = seed(sqlite_helpers, sqlite_file, args.rows, rng)
+    terms = [rng.choice(words)[:rng.randint(3, 6)] for _ in range(args.searches)]
+    db = sqlite_helpers.get_connection(sqlite_file)
+
+    def legacy(term):
+        pattern = f"%{term}%"
+        db.execute(LEGACY_SEARCH_QUERY, (pattern, pattern)).fetchall()
+        db.execute(LEGACY_COUNT_QUERY, (pattern, pattern)).fetchone()
+
+    def indexed(term):
+        sqlite_helpers.get_urls(sqlite_file, search=term)
+        sqlite_helpers.get_number_of_entries(sqlite_file, search=term)
+
+    time_queries("LOWER() LIKE scan", legacy, terms)
+    time_queries("urls_search trigram", indexed, terms)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+times QR Code variants from modules.qr_code.render_qr_code against the
+disk based render /qr used before, which wrote a scale 10 png, read it
+back, pasted the logo and saved it again. prints the mean render time
+and the mean size of the output for each.
+
+    python -m benchmarks.qr_variants --renders 50
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from PIL import Image
+import pyqrcode
+
+from benchmarks.common import set_server_args
+
+DEFAULT_LOGO = os.path.join(os.path.dirname(__file__), "..", "assets", "SCE_logo.png")
+VARIANTS = [
+    ("png", 10),
+    ("png", 4),
+    ("png", 2),
+    ("webp", 10),
+    ("webp", 2),
+    ("svg", 2),
+]
+
+
+def legacy_render(url, path, qr_image_path):
+    # the previous QRCode.add, minus the cache bookkeeping
+    qrcode = pyqrcode.create(url, error="H")
+    qrcode.png(path, scale=10)
+    qrcode_image = Image.open(path).convert("RGBA")
+    sce_logo = Image.open(qr_image_path)
+    qrcode_width, qrcode_height = qrcode_image.size
+    sce_logo_width = int(qrcode_width * 0.2)
+    sce_logo_height = int(qrcode_height * 0.2)
+    sce_logo = sce_logo.resize((sce_logo_width, sce_logo_height))
+    top_left_x = int((qrcode_width / 2) - (sce_logo_width / 2))
+    top_left_y = int((qrcode_height / 2) - (sce_logo_height / 2))
+    box = [top_left_x, top_left_y, top_left_x + sce_logo_width, top_left_y + sce_logo_height]
+    qrcode_image.paste(sce_logo, box)
+    qrcode_image.save(path)
+    with open(path, "rb") as png_file:
+        return png_file.read()
+
+
+def report(label, durations, sizes):
+    print(
+        f"{label:>16}: {statistics.mean(durations) * 1000:7.2f} ms/render "
+        f"{statistics.mean(sizes):9,.0f} bytes"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--renders", type=int, default=50)
+    parser.add_argument("--logo", default=DEFAULT_LOGO)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    set_server_args(os.path.join(directory, "unused.db"), directory)
+    from modules.qr_code import render_qr_code
+
+    urls = [f"https://sce.sjsu.edu/s/alias{i}" for i in range(args.renders)]
+    path = os.path.join(directory, "legacy.png")
+
+    durations, sizes = [], []
+    for url in urls:
+        start = time.perf_counter()
+        sizes.append(len(legacy_render(url, path, args.logo)))
+        durations.append(time.perf_counter() - start)
+    report("legacy png 10", durations, sizes)
+
+    for image_format, scale in VARIANTS:
+        durations, sizes = [], []
+        for url in urls:
+            start = time.perf_counter()
+            data, _ = render_qr_code(url, image_format, scale, args.logo)
+            durations.append(time.perf_counter() - start)
+            sizes.append(len(data))
+        report(f"{image_format} {scale}", durations, sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,30 @@
 import argparse
+import os
 import time
 
+from modules.hit_log import OVERFLOW_DROP, OVERFLOW_POLICIES
+from modules.metrics import DEFAULT_LATENCY_BUCKETS
+
+
+def bucket_list(value):
+    # comma separated upper bounds in seconds, e.g. 0.001,0.01,0.1,1
+    try:
+        buckets = sorted(float(bound) for bound in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a comma separated list of numbers")
+    return tuple(buckets)
+
+
+def cpu_budget(value):
+    # a share of one cpu, above 0 and at most 1
+    try:
+        budget = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a number")
+    if not 0 < budget <= 1:
+        raise argparse.ArgumentTypeError(f"{value} is not above 0 and at most 1")
+    return budget
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -9,6 +33,14 @@ def get_args():
         required=True,
         help="path to sqlite database file"
     )
+    parser.add_argument(
+        "--database-shards",
+        type=int,
+        default=1,
+        help="number of sqlite files urls are spread across by alias. with more than 1, "
+        "urls.db is stored as urls-0.db, urls-1.db and so on. changing it needs "
+        "--reshard-from. defaults to 1"
+    )
     parser.add_argument(
         "--host",
         default="0.0.0.0",
@@ -20,11 +52,33 @@ def get_args():
         default=8000,
         help="port for server to be hosted on, defaults to 8000"
     )
+    parser.add_argument(
+        "--fast-find",
+        action="store_true",
+        help="answer /find cache hits ahead of fastapi and its middleware, misses take the normal path"
+    )
     parser.add_argument(
         "--disable-random-alias",
         action= "store_true",
         help="disable generating randomly hashed aliases"
     )
+    parser.add_argument(
+        "--alias-length",
+        type=int,
+        default=6,
+        help="number of base62 characters in a generated alias. defaults to 6"
+    )
+    parser.add_argument(
+        "--alias-block-size",
+        type=int,
+        default=1000,
+        help="number of alias ids each server process reserves from sqlite at a time. defaults to 1000"
+    )
+    parser.add_argument(
+        "--disable-alias-obfuscation",
+        action="store_true",
+        help="hand out generated aliases in counter order instead of shuffling them"
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -38,6 +92,48 @@ def get_args():
         default=100,
         help="number of url redirects to store in memory. defaults to 100"
     )
+    parser.add_argument(
+        "--cache-backend",
+        default="memory",
+        choices=["memory", "shared"],
+        help="where url redirects are cached. memory keeps a cache per server process, "
+        "shared keeps one memory mapped cache for every process on the host. defaults to memory"
+    )
+    parser.add_argument(
+        "--shared-cache-path",
+        default="/dev/shm/cleezy-redirect-cache",
+        help="file backing the shared cache. defaults to /dev/shm/cleezy-redirect-cache"
+    )
+    parser.add_argument(
+        "--shared-cache-max-url-length",
+        type=int,
+        default=1024,
+        help="longest url in bytes the shared cache stores, longer urls are not cached. defaults to 1024"
+    )
+    parser.add_argument(
+        "--cache-shards",
+        type=int,
+        default=4,
+        help="number of independently locked segments the redirect cache is split into. defaults to 4"
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=None,
+        help="bound the redirect cache by the total length of its aliases and urls instead of --cache-size"
+    )
+    parser.add_argument(
+        "--cache-snapshot-file",
+        default=None,
+        help="JSON file the redirect cache's aliases are saved to on shutdown and preloaded from on startup"
+    )
+    parser.add_argument(
+        "--cache-warmup-size",
+        type=int,
+        default=100,
+        help="number of most used aliases to preload into the redirect cache on startup "
+        "when there is no snapshot, 0 disables. defaults to 100"
+    )
     parser.add_argument(
         "--qr-code-cache-path",
         required=True,
@@ -49,6 +145,19 @@ def get_args():
         default=100,
         help="maxmimum number of images to store on disk for qr codes. defaults to 100"
     )
+    parser.add_argument(
+        "--qr-code-cache-max-bytes",
+        type=int,
+        default=256 * 1024 * 1024,
+        help="maximum total bytes of qr code images to store on disk. defaults to 256 MiB"
+    )
+    parser.add_argument(
+        "--qr-code-memory-cache-bytes",
+        type=int,
+        default=32 * 1024 * 1024,
+        help="maximum bytes of rendered qr codes to keep in memory, in front of the files on disk. "
+        "defaults to 32 MiB"
+    )
     parser.add_argument(
         "--qr-code-base-url",
         required=True,
@@ -61,11 +170,217 @@ def get_args():
     )
     parser.add_argument(
         "--qr-code-cache-state-file",
-        help="the JSON file where the cache will map to. If not specified, the qr-code cache will be cleared",
+        help="the sqlite file that indexes the qr codes on disk, which are then kept across restarts. "
+        "If not specified, the index is kept in the qr code cache path and the qr-code cache is cleared on shutdown",
+    )
+    parser.add_argument(
+        "--qr-prerender-rate",
+        type=float,
+        default=0,
+        help="maximum qr codes rendered per second ahead of demand for new and trending aliases, "
+        "0 disables pre-rendering. defaults to 0"
+    )
+    parser.add_argument(
+        "--qr-prerender-cpu-budget",
+        type=cpu_budget,
+        default=0.25,
+        help="share of one cpu pre-rendering may use, above 0 and at most 1. "
+        "--qr-prerender-rate 0 turns pre-rendering off. defaults to 0.25"
+    )
+    parser.add_argument(
+        "--qr-prerender-queue-size",
+        type=int,
+        default=1000,
+        help="number of aliases waiting to be pre-rendered before more are dropped. defaults to 1000"
+    )
+    parser.add_argument(
+        "--qr-prerender-used-threshold",
+        type=int,
+        default=100,
+        help="pre-render the qr code of an alias once its used count reaches this, 0 disables. defaults to 100"
     )
     parser.add_argument(
         "--expiration-date-timezone",
         default="America/Los_Angeles",
         help="the timezone that url expiration checks will use. defaults to America/Los_Angeles"
     )
+    parser.add_argument(
+        "--expiry-sweep-interval",
+        type=float,
+        default=60,
+        help="seconds between deletes of expired urls, 0 disables. expired urls are never "
+        "redirected to either way. defaults to 60"
+    )
+    parser.add_argument(
+        "--expiry-sweep-batch-size",
+        type=int,
+        default=500,
+        help="number of expired urls deleted per transaction. defaults to 500"
+    )
+    parser.add_argument(
+        "--sqlite-journal-mode",
+        default="WAL",
+        choices=["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"],
+        help="sqlite journal_mode pragma. WAL lets readers run alongside the writer. defaults to WAL"
+    )
+    parser.add_argument(
+        "--sqlite-synchronous",
+        default="NORMAL",
+        choices=["OFF", "NORMAL", "FULL", "EXTRA"],
+        help="sqlite synchronous pragma. NORMAL is durable across crashes of the server when used with WAL. defaults to NORMAL"
+    )
+    parser.add_argument(
+        "--sqlite-cache-size",
+        type=int,
+        default=-8000,
+        help="sqlite cache_size pragma per connection. negative values are in KiB, positive values are pages. defaults to -8000 (8MiB)"
+    )
+    parser.add_argument(
+        "--sqlite-mmap-size",
+        type=int,
+        default=268435456,
+        help="sqlite mmap_size pragma in bytes, 0 disables memory mapped reads. defaults to 268435456 (256MiB)"
+    )
+    parser.add_argument(
+        "--sqlite-statement-cache-size",
+        type=int,
+        default=128,
+        help="number of prepared statements each sqlite connection keeps cached. defaults to 128"
+    )
+    parser.add_argument(
+        "--sqlite-busy-timeout",
+        type=float,
+        default=5.0,
+        help="seconds a sqlite connection waits on a locked database before erroring. defaults to 5"
+    )
+    parser.add_argument(
+        "--search-count-ttl",
+        type=float,
+        default=5.0,
+        help="seconds the total number of matches for a /list search is reused. defaults to 5"
+    )
+    parser.add_argument(
+        "--db-pool-size",
+        type=int,
+        default=4,
+        help="number of threads that run sqlite queries off the event loop. defaults to 4"
+    )
+    parser.add_argument(
+        "--cpu-pool-size",
+        type=int,
+        default=os.cpu_count(),
+        help="number of threads that run qr code work off the event loop. defaults to the number of cpus"
+    )
+    parser.add_argument(
+        "--qr-render-processes",
+        type=int,
+        default=min(2, os.cpu_count() or 1),
+        help="number of processes that render qr codes, 0 renders them on the cpu pool threads instead. "
+        "defaults to 2, or 1 on a single cpu"
+    )
+    parser.add_argument(
+        "--executor-max-queue-size",
+        type=int,
+        default=1024,
+        help="number of calls each pool accepts beyond its thread count before callers wait. defaults to 1024"
+    )
+    parser.add_argument(
+        "--hit-flush-batch-size",
+        type=int,
+        default=500,
+        help="number of /find hits to merge before writing them to the used column. defaults to 500"
+    )
+    parser.add_argument(
+        "--hit-flush-interval",
+        type=float,
+        default=1.0,
+        help="maximum seconds a /find hit waits before being written to the used column. defaults to 1"
+    )
+    parser.add_argument(
+        "--hit-log-path",
+        help="base name of the files /find hits are queued in until they are written, so they "
+        "survive a crash or restart. each server process uses its own, the path followed by .0, "
+        ".1 and so on. defaults to the database file path followed by .hits"
+    )
+    parser.add_argument(
+        "--hit-log-size",
+        type=int,
+        default=8 * 1024 * 1024,
+        help="bytes of queued /find hits the hit log holds, about 20 per hit. defaults to 8388608"
+    )
+    parser.add_argument(
+        "--hit-log-overflow",
+        default=OVERFLOW_DROP,
+        choices=OVERFLOW_POLICIES,
+        help="what happens to a /find hit when the hit log is full. drop discards it, block makes "
+        f"the request wait up to --hit-log-block-timeout for space first. defaults to {OVERFLOW_DROP}"
+    )
+    parser.add_argument(
+        "--hit-log-block-timeout",
+        type=float,
+        default=0.1,
+        help="seconds a /find request waits for space in a full hit log with --hit-log-overflow "
+        "block before its hit is dropped. defaults to 0.1"
+    )
+    parser.add_argument(
+        "--click-retention-days",
+        type=float,
+        default=90,
+        help="days of per-minute click counts /stats can return, 0 keeps them forever. defaults to 90"
+    )
+    parser.add_argument(
+        "--negative-cache-size",
+        type=int,
+        default=0,
+        help="number of unknown aliases to remember so repeated lookups skip sqlite, 0 disables. each "
+        "process remembers its own, so with several server processes an alias created by one can "
+        "404 on the others for up to --negative-cache-ttl. defaults to 0"
+    )
+    parser.add_argument(
+        "--negative-cache-ttl",
+        type=float,
+        default=30.0,
+        help="seconds an unknown alias is remembered by the negative cache. defaults to 30"
+    )
+    parser.add_argument(
+        "--bloom-filter-capacity",
+        type=int,
+        default=0,
+        help="expected number of aliases for a bloom filter that rejects unknown aliases, 0 disables. "
+        "only use with a single server process, since other processes' new aliases are not seen. defaults to 0"
+    )
+    parser.add_argument(
+        "--bloom-filter-error-rate",
+        type=float,
+        default=0.01,
+        help="target false positive rate of the bloom filter. defaults to 0.01"
+    )
+    parser.add_argument(
+        "--metrics-latency-buckets",
+        type=bucket_list,
+        default=DEFAULT_LATENCY_BUCKETS,
+        help="comma separated histogram bucket bounds in seconds for request, /find stage and "
+        "sqlite latency metrics. defaults to 0.0001 up to 10"
+    )
+    transfer = parser.add_mutually_exclusive_group()
+    transfer.add_argument(
+        "--export-file",
+        help="write every url as newline delimited JSON to this file, or - for stdout, then exit"
+    )
+    transfer.add_argument(
+        "--import-file",
+        help="add the urls in a file written by --export-file or /export, or - for stdin, then exit. "
+        "aliases that already exist are skipped"
+    )
+    transfer.add_argument(
+        "--reshard-from",
+        help="copy every url from this database into --database-file-path split into "
+        "--database-shards files, then exit"
+    )
+    parser.add_argument(
+        "--reshard-from-shards",
+        type=int,
+        default=1,
+        help="number of shards the --reshard-from database is split into. defaults to 1"
+    )
     return parser.parse_args()
@@ -1,34 +1,174 @@
 from collections import OrderedDict
+import itertools
 import logging
+import threading
+import time
 
 from modules.metrics import MetricsHandler
 
+# share of each shard reserved for entries that were hit at least twice
+PROTECTED_RATIO = 0.8
+# a shard smaller than this is mostly churn, so small caches use fewer shards
+MIN_ENTRIES_PER_SHARD = 16
+
+
+class CacheShard:
+    """
+    segmented LRU. new entries start in the probation segment and are only
+    promoted to the protected segment when hit again, so a scan over many
+    one-off aliases can only evict other one-off aliases. both segments
+    keep their least recently used entry first
+    """
+
+    def __init__(self, capacity, weigh):
+        self.capacity = capacity
+        self.protected_capacity = int(capacity * PROTECTED_RATIO)
+        self.weigh = weigh
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.probation_weight = 0
+        self.protected_weight = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def find(self, alias):
+        with self.lock:
+            if alias in self.protected:
+                self.protected.move_to_end(alias)
+                return self.protected[alias]
+            if alias not in self.probation:
+                return None
+            entry = self.probation.pop(alias)
+            weight = self.weigh(alias, entry)
+            self.probation_weight -= weight
+            self.protected[alias] = entry
+            self.protected_weight += weight
+            # demote the coldest protected entries back to probation
+            while self.protected_weight > self.protected_capacity and len(self.protected) > 1:
+                demoted_alias, demoted_entry = self.protected.popitem(last=False)
+                demoted_weight = self.weigh(demoted_alias, demoted_entry)
+                self.protected_weight -= demoted_weight
+                self.probation[demoted_alias] = demoted_entry
+                self.probation_weight += demoted_weight
+            return entry
+
+    def items(self):
+        # hottest first: protected before probation, most recent first
+        with self.lock:
+            return list(reversed(self.protected.items())) + list(
+                reversed(self.probation.items())
+            )
+
+    def delete(self, alias):
+        with self.lock:
+            if alias in self.protected:
+                self.protected_weight -= self.weigh(alias, self.protected.pop(alias))
+                return True
+            if alias in self.probation:
+                self.probation_weight -= self.weigh(alias, self.probation.pop(alias))
+                return True
+            return False
+
+    def add(self, alias, entry):
+        # returns the change in number of entries
+        weight = self.weigh(alias, entry)
+        if weight > self.capacity:
+            return 0
+        change = 1
+        with self.lock:
+            if alias in self.protected:
+                self.protected_weight -= self.weigh(alias, self.protected.pop(alias))
+                change = 0
+            elif alias in self.probation:
+                self.probation_weight -= self.weigh(alias, self.probation.pop(alias))
+                change = 0
+            self.probation[alias] = entry
+            self.probation_weight += weight
+            while self.probation_weight + self.protected_weight > self.capacity:
+                segment = self.probation if self.probation else self.protected
+                evicted_alias, evicted_entry = segment.popitem(last=False)
+                evicted_weight = self.weigh(evicted_alias, evicted_entry)
+                if segment is self.probation:
+                    self.probation_weight -= evicted_weight
+                else:
+                    self.protected_weight -= evicted_weight
+                change -= 1
+                logging.debug(f"alias: {evicted_alias} has been removed from cache")
+        return change
+
+
+# shards hold (url, expiration timestamp or None) entries
+def _weigh_entry(alias, entry):
+    return 1
+
+
+def _weigh_bytes(alias, entry):
+    return len(alias) + len(entry[0])
+
+
 class Cache:
-    def __init__(self, cacheSize):
-        self.dict = OrderedDict()
-        self.size = cacheSize
+    def __init__(self, cacheSize, shards=1, max_bytes=None):
+        if max_bytes is not None:
+            capacity, weigh = max_bytes, _weigh_bytes
+        else:
+            capacity, weigh = cacheSize, _weigh_entry
+            shards = max(1, min(shards, cacheSize // MIN_ENTRIES_PER_SHARD))
+        self.shards = [CacheShard(capacity // shards, weigh) for _ in range(shards)]
+        self.size = capacity
+        self.count = 0
+        self.count_lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _shard(self, alias):
+        return self.shards[hash(alias) % len(self.shards)]
+
+    def _update_count(self, change):
+        if change == 0:
+            return
+        with self.count_lock:
+            self.count += change
+            MetricsHandler.cache_size.set(self.count)
 
     def find(self, alias):
-        if alias not in self.dict:
+        shard = self._shard(alias)
+        entry = shard.find(alias)
+        if entry is not None:
+            url_output, expires_at = entry
+            # the sweeper evicts expired urls too, this covers the time
+            # until it gets to them
+            if expires_at is not None and expires_at <= time.time():
+                if shard.delete(alias):
+                    self._update_count(-1)
+                entry = None
+        if entry is None:
             MetricsHandler.cache_misses.inc()
             return None
-        
-        self.dict.move_to_end(alias, last=False) #move alias to front of cache
         logging.debug(f"alias: '{alias}' is grabbed from mapping")
         MetricsHandler.cache_hits.inc()
-        return self.dict[alias]
+        return url_output
+
+    def items(self):
+        # approximately hottest first, taking one entry from each shard in turn
+        per_shard = [shard.items() for shard in self.shards]
+        return [
+            (item[0], item[1][0])
+            for items in itertools.zip_longest(*per_shard)
+            for item in items
+            if item is not None
+        ]
 
     def delete(self, alias):
-        if alias not in self.dict:
+        if not self._shard(alias).delete(alias):
             logging.debug(f"alias {alias} was not found in cache")
             return None
-        self.dict.pop(alias)
+        self._update_count(-1)
         logging.debug(f"deleted {alias} from cache")
 
-    def add(self, alias, url_output):
-        if len(self.dict) == self.size: 
-            data = self.dict.popitem() #remove least used alias if size reaches max
-            logging.debug(f"alias: {data[0]} has been removed from cache")
-        self.dict[alias] = url_output
-        MetricsHandler.cache_size.set(len(self.dict))
+    def add(self, alias, url_output, expires_at=None):
+        # expires_at is seconds since the epoch, after which find() misses
+        self._update_count(self._shard(alias).add(alias, (url_output, expires_at)))
         logging.debug("set alias: '" + alias + "' to mapping")
@@ -0,0 +1,115 @@
+import json
+import logging
+import threading
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+# aliases are resolved against sqlite and added to the cache this many at a time
+WARMUP_CHUNK_SIZE = 500
+
+
+class CacheWarmer:
+    """
+    refills the redirect cache after a restart. the aliases come from the
+    snapshot written by write_snapshot() on the last shutdown, or if there
+    is none, the warmup_size most used aliases in sqlite. urls are always
+    read from sqlite, so a stale snapshot can't bring back old redirects
+    """
+
+    def __init__(self, cache, storage, snapshot_file=None, warmup_size=0):
+        self.cache = cache
+        self.storage = storage
+        self.snapshot_file = snapshot_file
+        self.warmup_size = warmup_size
+        self.thread = None
+        self.stopped = threading.Event()
+        # aliases deleted while warmup runs, so they aren't added back
+        self.discarded = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="cache-warmer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # ends warmup after the chunk it is on
+        with self.lock:
+            thread = self.thread
+        if thread is None:
+            return
+        self.stopped.set()
+        thread.join()
+
+    def discard(self, alias):
+        # must be called before the alias is deleted from the cache
+        with self.lock:
+            if self.thread is not None:
+                self.discarded.add(alias)
+
+    def read_snapshot(self):
+        if self.snapshot_file is None:
+            return None
+        try:
+            with open(self.snapshot_file, "r") as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            logger.info(f"no cache snapshot at {self.snapshot_file}")
+        except Exception:
+            logger.exception(
+                f"An unexpected error occurred while reading cache snapshot file: {self.snapshot_file}"
+            )
+        return None
+
+    def write_snapshot(self):
+        if self.snapshot_file is None:
+            return
+        try:
+            with open(self.snapshot_file, "w") as json_file:
+                json.dump([alias for alias, _ in self.cache.items()], json_file)
+        except Exception:
+            logger.exception(
+                f"An unexpected error occurred while saving cache snapshot file: {self.snapshot_file}"
+            )
+
+    def run(self):
+        start = time.monotonic()
+        aliases = self.read_snapshot()
+        source = "snapshot"
+        if not aliases:
+            if self.warmup_size <= 0:
+                return self._finish(start, 0)
+            aliases = self.storage.get_most_used_aliases(self.warmup_size)
+            source = "most used"
+        MetricsHandler.cache_warmup_total.set(len(aliases))
+
+        loaded = 0
+        # add the coldest aliases first so the hottest end up most recent
+        aliases = list(reversed(aliases))
+        for chunk_start in range(0, len(aliases), WARMUP_CHUNK_SIZE):
+            if self.stopped.is_set():
+                break
+            chunk = aliases[chunk_start:chunk_start + WARMUP_CHUNK_SIZE]
+            urls = self.storage.get_urls_for_aliases(chunk)
+            for alias in chunk:
+                entry = urls.get(alias)
+                if entry is None:
+                    continue
+                with self.lock:
+                    if alias in self.discarded:
+                        continue
+                    # (url, expiration timestamp)
+                    self.cache.add(alias, *entry)
+                loaded += 1
+            MetricsHandler.cache_warmup_loaded.set(loaded)
+        logger.info(f"warmed cache with {loaded} aliases from {source}")
+        self._finish(start, loaded)
+
+    def _finish(self, start, loaded):
+        MetricsHandler.cache_warmup_loaded.set(loaded)
+        MetricsHandler.cache_warmup_seconds.set(time.monotonic() - start)
+        with self.lock:
+            self.thread = None
+            self.discarded.clear()
@@ -0,0 +1,98 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor:
+    """
+    runs blocking functions on a thread pool so they do not stall the
+    event loop. at most max_workers + max_queue_size calls are handed to
+    the pool at once, any callers past that wait on the event loop until
+    a slot frees up
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue_size: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"{name}-pool"
+        )
+        # the semaphore is created on first use so it binds to the event
+        # loop uvicorn runs, not whichever loop exists at import time
+        self.semaphore = None
+
+    def _dequeue(self, queued: list) -> bool:
+        # a call leaves the queue either when a worker starts it or when
+        # its caller gives up first. list.pop() is atomic, so exactly one
+        # of the two decrements the gauge
+        try:
+            queued.pop()
+        except IndexError:
+            return False
+        MetricsHandler.executor_queue_depth.labels(self.name).dec()
+        return True
+
+    def _run_queued(self, queued, func, *args, **kwargs):
+        if not self._dequeue(queued):
+            return None
+        MetricsHandler.executor_active.labels(self.name).inc()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            MetricsHandler.executor_active.labels(self.name).dec()
+
+    async def run(self, func, *args, **kwargs):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers + self.max_queue_size)
+        queued = [True]
+        MetricsHandler.executor_queue_depth.labels(self.name).inc()
+        try:
+            async with self.semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self.executor,
+                    functools.partial(self._run_queued, queued, func, *args, **kwargs),
+                )
+        finally:
+            self._dequeue(queued)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        logger.debug(f"shut down {self.name} executor")
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls that share a key. the first caller starts
+    the call, and every caller with the same key awaits that one result
+    until it finishes. a caller that gives up does not cancel the call for
+    the others
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = {}
+
+    def _done(self, key, future):
+        self.in_flight.pop(key, None)
+        # retrieve the exception so it isn't logged as never retrieved when
+        # every caller gave up
+        if not future.cancelled():
+            future.exception()
+
+    async def run(self, key, func, *args, **kwargs):
+        # func returns an awaitable
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.in_flight[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+        else:
+            MetricsHandler.single_flight_coalesced.labels(self.name).inc()
+        return await asyncio.shield(future)
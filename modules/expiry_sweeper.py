@@ -0,0 +1,65 @@
+import logging
+import threading
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    """
+    deletes expired urls every interval seconds, batch_size rows per
+    transaction, and calls on_expired with the alias of each so the caches
+    forget it. lookups already skip expired rows and cache entries, the
+    sweep frees their space and their qr codes. an interval of 0 turns it
+    off
+    """
+
+    def __init__(self, storage, on_expired, interval, batch_size):
+        self.storage = storage
+        self.on_expired = on_expired
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.thread = threading.Thread(target=self.run, name="expiry-sweeper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def sweep(self):
+        # returns the number of urls deleted
+        deleted = 0
+        while not self.stopped.is_set():
+            with MetricsHandler.query_time.labels("delete_expired").time():
+                aliases = self.storage.delete_expired_urls(self.batch_size)
+            if not aliases:
+                break
+            for alias in aliases:
+                self.on_expired(alias)
+            deleted += len(aliases)
+            MetricsHandler.expired_urls_deleted.inc(len(aliases))
+        if deleted:
+            logger.info(f"deleted {deleted} expired urls")
+        return deleted
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Error deleting expired urls")
+            self.stopped.wait(self.interval)
@@ -0,0 +1,78 @@
+import time
+from urllib.parse import quote
+
+from modules.metrics import MetricsHandler
+
+FIND_PREFIX = "/find/"
+# the route template get_url is registered under, the http_code path label
+FIND_ROUTE = "/find/{alias}"
+# the characters starlette's RedirectResponse leaves unescaped in location
+LOCATION_SAFE_CHARS = ":/%#?=@[]!$&'()*+,;"
+REDIRECT_STATUS = 307
+# scope key set when the cache was checked and missed, so get_url skips it
+FAST_FIND_MISSED = "fast_find_missed"
+# every cache hit answers with these besides location
+REDIRECT_HEADERS = [(b"content-length", b"0")]
+# what CORSMiddleware with allow_origins=["*"] adds to a request with an
+# origin header. it echoes the origin instead when there are cookies too,
+# so those requests are left to app
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+REDIRECT_BODY = {"type": "http.response.body", "body": b""}
+
+
+def _cors_headers(scope):
+    # the cors headers of a redirect, or None if app has to answer
+    has_origin = has_cookie = False
+    for name, _ in scope["headers"]:
+        if name == b"origin":
+            has_origin = True
+        elif name == b"cookie":
+            has_cookie = True
+    if not has_origin:
+        return []
+    return None if has_cookie else CORS_HEADERS
+
+
+class FastFindApp:
+    """
+    raw ASGI app in front of the FastAPI app. it answers GET /find/{alias}
+    when the alias is cached, skipping routing, middleware and response
+    objects, and passes everything else, /find misses included, to app
+    """
+
+    def __init__(self, app, cache, on_hit):
+        self.app = app
+        self.cache = cache
+        # awaited with the alias of every redirect, like get_url does
+        self.on_hit = on_hit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET":
+            path = scope["path"]
+            cors = _cors_headers(scope) if path.startswith(FIND_PREFIX) else None
+            if cors is not None:
+                alias = path[len(FIND_PREFIX):]
+                url = None
+                start = time.perf_counter()
+                if alias and "/" not in alias:
+                    url = self.cache.find(alias)
+                    MetricsHandler.find_stage_seconds.labels("cache").observe(
+                        time.perf_counter() - start
+                    )
+                if url is not None:
+                    await self.on_hit(alias)
+                    MetricsHandler.http_code.labels(FIND_ROUTE, REDIRECT_STATUS).inc()
+                    location = quote(url, safe=LOCATION_SAFE_CHARS).encode("latin-1")
+                    await send({
+                        "type": "http.response.start",
+                        "status": REDIRECT_STATUS,
+                        "headers": [(b"location", location)] + REDIRECT_HEADERS + cors,
+                    })
+                    await send(REDIRECT_BODY)
+                    # what HttpMetricsMiddleware records for the requests it sees
+                    MetricsHandler.http_request_seconds.labels(FIND_ROUTE).observe(
+                        time.perf_counter() - start
+                    )
+                    return
+                scope[FAST_FIND_MISSED] = True
+        await self.app(scope, receive, send)
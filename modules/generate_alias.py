@@ -1,17 +1,99 @@
 import hashlib
+import logging
 import string
-import datetime
+import threading
 
 
+logger = logging.getLogger(__name__)
+
 ALPHANUMERIC_CHARS = string.ascii_letters + string.digits
+FEISTEL_ROUNDS = 4
+
+
+def encode_base62(number, length):
+    # fixed width, so every generated alias has the same length
+    chars = []
+    for _ in range(length):
+        number, remainder = divmod(number, len(ALPHANUMERIC_CHARS))
+        chars.append(ALPHANUMERIC_CHARS[remainder])
+    return "".join(reversed(chars))
+
+
+class FeistelPermutation:
+    """
+    keyed bijection of [0, domain_size). a balanced feistel network permutes
+    the smallest even-width power of two covering the domain, and values
+    that land outside of it are fed through again (cycle walking) until
+    they land inside. distinct inputs therefore always give distinct outputs
+    """
+
+    def __init__(self, domain_size, key: bytes):
+        self.domain_size = domain_size
+        bits = max(2, (domain_size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.key = key
+
+    def _round(self, round_number, value):
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "little"),
+            digest_size=8,
+            key=self.key,
+            salt=round_number.to_bytes(16, "little"),
+        ).digest()
+        return int.from_bytes(digest, "little") & self.half_mask
+
+    def _permute(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(round_number, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value):
+        value = self._permute(value)
+        while value >= self.domain_size:
+            value = self._permute(value)
+        return value
+
+
+class AliasAllocator:
+    """
+    hands out fixed length base62 aliases from a counter stored in storage.
+    ids are claimed block_size at a time, so sqlite is written once per
+    block instead of once per alias, and every process gets its own ids.
+    ids left in a block at shutdown are never used. with obfuscate, ids go
+    through a feistel permutation keyed by alias_counter.key, so
+    consecutive aliases don't look consecutive and can't be enumerated
+    """
 
-def generate_alias(url):
-  '''
-  Generates a random 5 character string with alphanumeric characters, for example "e030f"
-  '''
-  timestamp = datetime.datetime.now()
-  unique_object = f"{url}/{timestamp}"
+    def __init__(self, storage, length, block_size, obfuscate=True):
+        self.storage = storage
+        self.length = length
+        self.block_size = block_size
+        self.domain_size = len(ALPHANUMERIC_CHARS) ** length
+        self.permutation = None
+        if obfuscate:
+            self.permutation = FeistelPermutation(
+                self.domain_size, storage.get_alias_counter()[1]
+            )
+        self.next_id = 0
+        self.block_end = 0
+        self.lock = threading.Lock()
 
-  hash_object = hashlib.md5(unique_object.encode())
-  hash_string = hash_object.hexdigest()
-  return hash_string[:5]
+    def allocate(self) -> str:
+        # may write to sqlite, so call it off the event loop
+        with self.lock:
+            if self.next_id == self.block_end:
+                self.next_id = self.storage.reserve_alias_block(self.block_size)
+                self.block_end = self.next_id + self.block_size
+                logger.debug(f"reserved alias ids {self.next_id} to {self.block_end - 1}")
+            alias_id = self.next_id
+            self.next_id += 1
+        if alias_id >= self.domain_size:
+            raise RuntimeError(
+                f"all {self.domain_size} aliases of length {self.length} are used, "
+                "increase --alias-length"
+            )
+        if self.permutation is not None:
+            alias_id = self.permutation(alias_id)
+        return encode_base62(alias_id, self.length)
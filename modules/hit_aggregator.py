@@ -0,0 +1,161 @@
+from collections import Counter
+import logging
+from threading import Event, Thread
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+CLICK_PRUNE_INTERVAL = 60 * 60
+
+
+class HitAggregator:
+    """
+    reads hits added by add() from hit_log, merges them into per alias counts and
+    writes the counts to the used column in one transaction. a flush
+    happens once max_batch_size hits are pending or the oldest pending hit
+    is flush_interval seconds old, whichever comes first. when
+    used_threshold is set, on_used_threshold is called with each alias
+    whose used count reaches it.
+
+    hits are also counted per alias per minute, by when they were queued,
+    and those counts are added to url_clicks in the same transaction. with
+    click_retention set, minutes older than that many seconds are deleted
+    about once every CLICK_PRUNE_INTERVAL seconds.
+
+    the hit log is committed once everything read from it is written, so
+    hits that were read but not written are read again after a crash
+    """
+
+    def __init__(
+        self,
+        hit_log,
+        storage,
+        max_batch_size,
+        flush_interval,
+        used_threshold=None,
+        on_used_threshold=None,
+        click_retention=None,
+    ):
+        self.hit_log = hit_log
+        self.storage = storage
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.used_threshold = used_threshold
+        self.on_used_threshold = on_used_threshold
+        self.click_retention = click_retention
+        self.pending = Counter()
+        # (alias, minute since the epoch) -> hits
+        self.pending_clicks = Counter()
+        self.last_prune = None
+        self.pending_hits = 0
+        self.oldest_pending = None
+        self.thread = None
+        self.stopping = Event()
+
+    def start(self):
+        self.hit_log.open()
+        self.stopping.clear()
+        self.thread = Thread(target=self.run, name="hit-aggregator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        # run() reads what is left in the log, flushes it and exits
+        self.stopping.set()
+        self.hit_log.wake()
+        self.thread.join()
+        self.thread = None
+        self.hit_log.close()
+
+    async def add(self, alias):
+        await self.hit_log.append_async(alias)
+
+    def _record(self, alias, queued_at):
+        self.pending[alias] += 1
+        self.pending_clicks[alias, int(queued_at // 60)] += 1
+        self.pending_hits += 1
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+
+    def flush(self):
+        if not self.pending:
+            return
+        MetricsHandler.hit_flush_batch_size.observe(len(self.pending))
+        with MetricsHandler.hit_flush_latency.time():
+            crossed, unwritten = self.storage.increment_used_columns(
+                self.pending, threshold=self.used_threshold, clicks=self.pending_clicks
+            )
+        for alias in crossed:
+            self.on_used_threshold(alias)
+        if unwritten:
+            # keep the counts that weren't written and try again on the next interval
+            self.pending = Counter(unwritten)
+            self.pending_clicks = Counter({
+                key: count for key, count in self.pending_clicks.items() if key[0] in unwritten
+            })
+            self.pending_hits = sum(unwritten.values())
+            self.oldest_pending = time.monotonic()
+            return
+        logger.debug(
+            f"flushed {self.pending_hits} hits across {len(self.pending)} aliases"
+        )
+        self.pending = Counter()
+        self.pending_clicks = Counter()
+        self.pending_hits = 0
+        self.oldest_pending = None
+        self.hit_log.commit()
+
+    def prune_clicks(self):
+        if self.click_retention is None:
+            return
+        now = time.monotonic()
+        if self.last_prune is not None and now - self.last_prune < CLICK_PRUNE_INTERVAL:
+            return
+        self.last_prune = now
+        deleted = self.storage.delete_clicks_before(
+            int((time.time() - self.click_retention) // 60)
+        )
+        if deleted:
+            logger.info(f"deleted {deleted} click buckets past retention")
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            timeout = None
+            if self.oldest_pending is not None:
+                timeout = max(
+                    0, self.oldest_pending + self.flush_interval - time.monotonic()
+                )
+            # once stop() is called the log is read without waiting until
+            # it is empty
+            stopping = self.stopping.is_set()
+            hits = self.hit_log.read(
+                max(1, self.max_batch_size - self.pending_hits), 0 if stopping else timeout
+            )
+            # how long the first hit of this pass, the oldest, was queued
+            lag = time.time() - hits[0][1] if hits else 0
+            for alias, queued_at in hits:
+                self._record(alias, queued_at)
+            stopping = stopping and not hits
+            MetricsHandler.hit_consumer_lag_seconds.set(max(0, lag))
+            MetricsHandler.alias_queue_depth.set(len(self.hit_log))
+
+            if (
+                stopping
+                or self.pending_hits >= self.max_batch_size
+                or (
+                    self.oldest_pending is not None
+                    and time.monotonic() - self.oldest_pending >= self.flush_interval
+                )
+            ):
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Error flushing used counts")
+                try:
+                    self.prune_clicks()
+                except Exception:
+                    logger.exception("Error deleting old click buckets")
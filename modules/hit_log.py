@@ -0,0 +1,310 @@
+import asyncio
+import fcntl
+import glob
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_BLOCK = "block"
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_BLOCK)
+
+MAGIC = b"HITLOG01"
+# magic, capacity, head and tail. head and tail only ever grow, the byte
+# they point at is their value modulo capacity
+HEADER = struct.Struct("<8sQQQ")
+DATA_OFFSET = 64
+# alias length in bytes, then when the hit was queued in seconds since the
+# epoch, then the alias. a length of 0 means the rest of the lap is unused
+RECORD = struct.Struct("<Hd")
+MAX_ALIAS_BYTES = 0xFFFF
+# how often a blocked append_async checks for space again
+BLOCK_POLL_INTERVAL = 0.005
+
+
+def _lock_file(path):
+    # the open file at path, locked, or None if another process holds it
+    while True:
+        log_file = open(path, "a+b")
+        try:
+            fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log_file.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(log_file.fileno()).st_ino:
+                return log_file
+        except FileNotFoundError:
+            pass
+        # the previous holder adopted and removed it while we waited
+        log_file.close()
+
+
+def _read_header(log_file, path):
+    # (capacity, head, tail) of the log in log_file, or None if it isn't one
+    size = os.fstat(log_file.fileno()).st_size
+    if size < HEADER.size:
+        return None
+    log_file.seek(0)
+    magic, capacity, head, tail = HEADER.unpack(log_file.read(HEADER.size))
+    if magic == MAGIC and size >= DATA_OFFSET + capacity and tail - head <= capacity:
+        return capacity, head, tail
+    logger.warning(f"{path} is not a hit log, starting a new one")
+    return None
+
+
+def _read_hits(log_file, header):
+    # every whole (alias, queued at) record between head and tail
+    capacity, head, tail = header
+    with mmap.mmap(log_file.fileno(), DATA_OFFSET + capacity) as log_map:
+        return [
+            (alias, queued_at)
+            for alias, queued_at, _ in iter_records(log_map, capacity, head, tail)
+        ]
+
+
+def iter_records(buffer, capacity, position, tail):
+    # yields (alias, queued at, position after it) of the whole records
+    # between position and tail of a ring mapped in buffer, stopping at the
+    # first that isn't, like one a crash left half written
+    while position < tail:
+        offset = position % capacity
+        if capacity - offset < RECORD.size:
+            position += capacity - offset
+            continue
+        length, queued_at = RECORD.unpack_from(buffer, DATA_OFFSET + offset)
+        if length == 0:
+            position += capacity - offset
+            continue
+        end = position + RECORD.size + length
+        if end > tail or offset + RECORD.size + length > capacity or not math.isfinite(queued_at):
+            return
+        start = DATA_OFFSET + offset + RECORD.size
+        try:
+            alias = buffer[start:start + length].decode()
+        except UnicodeDecodeError:
+            return
+        position = end
+        yield alias, queued_at, position
+
+
+class HitLog:
+    """
+    /find hits waiting for the hit aggregator, as records in a ring of
+    capacity bytes in a memory mapped file, so the hits take at most that
+    much memory and outlive the process. append() writes behind tail, read()
+    hands out records after head without moving it, and commit() moves head
+    past what was read once it has been written to the database. whatever
+    is between head and tail when the file is opened again, after a crash
+    or a restart, is read again. a hit can be counted twice if the process
+    dies between writing its batch and the commit.
+
+    when a hit doesn't fit, the drop policy discards it and the block
+    policy has append_async wait up to block_timeout seconds for space
+    first.
+
+    every server process has a log of its own, base_path.0, base_path.1 and
+    so on, whichever is the first no other process has locked, so a process
+    that restarts usually gets its old log back. logs of processes that are
+    gone, like those of extra workers after a restart with fewer, are
+    copied into the log that was opened and removed
+    """
+
+    def __init__(self, base_path, capacity, overflow_policy=OVERFLOW_DROP, block_timeout=0.1):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow_policy}")
+        self.base_path = base_path
+        self.path = None
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.file = None
+        self.map = None
+        self.head = 0
+        self.tail = 0
+        # head of the records read() has handed out but not committed
+        self.read_position = 0
+        # number of records between read_position and tail
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.readable = threading.Condition(self.lock)
+        self.woken = False
+
+    def open(self):
+        index = 0
+        while self.file is None:
+            self.path = f"{self.base_path}.{index}"
+            self.file = _lock_file(self.path)
+            index += 1
+        recovered = self._recover()
+        recovered += self._adopt()
+        MetricsHandler.hit_log_capacity_bytes.set(self.capacity)
+        MetricsHandler.hit_log_overflow_policy.labels(self.overflow_policy).set(1)
+        self._report()
+        if recovered:
+            MetricsHandler.hit_log_recovered.inc(len(recovered))
+            logger.warning(f"recovered {len(recovered)} hits from {self.path}")
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        self.file.close()
+        self.file = None
+
+    def _map(self):
+        self.file.truncate(DATA_OFFSET + self.capacity)
+        self.map = mmap.mmap(self.file.fileno(), DATA_OFFSET + self.capacity)
+
+    def _reset(self):
+        self.head = self.tail = self.read_position = 0
+        self.queued = 0
+        HEADER.pack_into(self.map, 0, MAGIC, self.capacity, 0, 0)
+
+    def _recover(self):
+        # maps the file, and returns the hits it had queued. a log written
+        # with another capacity is copied into a new one of this capacity
+        old = _read_header(self.file, self.path)
+        if old is not None and old[0] == self.capacity:
+            self._map()
+            self.head = self.read_position = self.tail = old[1]
+            hits = []
+            for alias, queued_at, self.tail in iter_records(self.map, self.capacity, *old[1:]):
+                hits.append((alias, queued_at))
+            self.queued = len(hits)
+            # drops a partly written record, and anything after it
+            HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.head, self.tail)
+            return hits
+
+        hits = []
+        if old is not None:
+            hits = _read_hits(self.file, old)
+            logger.warning(f"resizing {self.path} from {old[0]} to {self.capacity} bytes")
+        self._map()
+        self._reset()
+        return self._append_recovered(hits)
+
+    def _adopt(self):
+        # copies in the hits of logs no running process has open, and
+        # removes them. returns the hits
+        adopted = []
+        for path in sorted(glob.glob(f"{glob.escape(self.base_path)}.*")):
+            if path == self.path or not path[len(self.base_path) + 1:].isdigit():
+                continue
+            log_file = _lock_file(path)
+            if log_file is None:
+                continue
+            try:
+                header = _read_header(log_file, path)
+                hits = [] if header is None else _read_hits(log_file, header)
+                with self.lock:
+                    adopted += self._append_recovered(hits)
+                if hits:
+                    logger.warning(f"moved {len(hits)} hits from {path} to {self.path}")
+                # removed while locked, so no process opens it in between
+                os.remove(path)
+            finally:
+                log_file.close()
+        return adopted
+
+    def _append_recovered(self, hits):
+        kept = [hit for hit in hits if self._append(*hit)]
+        if len(kept) < len(hits):
+            logger.warning(f"dropped {len(hits) - len(kept)} recovered hits that didn't fit")
+        return kept
+
+    def _append(self, alias, queued_at):
+        # writes one record if it fits, the caller holds the lock
+        data = alias.encode()
+        needed = RECORD.size + len(data)
+        if not data or len(data) > MAX_ALIAS_BYTES or needed > self.capacity:
+            return False
+        offset = self.tail % self.capacity
+        padding = 0
+        if self.capacity - offset < needed:
+            padding = self.capacity - offset
+        if self.tail + padding + needed - self.head > self.capacity:
+            return False
+        if padding >= RECORD.size:
+            RECORD.pack_into(self.map, DATA_OFFSET + offset, 0, 0.0)
+        offset = (self.tail + padding) % self.capacity
+        RECORD.pack_into(self.map, DATA_OFFSET + offset, len(data), queued_at)
+        start = DATA_OFFSET + offset + RECORD.size
+        self.map[start:start + len(data)] = data
+        # the record is whole before tail says so
+        self.tail += padding + needed
+        struct.pack_into("<Q", self.map, 24, self.tail)
+        self.queued += 1
+        return True
+
+    def append(self, alias, queued_at=None):
+        # never waits, returns whether the hit was logged
+        with self.lock:
+            appended = self._append(alias, time.time() if queued_at is None else queued_at)
+            if appended:
+                self.readable.notify()
+        if not appended and self.overflow_policy == OVERFLOW_DROP:
+            MetricsHandler.hit_log_overflows.labels(self.overflow_policy, "dropped").inc()
+        return appended
+
+    async def append_async(self, alias):
+        # append(), except that with the block policy a full log is retried
+        # until block_timeout, without holding up the event loop
+        queued_at = time.time()
+        if self.append(alias, queued_at) or self.overflow_policy != OVERFLOW_BLOCK:
+            return
+        deadline = time.monotonic() + self.block_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(BLOCK_POLL_INTERVAL)
+            if self.append(alias, queued_at):
+                MetricsHandler.hit_log_overflows.labels(self.overflow_policy, "waited").inc()
+                return
+        MetricsHandler.hit_log_overflows.labels(self.overflow_policy, "dropped").inc()
+
+    def read(self, max_records, timeout=None):
+        # up to max_records (alias, queued at) after the last read, waiting
+        # up to timeout seconds, forever for None, for the first one.
+        # returns fewer, possibly none, after a timeout or wake()
+        with self.lock:
+            if not self.queued and not self.woken:
+                self.readable.wait(timeout)
+            self.woken = False
+            hits = []
+            records = iter_records(self.map, self.capacity, self.read_position, self.tail)
+            for alias, queued_at, self.read_position in records:
+                hits.append((alias, queued_at))
+                if len(hits) == max_records:
+                    break
+            self.queued -= len(hits)
+        return hits
+
+    def wake(self):
+        # returns a read() that is waiting, or the next one, right away
+        with self.lock:
+            self.woken = True
+            self.readable.notify()
+
+    def commit(self):
+        # frees the space of every record read so far, and writes the
+        # mapped pages out so the log survives more than a process crash
+        with self.lock:
+            self.head = self.read_position
+            struct.pack_into("<Q", self.map, 16, self.head)
+        self.map.flush()
+        self._report()
+
+    def _report(self):
+        MetricsHandler.hit_log_used_bytes.set(self.tail - self.head)
+
+    def __len__(self):
+        return self.queued
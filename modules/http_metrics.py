@@ -0,0 +1,57 @@
+import time
+
+from modules.metrics import MetricsHandler
+
+# path label of requests that matched no route, so unknown urls don't each
+# become their own series
+UNMATCHED_PATH = "unmatched"
+
+
+class HttpMetricsMiddleware:
+    """
+    counts responses by status code and times requests, labeled with the
+    template of the route they matched, e.g. /find/{alias}, rather than the
+    path that was requested. plain ASGI, so unlike @app.middleware("http")
+    it doesn't wrap every request in an extra task and response object
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # endpoint function -> route template, filled in on first use
+        self.paths = {}
+
+    def _path(self, scope):
+        # the router leaves the endpoint it picked in the scope
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_PATH
+        path = self.paths.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                if hasattr(route, "endpoint"):
+                    self.paths[route.endpoint] = route.path
+            path = self.paths.get(endpoint, UNMATCHED_PATH)
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # stays 500 if the app raises before it starts a response
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            path = self._path(scope)
+            MetricsHandler.http_request_seconds.labels(path).observe(
+                time.perf_counter() - start
+            )
+            MetricsHandler.http_code.labels(path, status_code).inc()
@@ -1,26 +1,57 @@
 import enum
+import os
 
 import prometheus_client
+from prometheus_client import multiprocess
+
+# histograms given this instead of buckets use the ones passed to init()
+LATENCY_BUCKETS = "latency"
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+# set by prometheus_client's convention when several worker processes
+# share one metrics directory
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
 
 
 class Metrics(enum.Enum):
     URL_COUNT = (
         "url_count",
         "Number of urls in the database",
-        prometheus_client.Counter,
+        prometheus_client.Gauge,
+        (),
+        None,
+        # every process sets the whole count, the latest one is right
+        "mostrecent",
     )
     QUERY_TIME = (
         "query_time",
         "Time taken to execute SQLite queries",
-        prometheus_client.Summary,
+        prometheus_client.Histogram,
         ["query_type"],
+        LATENCY_BUCKETS,
     )
     HTTP_CODE = (
         "http_code",
-        "Count of each HTTP Response code",
+        "Count of each HTTP Response code, by route template",
         prometheus_client.Counter,
         ["path", "code"],
     )
+    HTTP_REQUEST_SECONDS = (
+        "http_request_seconds",
+        "Time taken to answer a request, by route template",
+        prometheus_client.Histogram,
+        ["path"],
+        LATENCY_BUCKETS,
+    )
+    FIND_STAGE_SECONDS = (
+        "find_stage_seconds",
+        "Time taken by each stage of /find: cache lookup, db lookup and hit enqueue",
+        prometheus_client.Histogram,
+        ["stage"],
+        LATENCY_BUCKETS,
+    )
     CACHE_SIZE = (
         "cache_size",
         "Size of LRU cache for /find",
@@ -40,14 +71,189 @@ class Metrics(enum.Enum):
         "qr_code_cache_size",
         "Number of stored QR Codes",
         prometheus_client.Gauge,
+        (),
+        None,
+        "livemax",
     )
     QR_CODE_CACHE_SIZE_IN_BYTES = (
         "qr_code_cache_size_in_bytes",
         "Total file size in bytes for all stored QR Codes",
         prometheus_client.Gauge,
+        (),
+        None,
+        "livemax",
+    )
+    QR_CODE_MEMORY_CACHE_SIZE_IN_BYTES = (
+        "qr_code_memory_cache_size_in_bytes",
+        "Total size in bytes of the QR Codes kept in memory",
+        prometheus_client.Gauge,
+    )
+    QR_CODE_CACHE_HITS = (
+        "qr_code_cache_hits",
+        "Number of QR Codes served without rendering, by cache tier",
+        prometheus_client.Counter,
+        ["tier"],
+    )
+    QR_RENDER_SECONDS = (
+        "qr_render_seconds",
+        "Time taken to render one QR Code in a render process",
+        prometheus_client.Histogram,
+    )
+    QR_RENDER_QUEUE_DEPTH = (
+        "qr_render_queue_depth",
+        "Number of QR Code renders waiting for or running in a render process",
+        prometheus_client.Gauge,
+    )
+    QR_RENDERS = (
+        "qr_renders",
+        "Number of QR Codes rendered, by whether a request or the pre-renderer asked",
+        prometheus_client.Counter,
+        ["source"],
+    )
+    QR_PRERENDER_HITS = (
+        "qr_prerender_hits",
+        "Number of pre-rendered QR Codes that were later served",
+        prometheus_client.Counter,
+    )
+    QR_PRERENDER_REQUESTS = (
+        "qr_prerender_requests",
+        "Number of aliases handed to the pre-renderer, by trigger",
+        prometheus_client.Counter,
+        ["trigger"],
+    )
+    QR_PRERENDER_DROPPED = (
+        "qr_prerender_dropped",
+        "Number of aliases not pre-rendered because the queue was full",
+        prometheus_client.Counter,
+    )
+    QR_PRERENDER_QUEUE_DEPTH = (
+        "qr_prerender_queue_depth",
+        "Number of aliases waiting to be pre-rendered",
+        prometheus_client.Gauge,
+    )
+    SINGLE_FLIGHT_COALESCED = (
+        "single_flight_coalesced",
+        "Number of calls that waited on an identical call already in flight",
+        prometheus_client.Counter,
+        ["name"],
+    )
+    EXECUTOR_QUEUE_DEPTH = (
+        "executor_queue_depth",
+        "Number of calls waiting for a free thread in each executor pool",
+        prometheus_client.Gauge,
+        ["pool"],
+    )
+    EXECUTOR_ACTIVE = (
+        "executor_active",
+        "Number of calls currently running in each executor pool",
+        prometheus_client.Gauge,
+        ["pool"],
+    )
+    ALIAS_QUEUE_DEPTH = (
+        "alias_queue_depth",
+        "Number of /find hits in the hit log waiting to be counted in the used column",
+        prometheus_client.Gauge,
+    )
+    HIT_LOG_USED_BYTES = (
+        "hit_log_used_bytes",
+        "Bytes of the hit log taken by hits not yet written to the database",
+        prometheus_client.Gauge,
+    )
+    HIT_LOG_CAPACITY_BYTES = (
+        "hit_log_capacity_bytes",
+        "Size of the hit log, the most memory queued hits can take",
+        prometheus_client.Gauge,
+    )
+    HIT_LOG_OVERFLOW_POLICY = (
+        "hit_log_overflow_policy",
+        "1 for the policy applied to hits that don't fit in the hit log",
+        prometheus_client.Gauge,
+        ["policy"],
+        None,
+        "livemax",
+    )
+    HIT_LOG_OVERFLOWS = (
+        "hit_log_overflows",
+        "Number of hits that found the hit log full, by whether they were dropped or waited for space",
+        prometheus_client.Counter,
+        ["policy", "outcome"],
+    )
+    HIT_LOG_RECOVERED = (
+        "hit_log_recovered",
+        "Number of hits left in the hit log by a previous run and counted at startup",
+        prometheus_client.Counter,
+    )
+    HIT_CONSUMER_LAG_SECONDS = (
+        "hit_consumer_lag_seconds",
+        "Time the oldest hit drained by the hit aggregator's last pass waited in the hit log",
+        prometheus_client.Gauge,
+        (),
+        None,
+        "livemax",
+    )
+    HIT_FLUSH_BATCH_SIZE = (
+        "hit_flush_batch_size",
+        "Number of aliases whose used column is updated per flush",
+        prometheus_client.Histogram,
+        (),
+        (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+    )
+    HIT_FLUSH_LATENCY = (
+        "hit_flush_latency",
+        "Time taken to write one batch of used counts",
+        prometheus_client.Histogram,
+        (),
+        LATENCY_BUCKETS,
+    )
+    EXPIRED_URLS_DELETED = (
+        "expired_urls_deleted",
+        "Number of expired urls deleted by the expiry sweeper",
+        prometheus_client.Counter,
+    )
+    NEGATIVE_CACHE_HITS = (
+        "negative_cache_hits",
+        "Number of lookups for unknown aliases answered without sqlite",
+        prometheus_client.Counter,
+        ["layer"],
+    )
+    NEGATIVE_CACHE_SIZE = (
+        "negative_cache_size",
+        "Number of recently missed aliases remembered by the negative cache",
+        prometheus_client.Gauge,
+    )
+    BLOOM_FILTER_FALSE_POSITIVES = (
+        "bloom_filter_false_positives",
+        "Number of aliases the bloom filter let through that sqlite did not have",
+        prometheus_client.Counter,
+    )
+    CACHE_WARMUP_TOTAL = (
+        "cache_warmup_total",
+        "Number of aliases the cache warmer is loading at startup",
+        prometheus_client.Gauge,
+    )
+    CACHE_WARMUP_LOADED = (
+        "cache_warmup_loaded",
+        "Number of aliases the cache warmer has added to the cache so far",
+        prometheus_client.Gauge,
+    )
+    CACHE_WARMUP_SECONDS = (
+        "cache_warmup_seconds",
+        "Time the cache warmer took to finish, 0 while it is running",
+        prometheus_client.Gauge,
+        (),
+        None,
+        "liveall",
     )
 
-    def __init__(self, title, description, prometheus_type, labels=()):
+    def __init__(
+        self,
+        title,
+        description,
+        prometheus_type,
+        labels=(),
+        buckets=None,
+        multiprocess_mode="livesum",
+    ):
         # we use the above default value for labels because it matches what's used
         # in the prometheus_client library's metrics constructor, see
         # https://github.com/prometheus/client_python/blob/fd4da6cde36a1c278070cf18b4b9f72956774b05/prometheus_client/metrics.py#L115
@@ -55,16 +261,43 @@ class Metrics(enum.Enum):
         self.description = description
         self.prometheus_type = prometheus_type
         self.labels = labels
+        self.buckets = buckets
+        # how gauges from several worker processes are combined, see
+        # https://prometheus.github.io/client_python/multiprocess/
+        self.multiprocess_mode = multiprocess_mode
 
 
 class MetricsHandler:
     @classmethod
-    def init(self) -> None:
+    def init(self, latency_buckets=DEFAULT_LATENCY_BUCKETS) -> None:
         for metric in Metrics:
+            kwargs = {}
+            if metric.buckets == LATENCY_BUCKETS:
+                kwargs["buckets"] = latency_buckets
+            elif metric.buckets is not None:
+                kwargs["buckets"] = metric.buckets
+            if metric.prometheus_type is prometheus_client.Gauge:
+                kwargs["multiprocess_mode"] = metric.multiprocess_mode
             setattr(
                 self,
                 metric.title,
                 metric.prometheus_type(
-                    metric.title, metric.description, labelnames=metric.labels
+                    metric.title, metric.description, labelnames=metric.labels, **kwargs
                 ),
             )
+
+    @classmethod
+    def generate_latest(self) -> bytes:
+        # in multiprocess mode each worker writes its metrics to files in
+        # the shared directory, and any worker can report all of them
+        if MULTIPROC_DIR_ENV not in os.environ:
+            return prometheus_client.generate_latest()
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry)
+
+    @classmethod
+    def close(self) -> None:
+        # drops this process's live gauges from the multiprocess totals
+        if MULTIPROC_DIR_ENV in os.environ:
+            multiprocess.mark_process_dead(os.getpid())
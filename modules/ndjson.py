@@ -0,0 +1,57 @@
+import json
+
+from fastapi.responses import StreamingResponse
+
+MEDIA_TYPE = "application/x-ndjson"
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    streams newline delimited JSON while the request body may still be
+    arriving. StreamingResponse reads from receive to watch for client
+    disconnects, which would swallow body chunks an iterator reading the
+    request still needs, so this response never reads from receive
+    """
+
+    media_type = MEDIA_TYPE
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+def parse_line(line: bytes):
+    # lines that aren't valid JSON come back as the JSONDecodeError
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return e
+
+
+async def iter_json_items(chunks):
+    # yields each item of a JSON array, or of newline delimited JSON as its
+    # lines arrive, from an async iterator of bytes such as request.stream()
+    buffer = b""
+    is_array = None
+    async for chunk in chunks:
+        buffer += chunk
+        if is_array is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                continue
+            is_array = stripped.startswith(b"[")
+        if is_array:
+            continue
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+    if is_array:
+        items = parse_line(buffer)
+        if not isinstance(items, list):
+            items = [items]
+        for item in items:
+            yield item
+    elif buffer.strip():
+        yield parse_line(buffer)
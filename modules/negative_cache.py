@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        # standard sizing, see https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        # two 64 bit hashes combined as h1 + i * h2 stand in for num_hashes
+        # independent hash functions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class NegativeCache:
+    """
+    answers "does this alias definitely not exist?" without going to sqlite.
+    recent misses are remembered for ttl seconds, and an optional bloom
+    filter of every alias in the database rejects aliases that were never
+    created
+    """
+
+    def __init__(self, max_size, ttl, bloom_filter=None):
+        self.misses = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bloom_filter = bloom_filter
+        self.lock = threading.Lock()
+        # bumped whenever an alias is created. a miss read from sqlite before
+        # a create finished must not hide the new alias
+        self.generation = 0
+
+    def load(self, aliases):
+        if self.bloom_filter is None:
+            return
+        count = 0
+        with self.lock:
+            for alias in aliases:
+                self.bloom_filter.add(alias)
+                count += 1
+        logger.info(f"loaded {count} aliases into bloom filter")
+
+    def is_missing(self, alias: str) -> bool:
+        with self.lock:
+            expires_at = self.misses.get(alias)
+            if expires_at is not None:
+                if expires_at > time.monotonic():
+                    MetricsHandler.negative_cache_hits.labels("recent_misses").inc()
+                    return True
+                self.misses.pop(alias)
+            if self.bloom_filter is not None and alias not in self.bloom_filter:
+                MetricsHandler.negative_cache_hits.labels("bloom_filter").inc()
+                return True
+        return False
+
+    def _remember(self, alias: str):
+        self.misses[alias] = time.monotonic() + self.ttl
+        self.misses.move_to_end(alias)
+        if len(self.misses) > self.max_size:
+            self.misses.popitem(last=False)
+        MetricsHandler.negative_cache_size.set(len(self.misses))
+
+    def add_miss(self, alias: str, generation: int):
+        # called after sqlite confirmed the alias doesn't exist. generation
+        # is the value of self.generation from before the query was made
+        with self.lock:
+            if generation != self.generation:
+                return
+            if self.bloom_filter is not None and alias in self.bloom_filter:
+                MetricsHandler.bloom_filter_false_positives.inc()
+            if self.max_size > 0:
+                self._remember(alias)
+
+    def add_alias(self, alias: str):
+        with self.lock:
+            self.generation += 1
+            self.misses.pop(alias, None)
+            if self.bloom_filter is not None:
+                self.bloom_filter.add(alias)
+            MetricsHandler.negative_cache_size.set(len(self.misses))
+
+    def remove_alias(self, alias: str):
+        # bloom filters can't forget keys, so a deleted alias is only
+        # remembered as a recent miss
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self._remember(alias)
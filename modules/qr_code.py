@@ -1,91 +1,382 @@
+import base64
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import io
 import logging
+import mimetypes
 import os
-import uuid
+import re
+import threading
+import time
 import json
+import multiprocessing
 
 from PIL import Image
 import pyqrcode
 
 from modules.metrics import MetricsHandler
+from modules.qr_index import QRCodeIndex, is_sqlite_file
 
 logger = logging.getLogger(__name__)
 
+# default pixels per QR Code module, and modules of white border, as
+# pyqrcode.png uses
+QR_CODE_SCALE = 10
+QR_CODE_MAX_SCALE = 40
+QR_CODE_QUIET_ZONE = 4
+# output formats and their media types
+QR_CODE_FORMATS = {"png": "image/png", "webp": "image/webp", "svg": "image/svg+xml"}
+# a variant's bytes only depend on its key, and the key doesn't change for
+# an alias, so clients and nginx may keep a variant forever
+QR_CODE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# bump when render_qr_code's output changes, so every variant gets a new key
+RENDER_VERSION = 2
+
+# variant files are named alias.key.format, so a file without an index row
+# can be adopted. files named uuid.png were written before variants had keys
+VARIANT_FILE_PATTERN = re.compile(r"^([A-Za-z0-9]+)\.([0-9a-f]{32})\.(png|webp|svg)$")
+LEGACY_FILE_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.png$")
+TEMP_SUFFIX = ".tmp"
+# temp files older than this were left by a crash, not a write in progress
+STALE_TEMP_FILE_SECONDS = 300
+# directory entries reconciled per index transaction
+RECONCILE_CHUNK_SIZE = 1000
+
+# data is the encoded image, etag the quoted variant key
+QRImage = namedtuple("QRImage", ["data", "etag"])
+
+
+@functools.lru_cache(maxsize=8)
+def load_logo(qr_image_path, width, height):
+    # the logo never changes, so each render process decodes and resizes it
+    # once per output size
+    with Image.open(qr_image_path) as sce_logo:
+        return sce_logo.resize((width, height))
+
+
+@functools.lru_cache(maxsize=1)
+def load_logo_data_uri(qr_image_path):
+    with open(qr_image_path, "rb") as logo_file:
+        data = base64.b64encode(logo_file.read()).decode()
+    media_type = mimetypes.guess_type(qr_image_path)[0] or "image/png"
+    return f"data:{media_type};base64,{data}"
+
+
+def logo_box(width, height):
+    # the logo covers the middle 20% of the QR Code's width and height,
+    # returns its size and its top left corner
+    sce_logo_width = int(width * 0.2)
+    sce_logo_height = int(height * 0.2)
+    top_left_x = int((width / 2) - (sce_logo_width / 2))
+    top_left_y = int((height / 2) - (sce_logo_height / 2))
+    return sce_logo_width, sce_logo_height, top_left_x, top_left_y
+
+
+def _render_svg(qrcode, scale, qr_image_path):
+    output = io.BytesIO()
+    qrcode.svg(output, scale=scale, background="#fff", quiet_zone=QR_CODE_QUIET_ZONE)
+    svg = output.getvalue().decode()
+    if qr_image_path is not None:
+        size = (qrcode.get_png_size(1, QR_CODE_QUIET_ZONE)) * scale
+        width, height, x, y = logo_box(size, size)
+        # the logo is embedded as is, on white like the raster formats
+        svg = svg.replace(
+            "</svg>",
+            f'<rect x="{x}" y="{y}" width="{width}" height="{height}" fill="#fff"/>'
+            f'<image x="{x}" y="{y}" width="{width}" height="{height}" '
+            f'href="{load_logo_data_uri(qr_image_path)}"/></svg>',
+        )
+    return svg.encode()
+
+
+def _render_raster(qrcode, image_format, scale, qr_image_path):
+    code = qrcode.code
+    size = len(code) + 2 * QR_CODE_QUIET_ZONE
+    border = b"\xff" * QR_CODE_QUIET_ZONE
+    rows = [b"\xff" * size] * QR_CODE_QUIET_ZONE
+    for row in code:
+        rows.append(border + bytes(0 if bit else 255 for bit in row) + border)
+    rows.extend([b"\xff" * size] * QR_CODE_QUIET_ZONE)
+    qrcode_image = Image.frombytes("L", (size, size), b"".join(rows)).resize(
+        (size * scale, size * scale), Image.NEAREST
+    )
+
+    if qr_image_path is not None:
+        qrcode_image = qrcode_image.convert("RGBA")
+        qrcode_width, qrcode_height = qrcode_image.size
+        width, height, x, y = logo_box(qrcode_width, qrcode_height)
+        # Place the logo in the center of the QR Code
+        qrcode_image.paste(load_logo(qr_image_path, width, height), (x, y))
+
+    output = io.BytesIO()
+    if image_format == "webp":
+        # lossy compression would blur the modules
+        qrcode_image.save(output, format="WEBP", lossless=True)
+    else:
+        qrcode_image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def render_qr_code(url, image_format="png", scale=QR_CODE_SCALE, qr_image_path=None):
+    # runs in a render process, so it must not touch metrics or QRCode
+    # state. returns the encoded image and the seconds the render took.
+    # the image is composited in memory and encoded once
+    start = time.perf_counter()
+    # Create a QR Code with high error tolerance (30%) to accommodate for the logo placed in the center
+    qrcode = pyqrcode.create(url, error="H")
+    if image_format == "svg":
+        data = _render_svg(qrcode, scale, qr_image_path)
+    else:
+        data = _render_raster(qrcode, image_format, scale, qr_image_path)
+    return data, time.perf_counter() - start
+
 
 class QRCode:
+    """
+    two tier cache of rendered QR Codes, keyed by variant_key(). the first
+    tier keeps up to max_memory_bytes of encoded images in memory. the
+    second tier is up to max_size files and max_bytes bytes in
+    qr_cache_path, recorded in a QRCodeIndex so they survive restarts and
+    crashes. both tiers evict the least recently served variant first
+    """
+
     def __init__(
         self,
         base_url,
         qr_cache_path,
         max_size,
-        cache_state_file=None,
+        index_file,
+        max_bytes=None,
         qr_image_path=None,
+        render_processes=0,
+        max_memory_bytes=0,
     ) -> None:
-        self.mapping = {}
+        # variant key -> (alias, path, size) of the files on disk, least
+        # recently used first
+        self.mapping = OrderedDict()
+        self.disk_bytes = 0
+        # alias -> keys of its variants on disk, so /delete can find them
+        self.variants = {}
+        # variant key -> time it was served, not yet written to the index
+        self.pending_touches = {}
+        # keys rendered by prerender() that haven't been served yet
+        self.prerendered = set()
+        # variant key -> QRImage, least recently served first
+        self.images = OrderedDict()
+        self.images_bytes = 0
+        self.max_memory_bytes = max_memory_bytes
+        # add() runs on executor threads, so changes to the dicts above are
+        # locked
+        self.lock = threading.Lock()
         self.base_url = base_url
         self.qr_cache_path = qr_cache_path
         self.max_size = max_size
-        self.cache_state_file = cache_state_file
+        self.max_bytes = max_bytes
         self.qr_image_path = qr_image_path
+        # a different logo changes every variant, so its hash is part of the key
+        self.logo_digest = ""
+        if qr_image_path is not None:
+            with open(qr_image_path, "rb") as logo_file:
+                self.logo_digest = hashlib.blake2b(logo_file.read(), digest_size=16).hexdigest()
+        # rendering is cpu bound, so it runs in worker processes to get
+        # around the GIL. the processes start on the first render, and are
+        # spawned rather than forked so they don't copy the locks of the
+        # server's other threads
+        self.render_pool = None
+        if render_processes > 0:
+            self.render_pool = ProcessPoolExecutor(
+                max_workers=render_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        if os.path.exists(index_file) and not is_sqlite_file(index_file):
+            # a JSON cache state file from before the index. the files it
+            # listed are cleaned up by reconciliation
+            logger.info(f"replacing old qr code cache state file {index_file} with an index")
+            os.remove(index_file)
+        self.index = QRCodeIndex(index_file)
+        for key, alias, path, size in self.index.entries():
+            self._track(key, alias, path, size)
+        self.reconciler = None
+        self.reconciled = False
+        self.stopped = threading.Event()
+
+    def start(self):
+        # call once metrics are initialized. checks the files on disk
+        # against the index in the background, unless the last run shut
+        # down cleanly and so left them in sync
+        self._set_disk_metrics()
+        if self.index.start():
+            logger.debug("qr code index was closed cleanly, skipping reconciliation")
+            return
+        self.reconciler = threading.Thread(target=self.reconcile, name="qr-reconcile", daemon=True)
+        self.reconciler.start()
+
+    def close(self):
+        with self.lock:
+            touches, self.pending_touches = self.pending_touches, {}
+        self.index.touch(touches)
+        # an unfinished reconciliation starts over on the next run
+        if self.reconciler is None or self.reconciled:
+            self.index.mark_clean_shutdown()
+
+    def variant_key(self, alias, image_format="png", scale=QR_CODE_SCALE):
+        # hash of everything that goes into the image
+        url = os.path.join(self.base_url, alias)
+        variant = json.dumps([RENDER_VERSION, url, image_format, scale, self.logo_digest])
+        return hashlib.blake2b(variant.encode(), digest_size=16).hexdigest()
+
+    def _render(self, url, image_format, scale):
+        if self.render_pool is None:
+            return render_qr_code(url, image_format, scale, self.qr_image_path)
+        MetricsHandler.qr_render_queue_depth.inc()
+        try:
+            return self.render_pool.submit(
+                render_qr_code, url, image_format, scale, self.qr_image_path
+            ).result()
+        finally:
+            MetricsHandler.qr_render_queue_depth.dec()
+
+    def _set_disk_metrics(self):
+        MetricsHandler.qr_code_cache_size.set(len(self.mapping))
+        MetricsHandler.qr_code_cache_size_in_bytes.set(self.disk_bytes)
 
-        # read from JSON file to initialize cache at server startup
-        if self.cache_state_file is not None:
-            self.read_cache_state()
+    def _track(self, key, alias, path, size):
+        # must be called with the lock held, or before other threads start
+        self.mapping[key] = (alias, path, size)
+        self.disk_bytes += size
+        self.variants.setdefault(alias, set()).add(key)
 
-    def add(self, alias: str):
+    def _touch(self, key):
+        # must be called with the lock held
+        if key in self.mapping:
+            self.mapping.move_to_end(key)
+            self.pending_touches[key] = time.time()
+        if key in self.prerendered:
+            self.prerendered.discard(key)
+            MetricsHandler.qr_prerender_hits.inc()
+
+    def _remember(self, key, image: QRImage):
+        with self.lock:
+            old_image = self.images.pop(key, None)
+            if old_image is not None:
+                self.images_bytes -= len(old_image.data)
+            if len(image.data) > self.max_memory_bytes:
+                return
+            self.images[key] = image
+            self.images_bytes += len(image.data)
+            while self.images_bytes > self.max_memory_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.images_bytes -= len(evicted.data)
+            MetricsHandler.qr_code_memory_cache_size_in_bytes.set(self.images_bytes)
+
+    def _forget(self, key):
+        # drops key from both tiers, returns its path on disk if it had one.
+        # must be called with the lock held, and the caller must remove the
+        # key from the index before it removes the file
+        image = self.images.pop(key, None)
+        if image is not None:
+            self.images_bytes -= len(image.data)
+            MetricsHandler.qr_code_memory_cache_size_in_bytes.set(self.images_bytes)
+        self.pending_touches.pop(key, None)
+        self.prerendered.discard(key)
+        if key not in self.mapping:
+            return None
+        alias, path, size = self.mapping.pop(key)
+        self.disk_bytes -= size
+        keys = self.variants.get(alias, set())
+        keys.discard(key)
+        if not keys:
+            self.variants.pop(alias, None)
+        return path
+
+    def _remove_files(self, paths):
+        for path in paths:
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                logger.debug(f"qr code at {path} was already removed")
+
+    def _read_from_disk(self, key):
+        with self.lock:
+            _, path, _ = self.mapping.get(key, (None, None, None))
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as image_file:
+                image = QRImage(image_file.read(), f'"{key}"')
+        except FileNotFoundError:
+            logger.warning(f"qr code {key} is missing from {path}")
+            with self.lock:
+                self._forget(key)
+                self._set_disk_metrics()
+            self.index.remove([key])
+            return None
+        MetricsHandler.qr_code_cache_hits.labels("disk").inc()
+        self._remember(key, image)
+        with self.lock:
+            self._touch(key)
+        return image
+
+    def _write_to_disk(self, alias, key, image_format, image: QRImage):
+        size = len(image.data)
+        victims = []
+        with self.lock:
+            while self.mapping and (
+                len(self.mapping) >= self.max_size
+                or (self.max_bytes is not None and self.disk_bytes + size > self.max_bytes)
+            ):
+                victim = next(iter(self.mapping))
+                victims.append((victim, self._forget(victim)))
+            touches, self.pending_touches = self.pending_touches, {}
+        if victims:
+            self.index.remove([victim for victim, _ in victims])
+            self._remove_files([path for _, path in victims])
+            logger.debug(f"Removed {len(victims)} qr codes to free space.")
+
+        # the file is complete before it gets its name, and named before
+        # it gets a row, so a crash can't leave a row without a whole file
+        path = os.path.join(self.qr_cache_path, f"{alias}.{key}.{image_format}")
+        with open(path + TEMP_SUFFIX, "wb") as image_file:
+            image_file.write(image.data)
+        os.replace(path + TEMP_SUFFIX, path)
+        self.index.add([(key, alias, path, size, time.time())])
+        # the index is being written anyway, so served times go with it
+        self.index.touch(touches)
+
+        with self.lock:
+            if key not in self.mapping:
+                self._track(key, alias, path, size)
+            self._set_disk_metrics()
+
+    def add(self, alias: str, image_format="png", scale=QR_CODE_SCALE, source="on_demand"):
+        # returns the QRImage for the variant from disk, or renders it.
+        # blocks, so call it off the event loop
+        key = self.variant_key(alias, image_format, scale)
         try:
-            if len(self.mapping) >= self.max_size:  # removes files if exceeds size
-                remove_alias, remove_path = self.mapping.popitem()
-                # Decrease the qr_code_cache_size_in_bytes custom prometheus metric by the file size of the QR Code that was removed
-                MetricsHandler.qr_code_cache_size_in_bytes.dec(
-                    os.path.getsize(remove_path)
-                )
-                os.remove(remove_path)
-                # Decrease the qr_code_cache_size custom prometheus metric by 1 after a QR Code is removed
-                MetricsHandler.qr_code_cache_size.dec(1)
-                logger.debug(
-                    f"Removed qrcode with alias: {remove_alias} to free space."
-                )
+            image = self.find(key)
+            if image is not None:
+                # rendered by a call that finished while this one waited
+                return image
+            image = self._read_from_disk(key)
+            if image is not None:
+                return image
 
             url = os.path.join(self.base_url, alias)
-            path = os.path.join(self.qr_cache_path, str(uuid.uuid4()) + ".png")
-
-            # Create a QR Code with high error tolerance (30%) to accommodate for the logo placed in the center
-            qrcode = pyqrcode.create(url, error="H")
-            # Save the generated QR Code
-            qrcode.png(path, scale=10)
-
-            # Open the saved QR Code to add the logo in the center
-            qrcode_image = Image.open(path)
-            qrcode_image = qrcode_image.convert("RGBA")
-
-            if self.qr_image_path is not None:
-                sce_logo = Image.open(self.qr_image_path)
-
-                qrcode_width, qrcode_height = qrcode_image.size
-                # Resize sce_logo to be 20% of the qr code's width and height
-                sce_logo_width = int(qrcode_width * 0.2)
-                sce_logo_height = int(qrcode_height * 0.2)
-                sce_logo = sce_logo.resize((sce_logo_width, sce_logo_height))
-
-                # Calculate the coordinates for the logo to be centered on the QR Code
-                top_left_x = int((qrcode_width / 2) - (sce_logo_width / 2))
-                top_left_y = int((qrcode_height / 2) - (sce_logo_height / 2))
-                bottom_right_x = int((qrcode_width / 2) + (sce_logo_width / 2))
-                bottom_right_y = int((qrcode_height / 2) + (sce_logo_height / 2))
-
-            box = [top_left_x, top_left_y, bottom_right_x, bottom_right_y]
-            # Place the logo in the center of the QR Code
-            qrcode_image.paste(sce_logo, box)
-            # Save the QR Code again after the logo has been added
-            qrcode_image.save(path, scale=10)
-            # Increase the qr_code_cache_size_in_bytes custom prometheus metric by the size of the newly created QR Code
-            MetricsHandler.qr_code_cache_size_in_bytes.inc(os.path.getsize(path))
-            # Increase the qr_code_cache_size custom prometheus metric by 1 after a new QR Code is added
-            MetricsHandler.qr_code_cache_size.inc()
-
-            self.mapping[alias] = path
-
-            return path
+            data, seconds = self._render(url, image_format, scale)
+            MetricsHandler.qr_render_seconds.observe(seconds)
+            MetricsHandler.qr_renders.labels(source).inc()
+            image = QRImage(data, f'"{key}"')
+            self._remember(key, image)
+            self._write_to_disk(alias, key, image_format, image)
+            if source == "prerender":
+                with self.lock:
+                    self.prerendered.add(key)
+            return image
         except FileNotFoundError:
             logger.exception(f"Could not find folder {self.qr_cache_path}:")
         except OSError:
@@ -93,57 +384,131 @@ class QRCode:
         except Exception:
             logger.exception("An unexpected error occured")
 
-    def find(self, alias: str):
-        return self.mapping.get(alias)
+    def prerender(self, alias: str, image_format="png", scale=QR_CODE_SCALE) -> bool:
+        # renders the variant unless it is cached, returns whether it did
+        key = self.variant_key(alias, image_format, scale)
+        with self.lock:
+            if key in self.images or key in self.mapping:
+                return False
+        return self.add(alias, image_format, scale, source="prerender") is not None
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.reconciler is not None:
+            self.reconciler.join()
+        if self.render_pool is not None:
+            self.render_pool.shutdown(wait=True)
+
+    def find(self, key: str):
+        # only looks in memory, so it is safe to call on the event loop
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                return None
+            self.images.move_to_end(key)
+            self._touch(key)
+        MetricsHandler.qr_code_cache_hits.labels("memory").inc()
+        return image
 
     def delete(self, alias: str):
-        path = self.mapping.get(alias)
-        if path is None:
-            logging.debug(f"path not found in mapping for alias {alias}")
+        # removes every variant of alias
+        with self.lock:
+            keys = list(self.variants.get(alias, ()))
+            paths = [self._forget(key) for key in keys]
+            self._set_disk_metrics()
+        if not keys:
+            logging.debug(f"no qr codes found for alias {alias}")
             return None
-        if alias in self.mapping:
-            self.mapping.pop(alias)
-        if os.path.exists(path):
-            # Decrease the qr_code_cache_size_in_bytes custom prometheus metric by the file size of the QR Code that was removed
-            MetricsHandler.qr_code_cache_size_in_bytes.dec(os.path.getsize(path))
-            os.remove(path)
-            # Set the qr_code_cache_size custom prometheus metric to the length of self.mapping after a QR Code is removed
-            MetricsHandler.qr_code_cache_size.set(len(self.mapping))
-            logger.debug(f"removed qr code at {path} for alias {alias}")
+        self.index.remove(keys)
+        self._remove_files(paths)
+        logger.debug(f"removed {len(keys)} qr codes for alias {alias}")
 
     def clear(self):
         try:
-            for alias in self.mapping.keys():
+            for alias in list(self.variants.keys()):
                 self.delete(alias)
-            self.mapping.clear()
+            with self.lock:
+                self.images.clear()
+                self.images_bytes = 0
             logger.debug("Cleared qr code folder")
         except Exception:
             logger.exception("An unexpected error occurred clearing the cache")
 
-    # when server starts, load the cache state from JSON file
-    def read_cache_state(self):
-        try:
-            with open(self.cache_state_file, "r") as json_file:
-                self.mapping = json.load(json_file)
-        except FileNotFoundError:
-            logger.exception(
-                f"Could not find cache state file: {self.cache_state_file}"
-            )
-        except json.JSONDecodeError:
-            logger.exception(
-                f"Error when reading JSON from cache state file: {self.cache_state_file}"
-            )
-        except Exception:
-            logger.exception(
-                f"An unexpected error occurred while reading cache state file: {self.cache_state_file}"
-            )
+    def _adopt(self, rows):
+        # rows are (key, alias, path, size, last_used) for files without a row
+        if not rows:
+            return
+        self.index.add(rows)
+        with self.lock:
+            for key, alias, path, size, _ in rows:
+                if key not in self.mapping:
+                    self._track(key, alias, path, size)
+                    # nothing says how recently they were served, so they
+                    # are evicted first
+                    self.mapping.move_to_end(key, last=False)
+            self._set_disk_metrics()
 
-    # when server shuts down, save the cache state to file
-    def write_cache_state(self):
+    def reconcile(self):
+        # adopts variant files that have no row, removes rows whose file is
+        # gone and removes files left by older versions or interrupted
+        # writes. runs RECONCILE_CHUNK_SIZE files per index transaction
+        start = time.monotonic()
+        with self.lock:
+            known = {key: path for key, (_, path, _) in self.mapping.items()}
+        seen = set()
+        rows = []
+        adopted = 0
+        stale_files = []
         try:
-            with open(self.cache_state_file, "w") as json_file:
-                json.dump(self.mapping, json_file)
-        except Exception:
-            logger.exception(
-                f"An unexpected error occurred while saving cache state file: {self.cache_state_file}"
+            with os.scandir(self.qr_cache_path) as entries:
+                for entry in entries:
+                    if self.stopped.is_set():
+                        logger.info("stopped reconciling qr code index for shutdown")
+                        return
+                    name = entry.name
+                    if name.endswith(TEMP_SUFFIX):
+                        # skip writes that may still be in progress
+                        if (
+                            VARIANT_FILE_PATTERN.match(name[:-len(TEMP_SUFFIX)])
+                            and time.time() - entry.stat().st_mtime > STALE_TEMP_FILE_SECONDS
+                        ):
+                            stale_files.append(entry.path)
+                        continue
+                    if LEGACY_FILE_PATTERN.match(name):
+                        stale_files.append(entry.path)
+                        continue
+                    match = VARIANT_FILE_PATTERN.match(name)
+                    if match is None:
+                        continue
+                    alias, key, _ = match.groups()
+                    seen.add(key)
+                    if key in known:
+                        continue
+                    stat = entry.stat()
+                    rows.append((key, alias, entry.path, stat.st_size, stat.st_mtime))
+                    if len(rows) >= RECONCILE_CHUNK_SIZE:
+                        self._adopt(rows)
+                        adopted += len(rows)
+                        rows = []
+            self._adopt(rows)
+            adopted += len(rows)
+
+            missing = [
+                key for key, path in known.items()
+                if key not in seen and not os.path.exists(path)
+            ]
+            with self.lock:
+                for key in missing:
+                    self._forget(key)
+                self._set_disk_metrics()
+            for start_index in range(0, len(missing), RECONCILE_CHUNK_SIZE):
+                self.index.remove(missing[start_index:start_index + RECONCILE_CHUNK_SIZE])
+            self._remove_files(stale_files)
+            logger.info(
+                f"reconciled qr code index in {time.monotonic() - start:.2f}s: "
+                f"adopted {adopted} files, dropped {len(missing)} missing files, "
+                f"removed {len(stale_files)} stale files"
             )
+            self.reconciled = True
+        except Exception:
+            logger.exception(f"Unable to reconcile qr code index with {self.qr_cache_path}")
@@ -0,0 +1,101 @@
+import logging
+
+import modules.sqlite_helpers as sqlite_helpers
+
+logger = logging.getLogger(__name__)
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def is_sqlite_file(path) -> bool:
+    with open(path, "rb") as index_file:
+        return index_file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class QRCodeIndex:
+    """
+    durable record of the qr code files on disk, so they are neither
+    forgotten nor leaked when the server crashes. every file is written
+    before its row and its row deleted before the file, so after a crash
+    the worst case is a file without a row, which reconciliation adopts
+    """
+
+    def __init__(self, sqlite_file):
+        self.sqlite_file = sqlite_file
+        db = sqlite_helpers.get_connection(sqlite_file)
+        with db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS qr_codes (
+                    key TEXT PRIMARY KEY,
+                    alias TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL);
+                """
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_qr_codes_last_used ON qr_codes (last_used);"
+            )
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS qr_code_index_state (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL);
+                """
+            )
+
+    def start(self) -> bool:
+        # returns whether the last run shut down cleanly, and marks this run
+        # as not yet shut down
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        with db:
+            row = db.execute(
+                "SELECT value FROM qr_code_index_state WHERE name = 'clean_shutdown'"
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO qr_code_index_state(name, value) VALUES ('clean_shutdown', 0)"
+            )
+        return row is not None and row[0] == 1
+
+    def mark_clean_shutdown(self):
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO qr_code_index_state(name, value) VALUES ('clean_shutdown', 1)"
+            )
+
+    def entries(self):
+        # (key, alias, path, size) of every file, least recently used first
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        return db.execute(
+            "SELECT key, alias, path, size FROM qr_codes ORDER BY last_used"
+        ).fetchall()
+
+    def add(self, rows):
+        # rows are (key, alias, path, size, last_used) tuples
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO qr_codes(key, alias, path, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def touch(self, last_used):
+        # last_used maps keys to the time they were last served
+        if not last_used:
+            return
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        with db:
+            db.executemany(
+                "UPDATE qr_codes SET last_used = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in last_used.items()],
+            )
+
+    def remove(self, keys):
+        if not keys:
+            return
+        db = sqlite_helpers.get_connection(self.sqlite_file)
+        with db:
+            db.executemany("DELETE FROM qr_codes WHERE key = ?", [(key,) for key in keys])
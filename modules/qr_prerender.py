@@ -0,0 +1,109 @@
+import logging
+from queue import Empty, Full, Queue
+import threading
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+
+class QRPrerenderer:
+    """
+    renders the default QR Code variant of new and trending aliases in the
+    background, so the first /qr request for them is a cache hit. renders
+    happen one at a time and at most rate per second, and after each one
+    the thread idles long enough to stay under cpu_budget of one cpu. a
+    rate of 0 turns pre-rendering off
+    """
+
+    def __init__(self, qr_code_cache, rate, cpu_budget, max_queue_size):
+        self.qr_code_cache = qr_code_cache
+        self.rate = rate
+        self.cpu_budget = cpu_budget
+        self.queue = Queue(maxsize=max_queue_size)
+        # aliases in the queue that weren't discarded, so each is queued once
+        self.pending = set()
+        # the alias being rendered, and whether it was deleted meanwhile
+        self.current = None
+        self.current_discarded = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.thread = threading.Thread(target=self.run, name="qr-prerender", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, alias, trigger):
+        # trigger says why, "create" or "trending". never blocks, an alias
+        # that doesn't fit in the queue is dropped
+        if not self.enabled:
+            return
+        MetricsHandler.qr_prerender_requests.labels(trigger).inc()
+        with self.lock:
+            if alias in self.pending:
+                return
+            try:
+                self.queue.put_nowait(alias)
+            except Full:
+                MetricsHandler.qr_prerender_dropped.inc()
+                return
+            self.pending.add(alias)
+        MetricsHandler.qr_prerender_queue_depth.set(self.queue.qsize())
+
+    def discard(self, alias):
+        # must be called before the alias's qr codes are deleted
+        with self.lock:
+            self.pending.discard(alias)
+            if self.current == alias:
+                self.current_discarded = True
+
+    def _render(self, alias):
+        # returns the seconds spent rendering, 0 if the variant was cached
+        with self.lock:
+            if alias not in self.pending:
+                return 0
+            self.pending.discard(alias)
+            self.current = alias
+            self.current_discarded = False
+        start = time.monotonic()
+        rendered = False
+        try:
+            rendered = self.qr_code_cache.prerender(alias)
+        except Exception:
+            logger.exception(f"Unable to pre-render qr code for alias {alias}")
+        with self.lock:
+            discarded = self.current_discarded
+            self.current = None
+        if discarded:
+            self.qr_code_cache.delete(alias)
+        return time.monotonic() - start if rendered else 0
+
+    def run(self):
+        next_render = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                alias = self.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            MetricsHandler.qr_prerender_queue_depth.set(self.queue.qsize())
+            if self.stopped.wait(max(0, next_render - time.monotonic())):
+                break
+            elapsed = self._render(alias)
+            if elapsed:
+                idle = elapsed * (1 - self.cpu_budget) / self.cpu_budget
+                next_render = time.monotonic() + max(1 / self.rate, idle)
@@ -0,0 +1,242 @@
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from modules.metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CLZYSHM2"
+# magic, number of buckets, ways per bucket, max alias bytes, max url bytes
+FILE_HEADER = struct.Struct("<8sIIII")
+FILE_HEADER_SIZE = 64
+# seqlock counter, alias hash (0 means empty), last used time, alias length,
+# url length, expiration timestamp (0 means never)
+SLOT_HEADER = struct.Struct("<IQIHHd")
+SEQUENCE = struct.Struct("<I")
+LAST_USED = struct.Struct("<I")
+LAST_USED_OFFSET = 12
+WAYS = 4
+MAX_ALIAS_LENGTH = 64
+MAX_READ_RETRIES = 8
+# in-process locks, striped by bucket. fcntl record locks only exclude
+# other processes, threads of one process share them
+PROCESS_LOCK_STRIPES = 64
+
+
+def _hash_alias(alias_bytes):
+    # python's hash() is salted per process, so workers need a stable hash
+    digest = hashlib.blake2b(alias_bytes, digest_size=8).digest()
+    return int.from_bytes(digest, "little") | 1
+
+
+class SharedMemoryCache:
+    """
+    alias -> url cache stored in a memory mapped file, so every server process
+    on the host shares one copy. the file is a fixed size, 4-way set
+    associative hash table. readers take no locks: each slot carries a
+    sequence counter that writers make odd while they change the slot, and a
+    reader retries when the counter is odd or changed during its read.
+    writers lock only the bucket they change, with an fcntl record lock
+    """
+
+    def __init__(self, path, cacheSize, max_url_length):
+        self.path = path
+        self.num_buckets = max(1, math.ceil(cacheSize / WAYS))
+        self.max_url_length = max_url_length
+        self.slot_size = SLOT_HEADER.size + MAX_ALIAS_LENGTH + max_url_length
+        self.bucket_size = self.slot_size * WAYS
+        self.file_size = FILE_HEADER_SIZE + self.bucket_size * self.num_buckets
+        self.process_locks = [threading.Lock() for _ in range(PROCESS_LOCK_STRIPES)]
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            self._maybe_initialize()
+            self.mm = mmap.mmap(self.fd, self.file_size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _maybe_initialize(self):
+        expected = FILE_HEADER.pack(
+            MAGIC, self.num_buckets, WAYS, MAX_ALIAS_LENGTH, self.max_url_length
+        )
+        if os.fstat(self.fd).st_size == self.file_size:
+            if os.pread(self.fd, FILE_HEADER.size, 0) == expected:
+                logger.debug(f"attaching to existing shared cache at {self.path}")
+                return
+        # new file, or one written with a different layout. every process
+        # starts with the same arguments, so this only happens on the first
+        # start after the layout changed
+        logger.info(f"initializing shared cache at {self.path}")
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, self.file_size)
+        os.pwrite(self.fd, expected, 0)
+
+    def _bucket(self, key_hash):
+        bucket = key_hash % self.num_buckets
+        return bucket, FILE_HEADER_SIZE + bucket * self.bucket_size
+
+    def _read_slot(self, offset, key_hash, alias_bytes):
+        # returns the url stored in the slot for alias_bytes, or None. an
+        # expired url is left for the sweeper to delete
+        for _ in range(MAX_READ_RETRIES):
+            (sequence,) = SEQUENCE.unpack_from(self.mm, offset)
+            if sequence & 1:
+                continue
+            _, slot_hash, _, alias_length, url_length, expires_at = SLOT_HEADER.unpack_from(
+                self.mm, offset
+            )
+            if slot_hash != key_hash:
+                return None
+            data_offset = offset + SLOT_HEADER.size
+            slot_alias = self.mm[data_offset:data_offset + alias_length]
+            url_offset = data_offset + MAX_ALIAS_LENGTH
+            url_bytes = self.mm[url_offset:url_offset + url_length]
+            if SEQUENCE.unpack_from(self.mm, offset)[0] != sequence:
+                continue
+            if slot_alias != alias_bytes:
+                return None
+            if expires_at and expires_at <= time.time():
+                return None
+            # last used only steers eviction, so a racy write is fine
+            LAST_USED.pack_into(self.mm, offset + LAST_USED_OFFSET, int(time.time()))
+            return url_bytes.decode()
+        return None
+
+    def find(self, alias):
+        alias_bytes = alias.encode()
+        key_hash = _hash_alias(alias_bytes)
+        _, bucket_offset = self._bucket(key_hash)
+        for way in range(WAYS):
+            url_output = self._read_slot(
+                bucket_offset + way * self.slot_size, key_hash, alias_bytes
+            )
+            if url_output is not None:
+                logging.debug(f"alias: '{alias}' is grabbed from shared cache")
+                MetricsHandler.cache_hits.inc()
+                return url_output
+        MetricsHandler.cache_misses.inc()
+        return None
+
+    def items(self):
+        # every cached entry, most recently read first
+        entries = []
+        for bucket in range(self.num_buckets):
+            bucket_offset = FILE_HEADER_SIZE + bucket * self.bucket_size
+            for way in range(WAYS):
+                offset = bucket_offset + way * self.slot_size
+                for _ in range(MAX_READ_RETRIES):
+                    (sequence,) = SEQUENCE.unpack_from(self.mm, offset)
+                    if sequence & 1:
+                        continue
+                    _, slot_hash, last_used, alias_length, url_length, _ = (
+                        SLOT_HEADER.unpack_from(self.mm, offset)
+                    )
+                    data_offset = offset + SLOT_HEADER.size
+                    alias_bytes = self.mm[data_offset:data_offset + alias_length]
+                    url_offset = data_offset + MAX_ALIAS_LENGTH
+                    url_bytes = self.mm[url_offset:url_offset + url_length]
+                    if SEQUENCE.unpack_from(self.mm, offset)[0] != sequence:
+                        continue
+                    if slot_hash != 0:
+                        entries.append((last_used, alias_bytes.decode(), url_bytes.decode()))
+                    break
+        entries.sort(reverse=True)
+        return [(alias, url_output) for _, alias, url_output in entries]
+
+    def _lock_bucket(self, bucket):
+        process_lock = self.process_locks[bucket % PROCESS_LOCK_STRIPES]
+        process_lock.acquire()
+        offset = FILE_HEADER_SIZE + bucket * self.bucket_size
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.bucket_size, offset)
+        return process_lock, offset
+
+    def _unlock_bucket(self, process_lock, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.bucket_size, offset)
+        process_lock.release()
+
+    def _write_slot(self, offset, key_hash, alias_bytes, url_bytes, expires_at=None):
+        (sequence,) = SEQUENCE.unpack_from(self.mm, offset)
+        SEQUENCE.pack_into(self.mm, offset, sequence + 1)
+        data_offset = offset + SLOT_HEADER.size
+        self.mm[data_offset:data_offset + len(alias_bytes)] = alias_bytes
+        url_offset = data_offset + MAX_ALIAS_LENGTH
+        self.mm[url_offset:url_offset + len(url_bytes)] = url_bytes
+        SLOT_HEADER.pack_into(
+            self.mm, offset, sequence + 1, key_hash, int(time.time()),
+            len(alias_bytes), len(url_bytes), expires_at or 0,
+        )
+        SEQUENCE.pack_into(self.mm, offset, sequence + 2)
+
+    def _slot_matches(self, offset, key_hash, alias_bytes):
+        # only called with the bucket locked, so no retry is needed
+        _, slot_hash, _, alias_length, _, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+        if slot_hash != key_hash:
+            return False
+        data_offset = offset + SLOT_HEADER.size
+        return self.mm[data_offset:data_offset + alias_length] == alias_bytes
+
+    def add(self, alias, url_output, expires_at=None):
+        alias_bytes = alias.encode()
+        url_bytes = url_output.encode()
+        if len(alias_bytes) > MAX_ALIAS_LENGTH or len(url_bytes) > self.max_url_length:
+            logging.debug(f"alias: '{alias}' is too long for the shared cache")
+            return
+        key_hash = _hash_alias(alias_bytes)
+        bucket, _ = self._bucket(key_hash)
+        process_lock, bucket_offset = self._lock_bucket(bucket)
+        try:
+            offsets = [bucket_offset + way * self.slot_size for way in range(WAYS)]
+            # the alias's own slot wins over an empty one, or a delete would
+            # leave a second copy behind. a file written before that was the
+            # case can still hold more than one, the extra ones are cleared
+            matches = [
+                offset for offset in offsets
+                if self._slot_matches(offset, key_hash, alias_bytes)
+            ]
+            if matches:
+                victim = matches[0]
+                for offset in matches[1:]:
+                    self._write_slot(offset, 0, b"", b"")
+            else:
+                victim = None
+                victim_last_used = None
+                for offset in offsets:
+                    _, slot_hash, last_used, _, _, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+                    if slot_hash == 0:
+                        victim = offset
+                        break
+                    if victim_last_used is None or last_used < victim_last_used:
+                        victim, victim_last_used = offset, last_used
+            self._write_slot(victim, key_hash, alias_bytes, url_bytes, expires_at)
+        finally:
+            self._unlock_bucket(process_lock, bucket_offset)
+        logging.debug("set alias: '" + alias + "' to shared cache")
+
+    def delete(self, alias):
+        alias_bytes = alias.encode()
+        key_hash = _hash_alias(alias_bytes)
+        bucket, _ = self._bucket(key_hash)
+        process_lock, bucket_offset = self._lock_bucket(bucket)
+        deleted = False
+        try:
+            # every way, in case a file from before add() checked them all
+            # holds more than one copy
+            for way in range(WAYS):
+                offset = bucket_offset + way * self.slot_size
+                if self._slot_matches(offset, key_hash, alias_bytes):
+                    self._write_slot(offset, 0, b"", b"")
+                    deleted = True
+        finally:
+            self._unlock_bucket(process_lock, bucket_offset)
+        if deleted:
+            logging.debug(f"deleted {alias} from shared cache")
+        else:
+            logging.debug(f"alias {alias} was not found in shared cache")
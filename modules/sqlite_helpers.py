@@ -1,17 +1,85 @@
+import base64
+from collections import OrderedDict
+import json
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import logging
 from modules.args import get_args
 
 ROWS_PER_PAGE = 25
+SORT_COLUMNS = {"id", "url", "alias", "created_at", "used"}
+# fts5's trigram tokenizer can only match terms at least this long
+MIN_INDEXED_SEARCH_LENGTH = 3
+# number of distinct search terms whose counts are remembered
+SEARCH_COUNT_CACHE_SIZE = 1024
+# columns written by /export and read back by /import, in order
+EXPORT_COLUMNS = ("url", "alias", "created_at", "expires_at", "used")
+# expires_at is stored as wall clock time in expiration_date_timezone in
+# this format, so comparing the text compares the times
+EXPIRES_AT_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
 logger = logging.getLogger(__name__)
 args = get_args()
 expiration_date_timezone = ZoneInfo(args.expiration_date_timezone)
 
+# each thread keeps one long-lived connection per database file, so a
+# query never pays for connect() and pragma setup after the first call
+_local = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
+
+def open_connection(sqlite_file: str) -> sqlite3.Connection:
+    # check_same_thread is off so close_connections() can close every
+    # connection at shutdown. outside of that, a pooled connection is only
+    # ever used by the thread that opened it
+    db = sqlite3.connect(
+        sqlite_file,
+        timeout=args.sqlite_busy_timeout,
+        cached_statements=args.sqlite_statement_cache_size,
+        check_same_thread=False,
+    )
+    # pragma values come from argparse choices/ints, so formatting is safe
+    db.execute(f"PRAGMA journal_mode = {args.sqlite_journal_mode}")
+    db.execute(f"PRAGMA synchronous = {args.sqlite_synchronous}")
+    db.execute(f"PRAGMA cache_size = {args.sqlite_cache_size}")
+    db.execute(f"PRAGMA mmap_size = {args.sqlite_mmap_size}")
+    return db
+
+
+def get_connection(sqlite_file: str) -> sqlite3.Connection:
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    db = connections.get(sqlite_file)
+    if db is None:
+        db = open_connection(sqlite_file)
+        connections[sqlite_file] = db
+        with _all_connections_lock:
+            _all_connections.append(db)
+        logger.debug(
+            f"opened connection to {sqlite_file} for thread {threading.current_thread().name}"
+        )
+    return db
+
+
+def close_connections():
+    with _all_connections_lock:
+        for db in _all_connections:
+            try:
+                db.close()
+            except Exception:
+                logger.exception("Unable to close sqlite connection")
+        _all_connections.clear()
+    # connections owned by the calling thread are gone now too
+    _local.connections = {}
+
+
 def maybe_create_table(sqlite_file: str) -> bool:
-    db = sqlite3.connect(sqlite_file)
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
 
     try:
@@ -30,26 +98,242 @@ def maybe_create_table(sqlite_file: str) -> bool:
         ON urls (alias);
         """
 
-        cursor.execute(create_table_query)
-        cursor.execute(create_index_query)
-        db.commit()
+        # one index per /list sort column, with id as the tie breaker used by
+        # cursor pagination. alias is unique and id is the rowid, so neither
+        # needs another index
+        create_sort_index_queries = [
+            "CREATE INDEX IF NOT EXISTS idx_urls_created_at_id ON urls (created_at, id);",
+            "CREATE INDEX IF NOT EXISTS idx_urls_url_id ON urls (url, id);",
+            "CREATE INDEX IF NOT EXISTS idx_urls_used_id ON urls (used, id);",
+        ]
+        # lets the expiry sweeper find expired rows without a scan. most
+        # urls never expire, so they're left out
+        create_expires_at_index_query = """
+        CREATE INDEX IF NOT EXISTS idx_urls_expires_at
+        ON urls (expires_at) WHERE expires_at IS NOT NULL;
+        """
+
+        # url_counts holds the number of rows in urls, kept up to date by
+        # triggers so nothing has to COUNT(*) the whole table
+        create_counts_table_query = """
+        CREATE TABLE IF NOT EXISTS url_counts (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL);
+        """
+        create_counts_trigger_queries = [
+            """
+            CREATE TRIGGER IF NOT EXISTS url_counts_insert AFTER INSERT ON urls BEGIN
+                UPDATE url_counts SET value = value + 1 WHERE name = 'urls';
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS url_counts_delete AFTER DELETE ON urls BEGIN
+                UPDATE url_counts SET value = value - 1 WHERE name = 'urls';
+            END;
+            """,
+        ]
+        # runs after the triggers exist, so no insert or delete is missed
+        backfill_counts_query = """
+        INSERT OR IGNORE INTO url_counts(name, value) SELECT 'urls', COUNT(*) FROM urls;
+        """
+
+        # next_id is the first id not yet handed to an AliasAllocator, key
+        # is the random key generated aliases are obfuscated with
+        create_alias_counter_query = """
+        CREATE TABLE IF NOT EXISTS alias_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            next_id INTEGER NOT NULL,
+            key BLOB NOT NULL);
+        """
+        create_alias_counter_row_query = """
+        INSERT OR IGNORE INTO alias_counter(id, next_id, key) VALUES (0, 0, randomblob(16));
+        """
+
+        # clicks per alias per minute, minute being minutes since the epoch
+        # in UTC. rows are only ever added to or deleted, never rewritten,
+        # and go when their url does
+        create_clicks_table_query = """
+        CREATE TABLE IF NOT EXISTS url_clicks (
+            alias TEXT NOT NULL,
+            minute INTEGER NOT NULL,
+            clicks INTEGER NOT NULL,
+            PRIMARY KEY (alias, minute)) WITHOUT ROWID;
+        """
+        create_clicks_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS url_clicks_delete AFTER DELETE ON urls BEGIN
+            DELETE FROM url_clicks WHERE alias = old.alias;
+        END;
+        """
+
+        with db:
+            cursor.execute(create_table_query)
+            cursor.execute(create_index_query)
+            for query in create_sort_index_queries:
+                cursor.execute(query)
+            cursor.execute(create_expires_at_index_query)
+            cursor.execute(create_counts_table_query)
+            for query in create_counts_trigger_queries:
+                cursor.execute(query)
+            cursor.execute(backfill_counts_query)
+            cursor.execute(create_alias_counter_query)
+            cursor.execute(create_alias_counter_row_query)
+            cursor.execute(create_clicks_table_query)
+            cursor.execute(create_clicks_trigger_query)
+        normalize_expires_at(sqlite_file)
+        maybe_create_search_index(sqlite_file)
         return True
     except Exception:
         logger.exception("Unable to create urls table")
         return False
 
 
+# matches expires_at as format_expiration_date writes it
+EXPIRES_AT_GLOB = (
+    "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] "
+    "[0-9][0-9]:[0-9][0-9]:[0-9][0-9].[0-9][0-9][0-9][0-9][0-9][0-9]"
+)
+
+def normalize_expires_at(sqlite_file: str) -> int:
+    # rewrites expires_at values stored before they were normalized, e.g.
+    # without microseconds or with a utc offset, with format_expiration_date,
+    # since get_url and the sweeper compare them as text. returns how many
+    # were rewritten. values that aren't dates are left alone
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute(
+            "SELECT id, expires_at FROM urls "
+            "WHERE expires_at IS NOT NULL AND expires_at NOT GLOB ?",
+            (EXPIRES_AT_GLOB,),
+        )
+        updates = []
+        for row_id, expires_at in cursor.fetchall():
+            try:
+                updates.append((format_expiration_date(str(expires_at)), row_id))
+            except ValueError:
+                logger.warning(f"url {row_id} has an invalid expires_at {expires_at!r}")
+        if updates:
+            with db:
+                cursor.executemany("UPDATE urls SET expires_at = ? WHERE id = ?", updates)
+            logger.info(f"normalized expires_at of {len(updates)} urls")
+        return len(updates)
+    finally:
+        cursor.close()
+
+
+# files that have a urls_search index, filled in by maybe_create_search_index
+_search_index_files = set()
+
+def maybe_create_search_index(sqlite_file: str) -> bool:
+    # urls_search is an external content fts5 table over urls, so it stores
+    # only the trigram index and reads alias and url from urls itself
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'urls_search'"
+        )
+        needs_backfill = cursor.fetchone() is None
+
+        create_search_table_query = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS urls_search
+        USING fts5(alias, url, content='urls', content_rowid='id', tokenize='trigram');
+        """
+        # updates of the used column don't touch the index
+        create_trigger_queries = [
+            """
+            CREATE TRIGGER IF NOT EXISTS urls_search_insert AFTER INSERT ON urls BEGIN
+                INSERT INTO urls_search(rowid, alias, url) VALUES (new.id, new.alias, new.url);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS urls_search_delete AFTER DELETE ON urls BEGIN
+                INSERT INTO urls_search(urls_search, rowid, alias, url)
+                VALUES ('delete', old.id, old.alias, old.url);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS urls_search_update AFTER UPDATE OF alias, url ON urls BEGIN
+                INSERT INTO urls_search(urls_search, rowid, alias, url)
+                VALUES ('delete', old.id, old.alias, old.url);
+                INSERT INTO urls_search(rowid, alias, url) VALUES (new.id, new.alias, new.url);
+            END;
+            """,
+        ]
+
+        with db:
+            cursor.execute(create_search_table_query)
+            for query in create_trigger_queries:
+                cursor.execute(query)
+            if needs_backfill:
+                # existing databases get their rows indexed once, here
+                logger.info(f"building urls_search index for {sqlite_file}")
+                cursor.execute("INSERT INTO urls_search(urls_search) VALUES ('rebuild')")
+        _search_index_files.add(sqlite_file)
+        return True
+    except sqlite3.OperationalError:
+        logger.exception(
+            "Unable to create urls_search index, is sqlite built with fts5? "
+            "searches will scan the urls table"
+        )
+        return False
+    finally:
+        cursor.close()
+
+
+def _search_filter(sqlite_file, search):
+    # returns the WHERE clause and parameters matching search in alias or url
+    if not search:
+        return "", ()
+    if sqlite_file in _search_index_files and len(search) >= MIN_INDEXED_SEARCH_LENGTH:
+        # quoted so fts5 treats the term as one string rather than a query
+        phrase = '"' + search.replace('"', '""') + '"'
+        return (
+            "WHERE id IN (SELECT rowid FROM urls_search WHERE urls_search MATCH ?)",
+            (phrase,),
+        )
+    pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    return (
+        "WHERE alias LIKE ? ESCAPE '\\' OR url LIKE ? ESCAPE '\\'",
+        (pattern, pattern),
+    )
+
+
+def format_expiration_date(expiration_date: str) -> str:
+    # an ISO 8601 expiration date as it is stored in expires_at. dates
+    # without a timezone are already in expiration_date_timezone
+    expiration_datetime = datetime.fromisoformat(expiration_date)
+    if expiration_datetime.tzinfo is not None:
+        expiration_datetime = expiration_datetime.astimezone(
+            expiration_date_timezone
+        ).replace(tzinfo=None)
+    return expiration_datetime.strftime(EXPIRES_AT_FORMAT)
+
+def expiration_timestamp(expires_at):
+    # expires_at as seconds since the epoch, None if it never expires
+    if expires_at is None:
+        return None
+    expiration_datetime = datetime.fromisoformat(expires_at)
+    if expiration_datetime.tzinfo is None:
+        expiration_datetime = expiration_datetime.replace(tzinfo=expiration_date_timezone)
+    return expiration_datetime.timestamp()
+
+def _now_expires_at():
+    return datetime.now(expiration_date_timezone).strftime(EXPIRES_AT_FORMAT)
+
 def insert_url(sqlite_file: str, url: str, alias: str, expiration_date: str):
-    db = sqlite3.connect(sqlite_file)
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
     timestamp = datetime.now()
     if expiration_date is not None:
-        expiration_date = datetime.fromisoformat(expiration_date)
+        expiration_date = format_expiration_date(expiration_date)
     try:
         sql = "INSERT INTO urls(url, alias, created_at, expires_at) VALUES (?, ?, ?, ?)"
         val = (url, alias, timestamp, expiration_date)
-        cursor.execute(sql, val)
-        db.commit()
+        with db:
+            cursor.execute(sql, val)
         return timestamp
     except sqlite3.IntegrityError:
         return None
@@ -57,24 +341,219 @@ def insert_url(sqlite_file: str, url: str, alias: str, expiration_date: str):
         logger.exception("Inserting url had an error")
         return None
 
-def get_urls(sqlite_file, page=0, search=None, sort_by="created_at", order="DESC"):
-    db = sqlite3.connect(sqlite_file)
+def insert_urls(sqlite_file: str, rows):
+    # rows are (url, alias, expiration_date) tuples. every row whose alias is
+    # free is inserted in one transaction. returns the created_at timestamp
+    # for each row, None for rows whose alias was taken, or None instead of
+    # a list if the transaction failed
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
+    timestamp = datetime.now()
+    results = [None] * len(rows)
+
+    try:
+        # take the write lock up front so no alias is claimed between the
+        # check below and the insert
+        cursor.execute("BEGIN IMMEDIATE")
+        aliases = [alias for _, alias, _ in rows]
+        taken = set()
+        for start in range(0, len(aliases), 500):
+            chunk = aliases[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(f"SELECT alias FROM urls WHERE alias IN ({placeholders})", chunk)
+            taken.update(row[0] for row in cursor.fetchall())
+
+        values = []
+        for i, (url, alias, expiration_date) in enumerate(rows):
+            if alias in taken:
+                continue
+            taken.add(alias)
+            if expiration_date is not None:
+                expiration_date = format_expiration_date(expiration_date)
+            values.append((url, alias, timestamp, expiration_date))
+            results[i] = timestamp
+        sql = "INSERT INTO urls(url, alias, created_at, expires_at) VALUES (?, ?, ?, ?)"
+        cursor.executemany(sql, values)
+        db.commit()
+        return results
+    except Exception:
+        db.rollback()
+        logger.exception(f"Inserting {len(rows)} urls had an error")
+        return None
+    finally:
+        cursor.close()
+
+def import_urls(sqlite_file: str, rows):
+    # rows are tuples of EXPORT_COLUMNS. rows whose alias is taken are
+    # skipped. returns the number of rows inserted, or None if the
+    # transaction failed
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        columns = ", ".join(EXPORT_COLUMNS)
+        placeholders = ", ".join("?" * len(EXPORT_COLUMNS))
+        with db:
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO urls({columns}) VALUES ({placeholders})", rows
+            )
+        return cursor.rowcount
+    except Exception:
+        logger.exception(f"Importing {len(rows)} urls had an error")
+        return None
+    finally:
+        cursor.close()
+
+def import_clicks(sqlite_file: str, rows):
+    # rows are (alias, minute, clicks) tuples. rows whose alias isn't in
+    # urls, or whose minute is already counted, are skipped. returns the
+    # number of rows inserted, or None if the transaction failed
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        with db:
+            cursor.executemany(
+                """
+                INSERT OR IGNORE INTO url_clicks(alias, minute, clicks)
+                SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM urls WHERE alias = ?)
+                """,
+                ((alias, minute, clicks, alias) for alias, minute, clicks in rows),
+            )
+        return cursor.rowcount
+    except Exception:
+        logger.exception(f"Importing {len(rows)} click counts had an error")
+        return None
+    finally:
+        cursor.close()
+
+def reserve_alias_block(sqlite_file: str, block_size: int) -> int:
+    # claims the next block_size alias ids for the caller, returns the first.
+    # the claim is committed before any id is used, so ids are never handed
+    # out twice, even across processes or restarts
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        with db:
+            cursor.execute(
+                "UPDATE alias_counter SET next_id = next_id + ? WHERE id = 0", (block_size,)
+            )
+            cursor.execute("SELECT next_id FROM alias_counter WHERE id = 0")
+            return cursor.fetchone()[0] - block_size
+    finally:
+        cursor.close()
+
+def get_alias_key(sqlite_file: str) -> bytes:
+    return get_alias_counter(sqlite_file)[1]
+
+def get_alias_counter(sqlite_file: str):
+    # returns (next_id, key) of alias_counter
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("SELECT next_id, key FROM alias_counter WHERE id = 0")
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+def set_alias_counter(sqlite_file: str, next_id: int, key: bytes):
+    # for copying the counter to another database, so aliases it generates
+    # never repeat ones generated before and are obfuscated the same way
+    db = get_connection(sqlite_file)
+    with db:
+        db.execute(
+            "UPDATE alias_counter SET next_id = MAX(next_id, ?), key = ? WHERE id = 0",
+            (next_id, key),
+        )
+
+def check_shard(sqlite_file: str, shard: int, shards: int):
+    # records which of how many shards the file is the first time it is
+    # opened as one, and raises ValueError if it was written as another
+    db = get_connection(sqlite_file)
+    with db:
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shard_layout (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                shard INTEGER NOT NULL,
+                shards INTEGER NOT NULL);
+            """
+        )
+        db.execute(
+            "INSERT OR IGNORE INTO shard_layout(id, shard, shards) VALUES (0, ?, ?)",
+            (shard, shards),
+        )
+        stored = db.execute("SELECT shard, shards FROM shard_layout WHERE id = 0").fetchone()
+    if tuple(stored) != (shard, shards):
+        raise ValueError(
+            f"{sqlite_file} is shard {stored[0]} of {stored[1]}, not {shard} of {shards}. "
+            "use --reshard-from to change the number of shards"
+        )
+
+def encode_cursor(sort_by: str, order: str, row: dict) -> str:
+    # opaque /list cursor for the page after row, which is a dict from get_urls
+    token = json.dumps([sort_by, order, row[sort_by], row["id"]])
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_by: str, order: str):
+    # returns (sort value, id) of the last row seen, raises ValueError if the
+    # cursor is malformed or was made for a different sort
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        cursor_sort_by, cursor_order, sort_value, last_id = token
+    except Exception:
+        raise ValueError(f"invalid cursor {cursor}")
+    if (cursor_sort_by, cursor_order) != (sort_by, order):
+        raise ValueError(f"cursor {cursor} is not for sort {sort_by} {order}")
+    # anything else would only fail once sqlite binds it. bool is an int too
+    sort_types = int if sort_by == "id" else (str, int, float, type(None))
+    if (
+        isinstance(last_id, bool) or not isinstance(last_id, int)
+        or isinstance(sort_value, bool) or not isinstance(sort_value, sort_types)
+    ):
+        raise ValueError(f"invalid cursor {cursor}")
+    return sort_value, last_id
+
+
+def get_urls(
+    sqlite_file,
+    page=0,
+    search=None,
+    sort_by="created_at",
+    order="DESC",
+    cursor=None,
+    limit=ROWS_PER_PAGE,
+    after=None,
+):
+    # with a cursor from encode_cursor, the page after it is returned and
+    # page is ignored. the rows already seen are skipped by an index seek
+    # instead of OFFSET, so deep pages cost the same as the first one.
+    # after is a decoded cursor, (sort value, id) of the last row seen
+    db = get_connection(sqlite_file)
+    sql_cursor = db.cursor()
+
+    # column names can't be parameters, so they are checked against a whitelist
+    if sort_by not in SORT_COLUMNS or order not in {"ASC", "DESC"}:
+        raise ValueError(f"invalid sort {sort_by} {order}")
+    where, params = _search_filter(sqlite_file, search)
+    offset = page * limit
+    if cursor is not None:
+        after = decode_cursor(cursor, sort_by, order)
+    if after is not None:
+        sort_value, last_id = after
+        comparison = "<" if order == "DESC" else ">"
+        keyset = f"({sort_by}, id) {comparison} (?, ?)"
+        where = f"WHERE ({where[len('WHERE '):]}) AND {keyset}" if where else f"WHERE {keyset}"
+        params += (sort_value, last_id)
+        offset = 0
+    order_by = f"{sort_by} {order}" if sort_by == "id" else f"{sort_by} {order}, id {order}"
+    sql = f"SELECT * FROM urls {where} ORDER BY {order_by} LIMIT ? OFFSET ?"
+    sql_cursor.execute(sql, params + (limit, offset))
     
-    offset = page * ROWS_PER_PAGE
-    if search:
-        sql = f"""
-        SELECT * FROM urls 
-        WHERE LOWER(alias) LIKE LOWER('%{search}%') 
-        OR LOWER(url) LIKE LOWER('%{search}%')
-        ORDER BY {sort_by} {order}
-        LIMIT {ROWS_PER_PAGE} OFFSET {offset}
-        """
-    else:
-        sql = f"SELECT * FROM urls ORDER BY {sort_by} {order} LIMIT {ROWS_PER_PAGE} OFFSET {offset}"
-    cursor.execute(sql)
-    
-    result = cursor.fetchall()
+    result = sql_cursor.fetchall()
     url_array = []
     for row in result:
         try:
@@ -90,94 +569,328 @@ def get_urls(sqlite_file, page=0, search=None, sort_by="created_at", order="DESC
             continue
     return url_array
 
-def get_url(sqlite_file: str, alias: str): #return the string for url entry for a specified alias
-    db = sqlite3.connect(sqlite_file)
+def get_url(sqlite_file: str, alias: str):
+    # returns (url, expiration_timestamp of expires_at) for alias, or None if
+    # it doesn't exist or has expired. expired rows are left for the sweeper
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
-    
+
     try:
-        sql = "SELECT * FROM urls WHERE alias = ?"
-        cursor.execute(sql, (alias,))
+        sql = """
+        SELECT url, expires_at FROM urls
+        WHERE alias = ? AND (expires_at IS NULL OR expires_at > ?)
+        """
+        cursor.execute(sql, (alias, _now_expires_at()))
         result = cursor.fetchone()
-
-        #delete the entry if it has been stored for over a year
-        if not result or maybe_delete_expired_url(sqlite_file, result):
+        if result is None:
             return None
-        else:
-            return result[1]
+        return result[0], expiration_timestamp(result[1])
     except Exception:
         logger.exception("Getting url had an error")
         return None
 
+def get_all_aliases(sqlite_file, chunk_size=10000):
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("SELECT alias FROM urls")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+    finally:
+        cursor.close()
+
+def iter_url_rows(sqlite_file, chunk_size=1000):
+    # yields lists of up to chunk_size EXPORT_COLUMNS tuples, in id order.
+    # the rows come from one read transaction on a connection of their own,
+    # so the dump is consistent and a caller can resume the generator from
+    # any thread. in WAL mode writers carry on while it is open
+    db = open_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("BEGIN")
+        cursor.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM urls ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+        db.close()
+
+def iter_click_rows(sqlite_file, chunk_size=1000):
+    # yields lists of up to chunk_size (alias, minute, clicks) tuples from
+    # one read transaction, like iter_url_rows
+    db = open_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT alias, minute, clicks FROM url_clicks ORDER BY alias, minute")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+        db.close()
+
+def get_urls_for_aliases(sqlite_file, aliases, chunk_size=500):
+    # returns {alias: (url, expiration timestamp)} for the aliases that
+    # exist and haven't expired, like get_url
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+    urls = {}
+    now = _now_expires_at()
+
+    try:
+        for start in range(0, len(aliases), chunk_size):
+            chunk = aliases[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(
+                f"""
+                SELECT alias, url, expires_at FROM urls
+                WHERE alias IN ({placeholders}) AND (expires_at IS NULL OR expires_at > ?)
+                """,
+                chunk + [now],
+            )
+            for alias, url, expires_at in cursor.fetchall():
+                urls[alias] = (url, expiration_timestamp(expires_at))
+    except Exception:
+        logger.exception("Getting urls for aliases had an error")
+    finally:
+        cursor.close()
+    return urls
+
+def get_most_used(sqlite_file, limit: int):
+    # returns (alias, used) of the limit most used aliases, most used first
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("SELECT alias, used FROM urls ORDER BY used DESC LIMIT ?", (limit,))
+        return cursor.fetchall()
+    except Exception:
+        logger.exception("Getting most used aliases had an error")
+        return []
+    finally:
+        cursor.close()
+
+def get_most_used_aliases(sqlite_file, limit: int):
+    return [alias for alias, _ in get_most_used(sqlite_file, limit)]
+
 def delete_url(sqlite_file: str, alias: str): #delete entry in the database from specified alias
-    db = sqlite3.connect(sqlite_file)
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
 
     try:
         sql = "DELETE FROM urls WHERE alias = ?"
-        cursor.execute(sql, (alias, ))
-        db.commit()
+        with db:
+            cursor.execute(sql, (alias, ))
 
         return cursor.rowcount > 0
     except Exception:
         logger.exception("Deleting url had an error")
         return False
     
-def maybe_delete_expired_url(sqlite_file, sqlite_row) -> bool: #returns True if url expired and deleted, otherwise False
-    db = sqlite3.connect(sqlite_file)
+def delete_expired_urls(sqlite_file, limit):
+    # deletes up to limit urls whose expires_at has passed, soonest expired
+    # first, in one transaction. returns their aliases
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
 
-    expiration_datetime = None
-    # sqlite_row[5] represents the expiration datetime e.g., "2024-11-04 18:05:24.006593"
-    if sqlite_row[5] is not None:
-        expiration_datetime = datetime.strptime(sqlite_row[5], "%Y-%m-%d %H:%M:%S.%f")
-        expiration_datetime = expiration_datetime.replace(tzinfo=expiration_date_timezone)
-
-    now = datetime.now(expiration_date_timezone)
-    if expiration_datetime is not None and expiration_datetime < now:
-        sql = "DELETE FROM urls WHERE alias = ?"
-        cursor.execute(sql, (sqlite_row[2], ))
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            "SELECT alias FROM urls WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+            (_now_expires_at(), limit),
+        )
+        aliases = [row[0] for row in cursor.fetchall()]
+        cursor.executemany("DELETE FROM urls WHERE alias = ?", ((alias,) for alias in aliases))
         db.commit()
-        return True
-    else:
-        return False
-    
+        return aliases
+    except Exception:
+        db.rollback()
+        logger.exception("Deleting expired urls had an error")
+        return []
+    finally:
+        cursor.close()
+
+# (sqlite file, search term) -> (time the count expires, count)
+_search_counts = OrderedDict()
+_search_counts_lock = threading.Lock()
+
 def get_number_of_entries(sqlite_file, search=None):
-    db = sqlite3.connect(sqlite_file)
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
 
     count = 0
     try:
-        if search:
-            sql = f"""
-            SELECT COUNT(*) FROM urls 
-            WHERE LOWER(alias) LIKE LOWER('%{search}%') 
-            OR LOWER(url) LIKE LOWER('%{search}%')
-            """
-        else:
-            sql = "SELECT COUNT(*) FROM urls"
+        if not search:
+            cursor.execute("SELECT value FROM url_counts WHERE name = 'urls'")
+            result = cursor.fetchone()
+            return result[0] if result is not None else 0
+
+        # a search count still has to visit every match, so it is reused
+        # for a few seconds while the user pages through the results
+        key = (sqlite_file, search.lower())
+        with _search_counts_lock:
+            cached = _search_counts.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
 
-        cursor.execute(sql)
+        where, params = _search_filter(sqlite_file, search)
+        cursor.execute(f"SELECT COUNT(*) FROM urls {where}", params)
         result = cursor.fetchone()
         count = result[0]
+        with _search_counts_lock:
+            _search_counts[key] = (time.monotonic() + args.search_count_ttl, count)
+            _search_counts.move_to_end(key)
+            if len(_search_counts) > SEARCH_COUNT_CACHE_SIZE:
+                _search_counts.popitem(last=False)
     except Exception as e:
         logger.exception("Couldn't get number of urls: " + str(e))
     finally:
         cursor.close()
-        db.close()
     return count
 
+def get_urls_page(
+    sqlite_file,
+    page=0,
+    search=None,
+    sort_by="created_at",
+    order="DESC",
+    cursor=None,
+    limit=ROWS_PER_PAGE,
+    after=None,
+):
+    # returns (urls, total) for /list, read from one snapshot of the database
+    db = get_connection(sqlite_file)
+    db.execute("BEGIN")
+    try:
+        urls = get_urls(
+            sqlite_file,
+            page,
+            search=search,
+            sort_by=sort_by,
+            order=order,
+            cursor=cursor,
+            limit=limit,
+            after=after,
+        )
+        total = get_number_of_entries(sqlite_file, search=search)
+        return urls, total
+    finally:
+        db.commit()
+
 def increment_used_column(sqlite_file, alias: str, count=1):
-    db = sqlite3.connect(sqlite_file)
+    db = get_connection(sqlite_file)
     cursor = db.cursor()
     
     try:
         sql = "UPDATE urls SET used = used + ? WHERE alias = ?"
         logging.debug(f"incrementing the used column alias {alias} by {count}")
-        cursor.execute(sql, (count, alias))
-        db.commit()
+        with db:
+            cursor.execute(sql, (count, alias))
     except Exception:
         logger.exception(f"Couldn't update the used column for alias {alias}: ")
+    finally:
+        cursor.close()
+
+def increment_used_columns(sqlite_file, counts, threshold=None, clicks=None):
+    # counts maps alias -> number of hits, all rows are updated in one
+    # transaction, along with clicks, which maps (alias, minute) -> hits in
+    # that minute. returns the aliases whose used count reached threshold
+    # with this update, or None if the update failed
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        # the write lock is taken first so the counts read below are the
+        # ones being updated
+        cursor.execute("BEGIN IMMEDIATE")
+        crossed = []
+        if threshold is not None:
+            aliases = list(counts)
+            for start in range(0, len(aliases), 500):
+                chunk = aliases[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT alias, used FROM urls WHERE used < ? AND alias IN ({placeholders})",
+                    [threshold, *chunk],
+                )
+                crossed.extend(
+                    alias for alias, used in cursor.fetchall()
+                    if used + counts[alias] >= threshold
+                )
+        sql = "UPDATE urls SET used = used + ? WHERE alias = ?"
+        cursor.executemany(sql, ((count, alias) for alias, count in counts.items()))
+        if clicks:
+            # hits queued before a /delete are written after its trigger
+            # cleared url_clicks, and must not bring the alias's clicks back
+            cursor.executemany(
+                """
+                INSERT INTO url_clicks(alias, minute, clicks)
+                SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM urls WHERE alias = ?)
+                ON CONFLICT(alias, minute) DO UPDATE SET clicks = clicks + excluded.clicks
+                """,
+                (
+                    (alias, minute, count, alias)
+                    for (alias, minute), count in clicks.items()
+                ),
+            )
+        db.commit()
+        return crossed
+    except Exception:
         db.rollback()
+        logger.exception(f"Couldn't update the used column for {len(counts)} aliases: ")
+        return None
+    finally:
+        cursor.close()
+
+def get_clicks(sqlite_file, alias, start_minute, end_minute, bucket_minutes=1):
+    # returns [(first minute of bucket, clicks)] of the buckets with clicks
+    # between start_minute inclusive and end_minute exclusive, or None if
+    # the alias doesn't exist
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT 1 FROM urls WHERE alias = ?", (alias,))
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute(
+            """
+            SELECT minute / ? * ? AS bucket, SUM(clicks) FROM url_clicks
+            WHERE alias = ? AND minute >= ? AND minute < ?
+            GROUP BY bucket ORDER BY bucket
+            """,
+            (bucket_minutes, bucket_minutes, alias, start_minute, end_minute),
+        )
+        return cursor.fetchall()
+    finally:
+        db.commit()
+        cursor.close()
+
+def delete_clicks_before(sqlite_file, minute):
+    # drops the click buckets older than minute, returns how many
+    db = get_connection(sqlite_file)
+    cursor = db.cursor()
+
+    try:
+        with db:
+            cursor.execute("DELETE FROM url_clicks WHERE minute < ?", (minute,))
+        return cursor.rowcount
+    except Exception:
+        logger.exception("Couldn't delete old click buckets")
+        return 0
     finally:
         cursor.close()
-        db.close()
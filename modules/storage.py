@@ -0,0 +1,327 @@
+from collections import Counter
+import heapq
+import itertools
+import os
+import zlib
+
+import modules.sqlite_helpers as sqlite_helpers
+
+
+def shard_paths(sqlite_file, shards):
+    # urls.db stays urls.db unsharded, and becomes urls-0.db ... urls-3.db
+    # with 4 shards, so a database is never mistaken for one of its shards
+    if shards == 1:
+        return [sqlite_file]
+    root, extension = os.path.splitext(sqlite_file)
+    return [f"{root}-{shard}{extension}" for shard in range(shards)]
+
+
+def open_storage(sqlite_file, shards=1):
+    if shards == 1:
+        return SQLiteStorage(sqlite_file)
+    return ShardedSQLiteStorage(shard_paths(sqlite_file, shards))
+
+
+class SQLiteStorage:
+    """
+    the urls table in one sqlite file. every method is the sqlite_helpers
+    function of the same name for that file, so they block and belong on
+    the db pool
+    """
+
+    def __init__(self, sqlite_file):
+        self.sqlite_file = sqlite_file
+
+    def maybe_create_table(self) -> bool:
+        return sqlite_helpers.maybe_create_table(self.sqlite_file)
+
+    def insert_url(self, url, alias, expiration_date):
+        return sqlite_helpers.insert_url(self.sqlite_file, url, alias, expiration_date)
+
+    def insert_urls(self, rows):
+        return sqlite_helpers.insert_urls(self.sqlite_file, rows)
+
+    def import_urls(self, rows):
+        # (number of rows inserted, rows whose transaction failed)
+        inserted = sqlite_helpers.import_urls(self.sqlite_file, rows)
+        if inserted is None:
+            return 0, list(rows)
+        return inserted, []
+
+    def import_clicks(self, rows):
+        # like import_urls, for (alias, minute, clicks) rows
+        inserted = sqlite_helpers.import_clicks(self.sqlite_file, rows)
+        if inserted is None:
+            return 0, list(rows)
+        return inserted, []
+
+    def reserve_alias_block(self, block_size):
+        return sqlite_helpers.reserve_alias_block(self.sqlite_file, block_size)
+
+    def get_alias_counter(self):
+        return sqlite_helpers.get_alias_counter(self.sqlite_file)
+
+    def set_alias_counter(self, next_id, key):
+        sqlite_helpers.set_alias_counter(self.sqlite_file, next_id, key)
+
+    def get_url(self, alias):
+        return sqlite_helpers.get_url(self.sqlite_file, alias)
+
+    def get_urls_page(self, page=0, search=None, sort_by="created_at", order="DESC", cursor=None):
+        return sqlite_helpers.get_urls_page(
+            self.sqlite_file, page, search=search, sort_by=sort_by, order=order, cursor=cursor
+        )
+
+    def get_all_aliases(self):
+        return sqlite_helpers.get_all_aliases(self.sqlite_file)
+
+    def iter_url_rows(self, chunk_size):
+        return sqlite_helpers.iter_url_rows(self.sqlite_file, chunk_size)
+
+    def iter_click_rows(self, chunk_size):
+        return sqlite_helpers.iter_click_rows(self.sqlite_file, chunk_size)
+
+    def get_urls_for_aliases(self, aliases):
+        return sqlite_helpers.get_urls_for_aliases(self.sqlite_file, aliases)
+
+    def get_most_used_aliases(self, limit):
+        return sqlite_helpers.get_most_used_aliases(self.sqlite_file, limit)
+
+    def delete_url(self, alias):
+        return sqlite_helpers.delete_url(self.sqlite_file, alias)
+
+    def delete_expired_urls(self, limit):
+        return sqlite_helpers.delete_expired_urls(self.sqlite_file, limit)
+
+    def get_number_of_entries(self, search=None):
+        return sqlite_helpers.get_number_of_entries(self.sqlite_file, search=search)
+
+    def get_clicks(self, alias, start_minute, end_minute, bucket_minutes=1):
+        return sqlite_helpers.get_clicks(
+            self.sqlite_file, alias, start_minute, end_minute, bucket_minutes
+        )
+
+    def delete_clicks_before(self, minute):
+        return sqlite_helpers.delete_clicks_before(self.sqlite_file, minute)
+
+    def increment_used_columns(self, counts, threshold=None, clicks=None):
+        # returns (aliases that reached threshold, counts that weren't written).
+        # clicks are written with counts, so they're unwritten when it is
+        crossed = sqlite_helpers.increment_used_columns(
+            self.sqlite_file, counts, threshold=threshold, clicks=clicks
+        )
+        if crossed is None:
+            return [], dict(counts)
+        return crossed, {}
+
+
+class ShardedSQLiteStorage:
+    """
+    the urls table spread across several sqlite files by a hash of the
+    alias, so writes to different shards don't wait on one write lock.
+    lookups by alias go to a single shard, /list merges the pages of every
+    shard. the alias counter lives in the first shard. ids are only unique
+    within a shard, so rows are given id * shards + shard, which also
+    breaks sort ties across shards the same way in every request.
+    transactions don't span shards: bulk writes commit per shard, and
+    exports read each shard from its own snapshot
+    """
+
+    def __init__(self, sqlite_files):
+        self.sqlite_files = sqlite_files
+        self.shards = len(sqlite_files)
+
+    def shard_for(self, alias) -> int:
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(alias.encode()) % self.shards
+
+    def _file_for(self, alias):
+        return self.sqlite_files[self.shard_for(alias)]
+
+    def _group_by_shard(self, items, alias_of):
+        # {shard: [(index in items, item)]}
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(self.shard_for(alias_of(item)), []).append((i, item))
+        return groups
+
+    def maybe_create_table(self) -> bool:
+        created = True
+        for shard, sqlite_file in enumerate(self.sqlite_files):
+            created = sqlite_helpers.maybe_create_table(sqlite_file) and created
+            sqlite_helpers.check_shard(sqlite_file, shard, self.shards)
+        return created
+
+    def insert_url(self, url, alias, expiration_date):
+        return sqlite_helpers.insert_url(self._file_for(alias), url, alias, expiration_date)
+
+    def insert_urls(self, rows):
+        # like sqlite_helpers.insert_urls, except that when one shard's
+        # transaction fails only its rows get False, the others are committed
+        results = [None] * len(rows)
+        for shard, group in self._group_by_shard(rows, lambda row: row[1]).items():
+            created = sqlite_helpers.insert_urls(
+                self.sqlite_files[shard], [row for _, row in group]
+            )
+            for position, (i, _) in enumerate(group):
+                results[i] = False if created is None else created[position]
+        return results
+
+    def import_urls(self, rows):
+        # like SQLiteStorage.import_urls. when one shard's transaction fails
+        # only its rows are returned as failed, the others are committed
+        imported = 0
+        failed_rows = []
+        for shard, group in self._group_by_shard(rows, lambda row: row[1]).items():
+            shard_rows = [row for _, row in group]
+            inserted = sqlite_helpers.import_urls(self.sqlite_files[shard], shard_rows)
+            if inserted is None:
+                failed_rows += shard_rows
+            else:
+                imported += inserted
+        return imported, failed_rows
+
+    def import_clicks(self, rows):
+        # like import_urls, for (alias, minute, clicks) rows
+        imported = 0
+        failed_rows = []
+        for shard, group in self._group_by_shard(rows, lambda row: row[0]).items():
+            shard_rows = [row for _, row in group]
+            inserted = sqlite_helpers.import_clicks(self.sqlite_files[shard], shard_rows)
+            if inserted is None:
+                failed_rows += shard_rows
+            else:
+                imported += inserted
+        return imported, failed_rows
+
+    def reserve_alias_block(self, block_size):
+        return sqlite_helpers.reserve_alias_block(self.sqlite_files[0], block_size)
+
+    def get_alias_counter(self):
+        return sqlite_helpers.get_alias_counter(self.sqlite_files[0])
+
+    def set_alias_counter(self, next_id, key):
+        sqlite_helpers.set_alias_counter(self.sqlite_files[0], next_id, key)
+
+    def get_url(self, alias):
+        return sqlite_helpers.get_url(self._file_for(alias), alias)
+
+    def _shard_after(self, after, shard, sort_by, order):
+        # turns (sort value, global id) of the last row seen into the
+        # (sort value, shard id) bound that skips the same rows in shard
+        sort_value, last_id = after
+        if order == "DESC":
+            # the lowest shard id whose global id isn't below last_id
+            bound = -((shard - last_id) // self.shards)
+        else:
+            bound = (last_id - shard) // self.shards
+        return (bound, bound) if sort_by == "id" else (sort_value, bound)
+
+    def get_urls_page(self, page=0, search=None, sort_by="created_at", order="DESC", cursor=None):
+        # every shard returns its first rows after the cursor, or its first
+        # page * ROWS_PER_PAGE + ROWS_PER_PAGE rows without one, and the
+        # merge of them is cut down to the requested page
+        after = None
+        offset = page * sqlite_helpers.ROWS_PER_PAGE
+        if cursor is not None:
+            after = sqlite_helpers.decode_cursor(cursor, sort_by, order)
+            offset = 0
+        limit = offset + sqlite_helpers.ROWS_PER_PAGE
+        pages = []
+        total = 0
+        for shard, sqlite_file in enumerate(self.sqlite_files):
+            urls, count = sqlite_helpers.get_urls_page(
+                sqlite_file,
+                search=search,
+                sort_by=sort_by,
+                order=order,
+                limit=limit,
+                after=None if after is None else self._shard_after(after, shard, sort_by, order),
+            )
+            for url in urls:
+                url["id"] = url["id"] * self.shards + shard
+            pages.append(urls)
+            total += count
+        merged = heapq.merge(
+            *pages, key=lambda url: (url[sort_by], url["id"]), reverse=order == "DESC"
+        )
+        return list(itertools.islice(merged, offset, limit)), total
+
+    def get_all_aliases(self):
+        for sqlite_file in self.sqlite_files:
+            yield from sqlite_helpers.get_all_aliases(sqlite_file)
+
+    def iter_url_rows(self, chunk_size):
+        for sqlite_file in self.sqlite_files:
+            yield from sqlite_helpers.iter_url_rows(sqlite_file, chunk_size)
+
+    def iter_click_rows(self, chunk_size):
+        for sqlite_file in self.sqlite_files:
+            yield from sqlite_helpers.iter_click_rows(sqlite_file, chunk_size)
+
+    def get_urls_for_aliases(self, aliases):
+        urls = {}
+        for shard, group in self._group_by_shard(aliases, lambda alias: alias).items():
+            urls.update(sqlite_helpers.get_urls_for_aliases(
+                self.sqlite_files[shard], [alias for _, alias in group]
+            ))
+        return urls
+
+    def get_most_used_aliases(self, limit):
+        most_used = heapq.merge(
+            *(sqlite_helpers.get_most_used(sqlite_file, limit) for sqlite_file in self.sqlite_files),
+            key=lambda row: row[1],
+            reverse=True,
+        )
+        return [alias for alias, _ in itertools.islice(most_used, limit)]
+
+    def delete_url(self, alias):
+        return sqlite_helpers.delete_url(self._file_for(alias), alias)
+
+    def delete_expired_urls(self, limit):
+        # up to limit from each shard
+        return [
+            alias
+            for sqlite_file in self.sqlite_files
+            for alias in sqlite_helpers.delete_expired_urls(sqlite_file, limit)
+        ]
+
+    def get_number_of_entries(self, search=None):
+        return sum(
+            sqlite_helpers.get_number_of_entries(sqlite_file, search=search)
+            for sqlite_file in self.sqlite_files
+        )
+
+    def get_clicks(self, alias, start_minute, end_minute, bucket_minutes=1):
+        return sqlite_helpers.get_clicks(
+            self._file_for(alias), alias, start_minute, end_minute, bucket_minutes
+        )
+
+    def delete_clicks_before(self, minute):
+        return sum(
+            sqlite_helpers.delete_clicks_before(sqlite_file, minute)
+            for sqlite_file in self.sqlite_files
+        )
+
+    def increment_used_columns(self, counts, threshold=None, clicks=None):
+        # one transaction per shard. the counts of a shard whose transaction
+        # failed are handed back, the other shards' are written
+        crossed = []
+        unwritten = {}
+        shard_clicks = {}
+        for (alias, minute), count in (clicks or {}).items():
+            shard_clicks.setdefault(self.shard_for(alias), {})[alias, minute] = count
+        groups = self._group_by_shard(list(counts), lambda alias: alias)
+        for shard, group in groups.items():
+            shard_counts = Counter({alias: counts[alias] for _, alias in group})
+            shard_crossed = sqlite_helpers.increment_used_columns(
+                self.sqlite_files[shard],
+                shard_counts,
+                threshold=threshold,
+                clicks=shard_clicks.get(shard),
+            )
+            if shard_crossed is None:
+                unwritten.update(shard_counts)
+            else:
+                crossed.extend(shard_crossed)
+        return crossed, unwritten
@@ -0,0 +1,182 @@
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+
+import modules.ndjson as ndjson
+import modules.sqlite_helpers as sqlite_helpers
+
+logger = logging.getLogger(__name__)
+
+# rows read or written per sqlite round trip by /export, /import and reshard
+TRANSFER_CHUNK_SIZE = 1000
+# format created_at is stored in
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class Throughput:
+    def __init__(self):
+        self.rows = 0
+        self.start = time.monotonic()
+
+    def summary(self) -> dict:
+        seconds = time.monotonic() - self.start
+        return {
+            "rows": self.rows,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds) if seconds > 0 else 0,
+        }
+
+
+def format_rows(rows) -> str:
+    # rows from sqlite_helpers.iter_url_rows as newline delimited JSON
+    return "".join(
+        json.dumps(dict(zip(sqlite_helpers.EXPORT_COLUMNS, row))) + "\n" for row in rows
+    )
+
+
+def _timestamp(value):
+    # accepts any ISO 8601 timestamp and stores it the way insert_url does
+    return datetime.fromisoformat(value).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_row(item):
+    # returns an EXPORT_COLUMNS tuple for sqlite_helpers.import_urls. raises
+    # KeyError for a missing url or alias, ValueError or TypeError otherwise
+    if isinstance(item, json.JSONDecodeError):
+        raise ValueError(f"invalid JSON: {item}")
+    if not isinstance(item, dict):
+        raise ValueError("item is not a JSON object")
+    url = item["url"]
+    alias = item["alias"]
+    if not isinstance(url, str):
+        raise ValueError("url must be a string")
+    if not isinstance(alias, str) or not alias.isalnum():
+        raise ValueError("alias must only contain alphanumeric characters")
+    created_at = item.get("created_at")
+    created_at = (
+        datetime.now().strftime(TIMESTAMP_FORMAT)
+        if created_at is None
+        else _timestamp(created_at)
+    )
+    expires_at = item.get("expires_at")
+    if expires_at is not None:
+        # converted like a /create_url expiration_date, offsets included
+        expires_at = sqlite_helpers.format_expiration_date(expires_at)
+    used = item.get("used", 1)
+    if not isinstance(used, int) or isinstance(used, bool):
+        raise ValueError("used must be an integer")
+    return (url, alias, created_at, expires_at, used)
+
+
+class Importer:
+    """
+    validates exported rows and inserts them chunk_size at a time, each
+    chunk in its own transaction. rows whose alias already exists are
+    skipped, so an import can be rerun after it was cut off
+    """
+
+    def __init__(self, storage, chunk_size=TRANSFER_CHUNK_SIZE):
+        self.storage = storage
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.throughput = Throughput()
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.failed = 0
+
+    def add(self, item) -> bool:
+        # returns True once a full chunk is waiting for flush()
+        self.throughput.rows += 1
+        try:
+            self.rows.append(parse_row(item))
+        except (KeyError, ValueError, TypeError) as e:
+            self.invalid += 1
+            logger.debug(f"skipping invalid import row {self.throughput.rows}: {e}")
+        return len(self.rows) >= self.chunk_size
+
+    def flush(self):
+        # inserts the pending rows, returns the aliases of the rows that
+        # now exist in sqlite
+        rows, self.rows = self.rows, []
+        if not rows:
+            return []
+        inserted, failed_rows = self.storage.import_urls(rows)
+        self.imported += inserted
+        self.failed += len(failed_rows)
+        self.skipped += len(rows) - len(failed_rows) - inserted
+        failed_aliases = {alias for _, alias, _, _, _ in failed_rows}
+        return [alias for _, alias, _, _, _ in rows if alias not in failed_aliases]
+
+    def summary(self) -> dict:
+        return {
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "invalid": self.invalid,
+            "failed": self.failed,
+            **self.throughput.summary(),
+        }
+
+
+def _open(path, mode):
+    # "-" means stdout or stdin, which are left open
+    if path == "-":
+        stream = sys.stdout if "w" in mode else sys.stdin
+        return open(stream.fileno(), mode, closefd=False)
+    return open(path, mode)
+
+
+def export_to_file(storage, path) -> dict:
+    throughput = Throughput()
+    with _open(path, "w") as export_file:
+        for rows in storage.iter_url_rows(TRANSFER_CHUNK_SIZE):
+            export_file.write(format_rows(rows))
+            throughput.rows += len(rows)
+    return throughput.summary()
+
+
+def reshard(source, target) -> dict:
+    # copies every url, its clicks and the alias counter from one storage to
+    # another, e.g. a single file database to a sharded one. urls and click
+    # counts already in target are skipped, so a reshard can be rerun after
+    # it was cut off
+    next_id, key = source.get_alias_counter()
+    target.set_alias_counter(next_id, key)
+    throughput = Throughput()
+    copied = 0
+    failed = 0
+    for rows in source.iter_url_rows(TRANSFER_CHUNK_SIZE):
+        throughput.rows += len(rows)
+        inserted, failed_rows = target.import_urls(rows)
+        copied += inserted
+        failed += len(failed_rows)
+    # after the urls, since clicks are only copied for urls in target
+    click_rows = 0
+    clicks_copied = 0
+    clicks_failed = 0
+    for rows in source.iter_click_rows(TRANSFER_CHUNK_SIZE):
+        click_rows += len(rows)
+        inserted, failed_rows = target.import_clicks(rows)
+        clicks_copied += inserted
+        clicks_failed += len(failed_rows)
+    return {
+        "copied": copied,
+        "skipped": throughput.rows - copied - failed,
+        "failed": failed,
+        "clicks_copied": clicks_copied,
+        "clicks_skipped": click_rows - clicks_copied - clicks_failed,
+        "clicks_failed": clicks_failed,
+        **throughput.summary(),
+    }
+
+
+def import_from_file(storage, path) -> dict:
+    importer = Importer(storage)
+    with _open(path, "rb") as import_file:
+        for line in import_file:
+            if line.strip() and importer.add(ndjson.parse_line(line)):
+                importer.flush()
+    importer.flush()
+    return importer.summary()
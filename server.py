@@ -1,27 +1,49 @@
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from fastapi import FastAPI, Request, HTTPException, Response
-from fastapi.responses import RedirectResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, HTTPException, Response, Query
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import json
 import logging
+import os
+import sys
 import time
-import prometheus_client
 import uvicorn
-from queue import Queue
-from threading import Thread
 
 from modules.args import get_args
-from modules.generate_alias import generate_alias
+from modules.generate_alias import AliasAllocator
+import modules.ndjson as ndjson
 import modules.sqlite_helpers as sqlite_helpers
+from modules.storage import open_storage
+import modules.transfer as transfer
 from modules.constants import HttpResponse, http_code_to_enum
 from modules.metrics import MetricsHandler
-from modules.sqlite_helpers import increment_used_column
 from modules.cache import Cache
-from modules.qr_code import QRCode
+from modules.cache_warmer import CacheWarmer
+from modules.executors import BoundedExecutor, SingleFlight
+from modules.expiry_sweeper import ExpirySweeper
+from modules.fast_find import FAST_FIND_MISSED, FastFindApp
+from modules.hit_aggregator import HitAggregator
+from modules.hit_log import HitLog
+from modules.http_metrics import HttpMetricsMiddleware
+from modules.negative_cache import BloomFilter, NegativeCache
+from modules.qr_code import (
+    QR_CODE_CACHE_CONTROL,
+    QR_CODE_FORMATS,
+    QR_CODE_MAX_SCALE,
+    QR_CODE_SCALE,
+    QRCode,
+)
+from modules.qr_prerender import QRPrerenderer
+from modules.shared_cache import SharedMemoryCache
 
 
 app = FastAPI()
 args = get_args()
-alias_queue = Queue()
+# number of /create_urls items inserted per transaction
+BULK_CHUNK_SIZE = 500
+# times a url gets a new generated alias because the last one was taken
+MAX_GENERATED_ALIAS_ATTEMPTS = 5
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,53 +51,201 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# counts response codes and times requests by route template
+app.add_middleware(HttpMetricsMiddleware)
+
+if args.cache_backend == "shared":
+    cache = SharedMemoryCache(
+        args.shared_cache_path, args.cache_size, args.shared_cache_max_url_length
+    )
+else:
+    cache = Cache(args.cache_size, shards=args.cache_shards, max_bytes=args.cache_max_bytes)
+negative_cache = NegativeCache(
+    args.negative_cache_size,
+    args.negative_cache_ttl,
+    bloom_filter=(
+        BloomFilter(args.bloom_filter_capacity, args.bloom_filter_error_rate)
+        if args.bloom_filter_capacity > 0
+        else None
+    ),
+)
 
-cache = Cache(args.cache_size)
+# sqlite queries and qr code rendering block, so they run on separate
+# pools. a burst of qr renders then can't hold up /find lookups
+db_executor = BoundedExecutor("db", args.db_pool_size, args.executor_max_queue_size)
+cpu_executor = BoundedExecutor("cpu", args.cpu_pool_size, args.executor_max_queue_size)
 
 # maybe create the table if it doesnt already exist
 DATABASE_FILE = args.database_file_path
-sqlite_helpers.maybe_create_table(DATABASE_FILE)
+storage = open_storage(DATABASE_FILE, args.database_shards)
+storage.maybe_create_table()
+alias_allocator = AliasAllocator(
+    storage,
+    length=args.alias_length,
+    block_size=args.alias_block_size,
+    obfuscate=not args.disable_alias_obfuscation,
+)
 qr_code_cache = QRCode(
   base_url=args.qr_code_base_url,
   qr_cache_path=args.qr_code_cache_path,
   max_size=args.qr_code_cache_size,
-  cache_state_file=args.qr_code_cache_state_file,
+  index_file=(
+    args.qr_code_cache_state_file
+    or os.path.join(args.qr_code_cache_path, "qr_code_index.db")
+  ),
+  max_bytes=args.qr_code_cache_max_bytes,
   qr_image_path=args.qr_code_center_image_path,
+  render_processes=args.qr_render_processes,
+  max_memory_bytes=args.qr_code_memory_cache_bytes,
+)
+# concurrent /qr requests for one uncached alias share a single render
+qr_renders = SingleFlight("qr_render")
+cache_warmer = CacheWarmer(
+    cache,
+    storage,
+    snapshot_file=args.cache_snapshot_file,
+    warmup_size=args.cache_warmup_size,
+)
+qr_prerenderer = QRPrerenderer(
+    qr_code_cache,
+    rate=args.qr_prerender_rate,
+    cpu_budget=args.qr_prerender_cpu_budget,
+    max_queue_size=args.qr_prerender_queue_size,
+)
+# opened by hit_aggregator.start(), so only the server process maps it
+hit_log = HitLog(
+    args.hit_log_path or f"{DATABASE_FILE}.hits",
+    args.hit_log_size,
+    overflow_policy=args.hit_log_overflow,
+    block_timeout=args.hit_log_block_timeout,
 )
+hit_aggregator = HitAggregator(
+    hit_log,
+    storage,
+    max_batch_size=args.hit_flush_batch_size,
+    flush_interval=args.hit_flush_interval,
+    used_threshold=(
+        args.qr_prerender_used_threshold
+        if qr_prerenderer.enabled and args.qr_prerender_used_threshold > 0
+        else None
+    ),
+    on_used_threshold=lambda alias: qr_prerenderer.submit(alias, "trending"),
+    click_retention=(
+        args.click_retention_days * 24 * 60 * 60 if args.click_retention_days > 0 else None
+    ),
+)
+
+
+
+
+async def queue_hit(alias):
+    with MetricsHandler.find_stage_seconds.labels("enqueue").time():
+        await hit_aggregator.add(alias)
+
+
+# uvicorn serves this instead of app with --fast-find
+fast_app = FastFindApp(app, cache, on_hit=queue_hit)
 
 
-# middleware to get metrics on HTTP response codes
-@app.middleware("http")
-async def track_response_codes(request: Request, call_next):
-    response = await call_next(request)
-    status_code = response.status_code
-    MetricsHandler.http_code.labels(request.url.path, status_code).inc()
-    return response
+def forget_alias(alias):
+    # drops a deleted or expired alias from everything that remembers it
+    qr_prerenderer.discard(alias)
+    qr_code_cache.delete(alias)
+    cache_warmer.discard(alias)
+    cache.delete(alias)
+    negative_cache.remove_alias(alias)
+
+
+expiry_sweeper = ExpirySweeper(
+    storage,
+    on_expired=forget_alias,
+    interval=args.expiry_sweep_interval,
+    batch_size=args.expiry_sweep_batch_size,
+)
+
+
+def resolve_alias(urljson):
+    # returns the requested alias, or None if one should be generated.
+    # raises KeyError if the alias is missing while random aliases are
+    # disabled and ValueError if the alias isn't alphanumeric
+    alias = urljson.get("alias")
+    if alias is None:
+        if args.disable_random_alias:
+            raise KeyError("alias must be specified")
+        return None
+    if not isinstance(alias, str) or not alias.isalnum():
+        raise ValueError("alias must only contain alphanumeric characters")
+    return alias
+
+
+def insert_url_with_alias(url, alias, expiration_date):
+    # runs on the db pool. returns (alias, created_at), where created_at is
+    # None if the alias is taken. an alias of None is generated, and a
+    # generated alias that collides with a custom one is replaced instead of
+    # being reported as a conflict
+    if alias is not None:
+        return alias, storage.insert_url(url, alias, expiration_date)
+    for _ in range(MAX_GENERATED_ALIAS_ATTEMPTS):
+        alias = alias_allocator.allocate()
+        created_at = storage.insert_url(url, alias, expiration_date)
+        if created_at is not None:
+            return alias, created_at
+        logging.warning(f"generated alias {alias} is taken, generating another")
+    return alias, None
+
+
+def insert_bulk_rows(rows):
+    # runs on the db pool. insert_url_with_alias for a list of
+    # (url, alias, expiration_date) rows, in one storage.insert_urls call
+    # per attempt. returns the rows with their final aliases
+    # and the insert_urls result for them
+    generated = [alias is None for _, alias, _ in rows]
+    rows = [
+        (url, alias_allocator.allocate() if alias is None else alias, expiration_date)
+        for url, alias, expiration_date in rows
+    ]
+    created = storage.insert_urls(rows)
+    for _ in range(MAX_GENERATED_ALIAS_ATTEMPTS - 1):
+        if created is None:
+            break
+        retry = [
+            i for i, created_at in enumerate(created)
+            if created_at is None and generated[i]
+        ]
+        if not retry:
+            break
+        for i in retry:
+            url, alias, expiration_date = rows[i]
+            logging.warning(f"generated alias {alias} is taken, generating another")
+            rows[i] = (url, alias_allocator.allocate(), expiration_date)
+        retried = storage.insert_urls([rows[i] for i in retry])
+        if retried is None:
+            break
+        for i, created_at in zip(retry, retried):
+            created[i] = created_at
+    return rows, created
 
 
 @app.post("/create_url")
 async def create_url(request: Request):
     urljson = await request.json()
     logging.debug(f"/create_url called with body: {urljson}")
-    alias = None
+    alias = urljson.get("alias")
 
     try:
-        alias = urljson.get("alias")
-        if alias is None:
-            if args.disable_random_alias:
-                raise KeyError("alias must be specified")
-            else:
-                alias = generate_alias(urljson["url"])
-        if not alias.isalnum():
-            raise ValueError("alias must only contain alphanumeric characters")
+        alias = resolve_alias(urljson)
         expiration_date = urljson.get("expiration_date")
 
         with MetricsHandler.query_time.labels("create").time():
-            response = sqlite_helpers.insert_url(
-                DATABASE_FILE, urljson["url"], alias, expiration_date
+            alias, response = await db_executor.run(
+                insert_url_with_alias,
+                urljson["url"],
+                alias,
+                expiration_date,
             )
             if response is not None:
-                MetricsHandler.url_count.inc(1)
+                negative_cache.add_alias(alias)
+                qr_prerenderer.submit(alias, "create")
                 return {
                     "url": urljson["url"],
                     "alias": alias,
@@ -92,12 +262,152 @@ async def create_url(request: Request):
         raise HTTPException(status_code=HttpResponse.INVALID_ARGUMENT_EXCEPTION.code)
 
 
+def validate_bulk_item(item):
+    # returns (row, None) with the (url, alias, expiration_date) row to
+    # insert, or (None, (status code, error)) to report for the item
+    if isinstance(item, json.JSONDecodeError):
+        return None, (HttpResponse.BAD_REQUEST.code, f"invalid JSON: {item}")
+    if not isinstance(item, dict):
+        return None, (HttpResponse.BAD_REQUEST.code, "item is not a JSON object")
+    try:
+        alias = resolve_alias(item)
+        url = item["url"]
+        expiration_date = item.get("expiration_date")
+        if expiration_date is not None:
+            datetime.fromisoformat(expiration_date)
+        return (url, alias, expiration_date), None
+    except KeyError as e:
+        return None, (HttpResponse.BAD_REQUEST.code, f"missing {e}")
+    except (ValueError, TypeError) as e:
+        return None, (HttpResponse.INVALID_ARGUMENT_EXCEPTION.code, str(e))
+
+
+async def chunk_bulk_items(request: Request):
+    # yields lists of up to BULK_CHUNK_SIZE (index, row, error) tuples
+    chunk = []
+    index = 0
+    async for item in ndjson.iter_json_items(request.stream()):
+        row, error = validate_bulk_item(item)
+        chunk.append((index, row, error))
+        index += 1
+        if len(chunk) == BULK_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def insert_bulk_chunk(chunk):
+    # inserts the valid rows of chunk in one transaction, returns one
+    # result per item
+    rows = [row for _, row, _ in chunk if row is not None]
+    created = []
+    if rows:
+        with MetricsHandler.query_time.labels("bulk_create").time():
+            rows, created = await db_executor.run(insert_bulk_rows, rows)
+    if created is None:
+        created = [False] * len(rows)
+    inserted = zip(rows, created)
+
+    results = []
+    for index, row, error in chunk:
+        if row is None:
+            status, message = error
+            results.append({"index": index, "status": status, "error": message})
+            continue
+        (url, alias, expiration_date), created_at = next(inserted)
+        if created_at is False:
+            status = HttpResponse.INTERNAL_SERVER_ERROR.code
+            results.append({"index": index, "alias": alias, "status": status})
+        elif created_at is None:
+            status = HttpResponse.CONFLICT.code
+            results.append({"index": index, "alias": alias, "status": status})
+        else:
+            negative_cache.add_alias(alias)
+            qr_prerenderer.submit(alias, "create")
+            results.append({
+                "index": index,
+                "status": HttpResponse.OK.code,
+                "url": url,
+                "alias": alias,
+                "created_at": created_at.isoformat(),
+                "expires_at": expiration_date,
+            })
+    return results
+
+
+@app.post("/create_urls")
+async def create_urls(request: Request):
+    # bulk /create_url. the body is a JSON array or newline delimited JSON of
+    # /create_url bodies. results stream back as newline delimited JSON in
+    # the same order, each with the item's index and its own status code
+    logging.debug("/create_urls called")
+
+    async def results():
+        async for chunk in chunk_bulk_items(request):
+            for result in await insert_bulk_chunk(chunk):
+                yield json.dumps(result) + "\n"
+
+    return ndjson.NDJSONStreamingResponse(results())
+
+
+@app.get("/export")
+async def export_urls():
+    # every url as newline delimited JSON, read from one sqlite snapshot per
+    # shard TRANSFER_CHUNK_SIZE rows at a time
+    logging.debug("/export called")
+    rows = storage.iter_url_rows(transfer.TRANSFER_CHUNK_SIZE)
+
+    async def lines():
+        throughput = transfer.Throughput()
+        try:
+            while True:
+                chunk = await db_executor.run(next, rows, None)
+                if chunk is None:
+                    break
+                throughput.rows += len(chunk)
+                yield transfer.format_rows(chunk)
+            logging.info(f"/export finished {throughput.summary()}")
+        finally:
+            try:
+                rows.close()
+            except ValueError:
+                # the client left while a chunk was being read. the
+                # generator closes its connection once that read returns
+                # and it is garbage collected
+                pass
+
+    return StreamingResponse(lines(), media_type=ndjson.MEDIA_TYPE)
+
+
+@app.post("/import")
+async def import_urls(request: Request):
+    # adds the urls in a body written by /export. rows whose alias already
+    # exists are skipped
+    logging.debug("/import called")
+    importer = transfer.Importer(storage)
+
+    async def flush():
+        for alias in await db_executor.run(importer.flush):
+            negative_cache.add_alias(alias)
+
+    with MetricsHandler.query_time.labels("import").time():
+        async for item in ndjson.iter_json_items(request.stream()):
+            if importer.add(item):
+                await flush()
+        await flush()
+    summary = importer.summary()
+    logging.info(f"/import finished {summary}")
+    return summary
+
+
 @app.get("/list")
 async def get_urls(
     search: Optional[str] = None,
     page: int = 0,
     sort_by: str = "created_at",
     order: str = "DESC",
+    cursor: Optional[str] = None,
 ):
     valid_sort_attributes = {"id", "url", "alias", "created_at", "used"}
     if order not in {"DESC", "ASC"}:
@@ -111,33 +421,56 @@ async def get_urls(
             status_code=400,
             detail=f'search term "{search}" is invalid. only alphanumeric chars are allowed',
         )
+    if cursor is not None:
+        try:
+            sqlite_helpers.decode_cursor(cursor, sort_by, order)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
     with MetricsHandler.query_time.labels("list").time():
-        urls = sqlite_helpers.get_urls(
-            DATABASE_FILE, page, search=search, sort_by=sort_by, order=order
+        urls, total_urls = await db_executor.run(
+            storage.get_urls_page,
+            page,
+            search=search,
+            sort_by=sort_by,
+            order=order,
+            cursor=cursor,
         )
-        total_urls = sqlite_helpers.get_number_of_entries(DATABASE_FILE, search=search)
+        next_cursor = None
+        if len(urls) == sqlite_helpers.ROWS_PER_PAGE:
+            next_cursor = sqlite_helpers.encode_cursor(sort_by, order, urls[-1])
         return {
             "data": urls,
             "total": total_urls,
             "rows_per_page": sqlite_helpers.ROWS_PER_PAGE,
+            "next_cursor": next_cursor,
         }
 
 
 @app.get("/find/{alias}")
-async def get_url(alias: str):
+async def get_url(alias: str, request: Request):
     logging.debug(f"/find called with alias: {alias}")
-    url_output = cache.find(alias)  # try to find url in cache
+    url_output = None
+    # fast_app already missed the cache for this request, don't count it twice
+    if not request.scope.get(FAST_FIND_MISSED):
+        with MetricsHandler.find_stage_seconds.labels("cache").time():
+            url_output = cache.find(alias)  # try to find url in cache
     if url_output is not None:
-        alias_queue.put(alias)
+        await queue_hit(alias)
         return RedirectResponse(url_output)
+    if negative_cache.is_missing(alias):
+        raise HTTPException(status_code=HttpResponse.NOT_FOUND.code)
 
-    with MetricsHandler.query_time.labels("find").time():
-        url_output = sqlite_helpers.get_url(DATABASE_FILE, alias)
-    if url_output is None:
+    generation = negative_cache.generation
+    with MetricsHandler.query_time.labels("find").time(), \
+            MetricsHandler.find_stage_seconds.labels("db").time():
+        entry = await db_executor.run(storage.get_url, alias)
+    if entry is None:
+        negative_cache.add_miss(alias, generation)
         raise HTTPException(status_code=HttpResponse.NOT_FOUND.code)
-    cache.add(alias, url_output)  # else, adds url and alias to cache
+    url_output, expires_at = entry
+    cache.add(alias, url_output, expires_at)  # else, adds url and alias to cache
 
-    alias_queue.put(alias)
+    await queue_hit(alias)
     return RedirectResponse(url_output)
 
 
@@ -145,32 +478,128 @@ async def get_url(alias: str):
 async def delete_url(alias: str):
     logging.debug(f"/delete called with alias: {alias}")
     with MetricsHandler.query_time.labels("delete").time():
-        if sqlite_helpers.delete_url(DATABASE_FILE, alias):
-            qr_code_cache.delete(alias)
-            cache.delete(alias)
+        if await db_executor.run(storage.delete_url, alias):
+            forget_alias(alias)
             return {"message": "URL deleted successfully"}
         else:
             raise HTTPException(status_code=HttpResponse.NOT_FOUND.code)
 
-@app.get("/qr/{alias}") 
-async def qr(alias: str):
+# /stats bucket name -> minutes in it. buckets start at multiples of their
+# width since the epoch, so hours and days line up with UTC
+STATS_BUCKETS = {"minute": 1, "hour": 60, "day": 24 * 60}
+STATS_MAX_BUCKETS = 7 * 24 * 60
+STATS_DEFAULT_RANGE = timedelta(days=1)
+
+
+def parse_stats_time(value):
+    # ISO 8601, UTC unless it says otherwise. python 3.9 doesn't take "Z"
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def minute_to_iso(minute):
+    return datetime.fromtimestamp(minute * 60, timezone.utc).isoformat()
+
+
+@app.get("/stats/{alias}")
+async def get_stats(
+    alias: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    bucket: str = "hour",
+):
+    logging.debug(f"/stats called with alias: {alias}")
+    if bucket not in STATS_BUCKETS:
+        raise HTTPException(status_code=400, detail="Invalid bucket")
+    try:
+        end_time = parse_stats_time(end) if end else datetime.now(timezone.utc)
+        start_time = parse_stats_time(start) if start else end_time - STATS_DEFAULT_RANGE
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid start or end")
+    # widened to whole buckets, end exclusive
+    width = STATS_BUCKETS[bucket]
+    start_minute = int(start_time.timestamp() // 60) // width * width
+    end_minute = -(-int(-(-end_time.timestamp() // 60)) // width) * width
+    if end_minute <= start_minute or (end_minute - start_minute) // width > STATS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail="Invalid range")
+    with MetricsHandler.query_time.labels("stats").time():
+        clicks = await db_executor.run(
+            storage.get_clicks, alias, start_minute, end_minute, width
+        )
+    if clicks is None:
+        raise HTTPException(status_code=HttpResponse.NOT_FOUND.code)
+    clicks = dict(clicks)
+    return {
+        "alias": alias,
+        "bucket": bucket,
+        "start": minute_to_iso(start_minute),
+        "end": minute_to_iso(end_minute),
+        "total": sum(clicks.values()),
+        "data": [
+            {"start": minute_to_iso(minute), "clicks": clicks.get(minute, 0)}
+            for minute in range(start_minute, end_minute, width)
+        ],
+    }
+
+
+def qr_code_response(image, image_format, if_none_match):
+    headers = {"ETag": image.etag, "Cache-Control": QR_CODE_CACHE_CONTROL}
+    if if_none_match is not None:
+        etags = {etag.strip().removeprefix("W/") for etag in if_none_match.split(",")}
+        if "*" in etags or image.etag in etags:
+            return Response(status_code=304, headers=headers)
+    return Response(
+        content=image.data, media_type=QR_CODE_FORMATS[image_format], headers=headers
+    )
+
+
+async def alias_exists(alias):
+    # asks the url cache, then the negative cache and then sqlite, caching
+    # the answer like /find does
+    if cache.find(alias) is not None:
+        return True
+    if negative_cache.is_missing(alias):
+        return False
+    generation = negative_cache.generation
+    entry = await db_executor.run(storage.get_url, alias)
+    if entry is None:
+        negative_cache.add_miss(alias, generation)
+        return False
+    cache.add(alias, *entry)
+    return True
+
+
+@app.get("/qr/{alias}")
+async def qr(
+    alias: str,
+    request: Request,
+    image_format: str = Query("png", alias="format"),
+    scale: int = QR_CODE_SCALE,
+):
     logging.debug(f"/qr code generation called with alias: {alias}")
+    if image_format not in QR_CODE_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+    if not 1 <= scale <= QR_CODE_MAX_SCALE:
+        raise HTTPException(status_code=400, detail="Invalid scale")
     with MetricsHandler.query_time.labels("qr").time():
-        maybe_image_data = qr_code_cache.find(alias)
-        if maybe_image_data is not None:
-            return FileResponse(
-            maybe_image_data,
-            media_type='image/jpeg',
-            )
-        
-        url_output = sqlite_helpers.get_url(DATABASE_FILE, alias)
-        if url_output is None:
+        # a cached qr code can outlive its alias, like one left on disk by a
+        # crash or one in memory of another process, so the alias is
+        # checked first either way
+        if not await alias_exists(alias):
             raise HTTPException(status_code=HttpResponse.NOT_FOUND.code)
-        image_data = qr_code_cache.add(alias)
-        return FileResponse(
-            image_data,
-            media_type='image/jpeg',
-        )
+        key = qr_code_cache.variant_key(alias, image_format, scale)
+        image = qr_code_cache.find(key)
+        if image is None:
+            image = await qr_renders.run(
+                key, cpu_executor.run, qr_code_cache.add, alias, image_format, scale
+            )
+            if image is None:
+                raise HTTPException(status_code=HttpResponse.INTERNAL_SERVER_ERROR.code)
+        return qr_code_response(image, image_format, request.headers.get("if-none-match"))
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
@@ -182,18 +611,32 @@ async def http_exception_handler(request, exc):
 
 @app.get("/metrics")
 def get_metrics():
+    # read from url_counts on every scrape, so creates, deletes and expiry
+    # by any process are counted once
+    MetricsHandler.url_count.set(storage.get_number_of_entries())
     return Response(
         media_type="text/plain",
-        content=prometheus_client.generate_latest(),
+        content=MetricsHandler.generate_latest(),
     )
 
-# write qr-codes to json file on shutdown if cache state file arg is specified
+# flush pending hits and save cache state on shutdown. qr-codes are kept on
+# disk if cache state file arg is specified, otherwise cleared
 @app.on_event("shutdown")
 def signal_handler():
+    # every thread that uses sqlite is stopped before the connections close
+    cache_warmer.stop()
+    cache_warmer.write_snapshot()
+    hit_aggregator.stop()
+    expiry_sweeper.stop()
+    qr_prerenderer.stop()
+    cpu_executor.shutdown()
+    qr_code_cache.shutdown()
+    db_executor.shutdown()
     if args.qr_code_cache_state_file is None:
-        return qr_code_cache.clear()
-    
-    qr_code_cache.write_cache_state()
+        qr_code_cache.clear()
+    qr_code_cache.close()
+    sqlite_helpers.close_connections()
+    MetricsHandler.close()
 
 logging.Formatter.converter = time.gmtime
 
@@ -205,20 +648,6 @@ logging.basicConfig(
 )
 
 
-def consumer():
-    while True:
-        alias = alias_queue.get()
-        if alias is None:
-            break
-        try:
-            with MetricsHandler.query_time.labels("increment_used").time():
-                increment_used_column(DATABASE_FILE, alias)
-        except Exception:
-            logging.exception("Error updating used count for alias {alias}")
-        finally:
-            alias_queue.task_done()
-
-
 # we have a separate __name__ check here due to how FastAPI starts
 # a server. the file is first ran (where __name__ == "__main__")
 # and then calls `uvicorn.run`. the call to run() reruns the file,
@@ -228,12 +657,33 @@ def consumer():
 # the thread interacts with an instance different than the one the
 # server uses
 if __name__ == "server":
-    initial_url_count = sqlite_helpers.get_number_of_entries(DATABASE_FILE)
-    MetricsHandler.init()
-    MetricsHandler.url_count.inc(initial_url_count)
-    consumer_thread = Thread(target=consumer, daemon=True)
-    consumer_thread.start()
+    MetricsHandler.init(latency_buckets=args.metrics_latency_buckets)
+    MetricsHandler.url_count.set(storage.get_number_of_entries())
+    negative_cache.load(storage.get_all_aliases())
+    hit_aggregator.start()
+    cache_warmer.start()
+    qr_code_cache.start()
+    qr_prerenderer.start()
+    expiry_sweeper.start()
 
 if __name__ == "__main__":
+    if args.export_file is not None:
+        summary = transfer.export_to_file(storage, args.export_file)
+        print(f"exported {summary}", file=sys.stderr)
+        sys.exit()
+    if args.import_file is not None:
+        summary = transfer.import_from_file(storage, args.import_file)
+        print(f"imported {summary}", file=sys.stderr)
+        sys.exit(1 if summary["failed"] else 0)
+    if args.reshard_from is not None:
+        source = open_storage(args.reshard_from, args.reshard_from_shards)
+        summary = transfer.reshard(source, storage)
+        print(f"resharded {summary}", file=sys.stderr)
+        sys.exit(1 if summary["failed"] or summary["clicks_failed"] else 0)
     logging.info(f"running on {args.host}, listening on port {args.port}")
-    uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
+    uvicorn.run(
+        "server:fast_app" if args.fast_find else "server:app",
+        host=args.host,
+        port=args.port,
+        reload=True,
+    )
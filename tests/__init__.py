@@ -0,0 +1,17 @@
+import sys
+from unittest import mock
+
+from modules.metrics import MetricsHandler
+
+# modules.sqlite_helpers parses the server's arguments when it is first
+# imported, so it is imported here with the required ones
+with mock.patch.object(sys, "argv", [
+    "server.py",
+    "--database-file-path", "unused",
+    "--qr-code-cache-path", "unused",
+    "--qr-code-base-url", "unused",
+]):
+    import modules.sqlite_helpers  # noqa: F401
+
+# the metrics can only be registered once per process
+MetricsHandler.init()
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import prometheus_client
+
+from modules.hit_log import OVERFLOW_BLOCK, OVERFLOW_DROP, RECORD, HitLog
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# appends the aliases in argv[3:] to the log at argv[1] with capacity
+# argv[2], then dies without closing it. an alias of "!" dies halfway
+# through its append, after the record is written but before tail says so
+CHILD = """
+import os
+import sys
+
+from modules import hit_log
+from modules.metrics import MetricsHandler
+
+MetricsHandler.init()
+log = hit_log.HitLog(sys.argv[1], int(sys.argv[2]))
+log.open()
+for alias in sys.argv[3:]:
+    if alias == "!":
+        def crash(*args):
+            os._exit(0)
+        hit_log.struct = type("struct", (), {"pack_into": staticmethod(crash)})
+        alias = "torn"
+    log.append(alias, 1.0)
+os._exit(0)
+"""
+
+
+def overflows(policy, outcome):
+    value = prometheus_client.REGISTRY.get_sample_value(
+        "hit_log_overflows_total", {"policy": policy, "outcome": outcome}
+    )
+    return value or 0
+
+
+class HitLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.directory, "db.sqlite.hits")
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.close()
+        shutil.rmtree(self.directory)
+
+    def open_log(self, capacity=4096, **kwargs):
+        log = HitLog(self.base_path, capacity, **kwargs)
+        log.open()
+        self.logs.append(log)
+        return log
+
+    def close_log(self, log):
+        log.close()
+        self.logs.remove(log)
+
+    def run_child(self, capacity, *aliases):
+        subprocess.run(
+            [sys.executable, "-c", CHILD, self.base_path, str(capacity), *aliases],
+            cwd=REPO,
+            check=True,
+        )
+
+    def read_all(self, log):
+        return [alias for alias, _ in log.read(1000, timeout=0)]
+
+    def test_wraps_around(self):
+        # 3 records of 15 bytes fit in 50, and the fourth has to wrap
+        self.assertEqual(RECORD.size + len("aaaaa"), 15)
+        log = self.open_log(capacity=50)
+        for alias in ("aaaaa", "bbbbb", "ccccc"):
+            self.assertTrue(log.append(alias))
+        self.assertFalse(log.append("ddddd"))
+        self.assertEqual([alias for alias, _ in log.read(2)], ["aaaaa", "bbbbb"])
+        log.commit()
+        self.assertTrue(log.append("ddddd"))
+        self.assertTrue(log.append("eeeee"))
+        self.assertFalse(log.append("fffff"))
+        self.assertEqual(self.read_all(log), ["ccccc", "ddddd", "eeeee"])
+        self.assertEqual(log.tail, 80)
+
+    def test_reopen_returns_uncommitted_hits_after_wrapping(self):
+        log = self.open_log(capacity=50)
+        for alias in ("aaaaa", "bbbbb", "ccccc"):
+            log.append(alias)
+        log.read(2)
+        log.commit()
+        log.append("ddddd")
+        self.close_log(log)
+        log = self.open_log(capacity=50)
+        self.assertEqual(self.read_all(log), ["ccccc", "ddddd"])
+
+    def test_recovers_hits_of_a_crashed_process(self):
+        self.run_child(4096, "a", "b", "c")
+        log = self.open_log()
+        self.assertEqual(log.path, f"{self.base_path}.0")
+        self.assertEqual(log.read(10, timeout=0), [("a", 1.0), ("b", 1.0), ("c", 1.0)])
+
+    def test_drops_a_record_torn_by_a_crash(self):
+        self.run_child(4096, "a", "b", "!")
+        log = self.open_log()
+        self.assertEqual(self.read_all(log), ["a", "b"])
+        # the torn record's space is reused
+        log.append("c")
+        self.assertEqual(self.read_all(log), ["c"])
+
+    def test_resizes_a_log_written_with_another_capacity(self):
+        self.run_child(4096, "a", "b")
+        log = self.open_log(capacity=2048)
+        self.assertEqual(self.read_all(log), ["a", "b"])
+
+    def test_drop_policy_discards_hits_that_dont_fit(self):
+        log = self.open_log(capacity=20, overflow_policy=OVERFLOW_DROP)
+        self.assertTrue(log.append("a"))
+        dropped = overflows(OVERFLOW_DROP, "dropped")
+        self.assertFalse(log.append("b"))
+        self.assertEqual(overflows(OVERFLOW_DROP, "dropped"), dropped + 1)
+        self.assertEqual(self.read_all(log), ["a"])
+
+    def test_block_policy_gives_up_after_the_timeout(self):
+        log = self.open_log(capacity=20, overflow_policy=OVERFLOW_BLOCK, block_timeout=0.05)
+        log.append("a")
+        dropped = overflows(OVERFLOW_BLOCK, "dropped")
+        asyncio.run(log.append_async("b"))
+        self.assertEqual(overflows(OVERFLOW_BLOCK, "dropped"), dropped + 1)
+        self.assertEqual(self.read_all(log), ["a"])
+
+    def test_block_policy_waits_for_space(self):
+        log = self.open_log(capacity=20, overflow_policy=OVERFLOW_BLOCK, block_timeout=5)
+        log.append("a")
+        waited = overflows(OVERFLOW_BLOCK, "waited")
+
+        def drain():
+            log.read(1)
+            log.commit()
+
+        timer = threading.Timer(0.05, drain)
+        timer.start()
+        asyncio.run(log.append_async("b"))
+        timer.join()
+        self.assertEqual(overflows(OVERFLOW_BLOCK, "waited"), waited + 1)
+        self.assertEqual(self.read_all(log), ["b"])
+
+    def test_each_open_log_gets_its_own_file(self):
+        first = self.open_log()
+        second = self.open_log()
+        self.assertEqual(first.path, f"{self.base_path}.0")
+        self.assertEqual(second.path, f"{self.base_path}.1")
+
+    def test_adopts_the_log_of_a_process_that_is_gone(self):
+        live = self.open_log()
+        live.append("mine", 2.0)
+        # .0 is taken, so the child's log is .1
+        self.run_child(4096, "a", "b")
+        self.close_log(live)
+        log = self.open_log()
+        self.assertEqual(log.path, f"{self.base_path}.0")
+        self.assertEqual(
+            log.read(10, timeout=0), [("mine", 2.0), ("a", 1.0), ("b", 1.0)]
+        )
+        self.assertFalse(os.path.exists(f"{self.base_path}.1"))
+
+    def test_leaves_the_log_of_a_running_process_alone(self):
+        first = self.open_log()
+        second = self.open_log()
+        second.append("theirs")
+        self.close_log(first)
+        log = self.open_log()
+        self.assertEqual(self.read_all(log), [])
+        self.assertEqual(self.read_all(second), ["theirs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from modules.shared_cache import FILE_HEADER_SIZE, SharedMemoryCache, WAYS, _hash_alias
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        # WAYS entries is a single bucket, so every alias shares its ways
+        self.cache = SharedMemoryCache(os.path.join(directory, "cache"), WAYS, 100)
+
+    def test_readd_after_delete_of_earlier_way_keeps_one_copy(self):
+        self.cache.add("a", "https://a")
+        self.cache.add("b", "https://b")
+        self.cache.delete("a")
+        # the way "a" freed comes before the one "b" is in
+        self.cache.add("b", "https://b")
+        self.cache.delete("b")
+        self.assertIsNone(self.cache.find("b"))
+
+    def test_delete_clears_every_copy(self):
+        alias_bytes = b"b"
+        key_hash = _hash_alias(alias_bytes)
+        # two copies, as add() used to be able to leave behind
+        for way in range(2):
+            self.cache._write_slot(
+                FILE_HEADER_SIZE + way * self.cache.slot_size, key_hash, alias_bytes, b"https://b"
+            )
+        self.cache.delete("b")
+        self.assertIsNone(self.cache.find("b"))
+
+    def test_add_replaces_the_existing_entry(self):
+        self.cache.add("a", "https://a")
+        self.cache.add("a", "https://new")
+        self.assertEqual(self.cache.find("a"), "https://new")
+        self.assertEqual(self.cache.items(), [("a", "https://new")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import base64
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from modules import sqlite_helpers
+from modules.storage import open_storage
+
+ROWS = 137
+SORTS = [
+    (sort_by, order)
+    for sort_by in sorted(sqlite_helpers.SORT_COLUMNS)
+    for order in ("ASC", "DESC")
+]
+
+
+def walk(storage, sort_by, order):
+    # every row of /list, following next_cursor like a client
+    rows = []
+    cursor = None
+    while True:
+        urls, _ = storage.get_urls_page(sort_by=sort_by, order=order, cursor=cursor)
+        rows += urls
+        if len(urls) < sqlite_helpers.ROWS_PER_PAGE:
+            return rows
+        cursor = sqlite_helpers.encode_cursor(sort_by, order, urls[-1])
+
+
+def walk_pages(storage, sort_by, order):
+    rows = []
+    page = 0
+    while True:
+        urls, _ = storage.get_urls_page(page, sort_by=sort_by, order=order)
+        rows += urls
+        if len(urls) < sqlite_helpers.ROWS_PER_PAGE:
+            return rows
+        page += 1
+
+
+class ShardedListTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        rng = random.Random(7)
+        # few distinct urls, times and counts, so every sort has ties
+        rows = [
+            (
+                f"https://example.com/{rng.randrange(6)}",
+                f"alias{i}",
+                f"2024-01-0{rng.randrange(1, 4)} 00:00:00.000000",
+                None,
+                rng.randrange(4),
+            )
+            for i in range(ROWS)
+        ]
+        cls.single = open_storage(os.path.join(cls.directory, "single.db"))
+        cls.sharded = open_storage(os.path.join(cls.directory, "sharded.db"), 3)
+        for storage in (cls.single, cls.sharded):
+            storage.maybe_create_table()
+            storage.import_urls(rows)
+
+    @classmethod
+    def tearDownClass(cls):
+        sqlite_helpers.close_connections()
+        shutil.rmtree(cls.directory)
+
+    def test_every_shard_has_rows(self):
+        for sqlite_file in self.sharded.sqlite_files:
+            self.assertGreater(sqlite_helpers.get_number_of_entries(sqlite_file), 0)
+
+    def test_cursor_walk_matches_unsharded_walk(self):
+        for sort_by, order in SORTS:
+            with self.subTest(sort_by=sort_by, order=order):
+                expected = walk(self.single, sort_by, order)
+                rows = walk(self.sharded, sort_by, order)
+                aliases = [row["alias"] for row in rows]
+                self.assertEqual(len(aliases), ROWS)
+                self.assertEqual(len(set(aliases)), ROWS)
+                # ids differ between the layouts, so rows that tie on the
+                # sort value may come in another order
+                if sort_by != "id":
+                    self.assertEqual(
+                        [row[sort_by] for row in rows], [row[sort_by] for row in expected]
+                    )
+                keys = [(row[sort_by], row["id"]) for row in rows]
+                self.assertEqual(keys, sorted(keys, reverse=order == "DESC"))
+
+    def test_page_walk_matches_cursor_walk(self):
+        for sort_by, order in SORTS:
+            with self.subTest(sort_by=sort_by, order=order):
+                self.assertEqual(
+                    walk_pages(self.sharded, sort_by, order), walk(self.sharded, sort_by, order)
+                )
+
+    def test_cursor_from_every_row_continues_after_it(self):
+        for sort_by, order in SORTS:
+            with self.subTest(sort_by=sort_by, order=order):
+                rows = walk(self.sharded, sort_by, order)
+                for i, row in enumerate(rows):
+                    cursor = sqlite_helpers.encode_cursor(sort_by, order, row)
+                    urls, _ = self.sharded.get_urls_page(
+                        sort_by=sort_by, order=order, cursor=cursor
+                    )
+                    self.assertEqual(urls, rows[i + 1:i + 1 + sqlite_helpers.ROWS_PER_PAGE])
+
+
+class CursorTest(unittest.TestCase):
+    def encode(self, *token):
+        return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+    def test_round_trip(self):
+        row = {"used": 3, "id": 7}
+        cursor = sqlite_helpers.encode_cursor("used", "DESC", row)
+        self.assertEqual(sqlite_helpers.decode_cursor(cursor, "used", "DESC"), (3, 7))
+
+    def test_rejects_values_sqlite_cant_bind(self):
+        for sort_by, sort_value, last_id in [
+            ("url", ["a"], 1),
+            ("url", {"a": 1}, 1),
+            ("used", True, 1),
+            ("id", "1", 1),
+            ("id", 1.5, 1),
+            ("url", "a", True),
+            ("url", "a", "1"),
+        ]:
+            with self.subTest(sort_by=sort_by, sort_value=sort_value, last_id=last_id):
+                cursor = self.encode(sort_by, "ASC", sort_value, last_id)
+                with self.assertRaises(ValueError):
+                    sqlite_helpers.decode_cursor(cursor, sort_by, "ASC")
+
+    def test_rejects_a_cursor_of_another_sort(self):
+        cursor = self.encode("url", "ASC", "a", 1)
+        with self.assertRaises(ValueError):
+            sqlite_helpers.decode_cursor(cursor, "url", "DESC")
+
+
+if __name__ == "__main__":
+    unittest.main()